@@ -0,0 +1,228 @@
+import math
+import numpy as np
+
+from ColourUtils import srgb_to_oklab, oklab_to_srgb
+from NoteUtils import MIDI_NOTE_COLOURS, MIDI_NOTE_OKLAB, MIDI_NOTE_OKLAB_CHROMA, NUM_MIDI_NOTES, NUM_PITCH_CLASSES
+
+# Struct-of-arrays animation engine for the brightness of every MIDI note.
+# Each of the 128 notes has a slot in a set of numpy arrays (start/target value,
+# elapsed time, duration, curve, current value and colour) so that a whole frame
+# is updated with a handful of vector operations instead of a Python loop over
+# per-note Animation objects.
+#
+# The per-slot semantics match Animation.Animation exactly (including how
+# reset() collapses animations whose start value isn't above their target), and
+# the colour blend matches the Animator's original sequential blend, so the LEDs
+# don't change.
+class AnimationEngine(object):
+  # Interpolation curves (see Animation.py)
+  CURVE_SQRTSTEP = 0
+  CURVE_SMOOTHSTEP = 1
+
+  # Colour spaces the colours of the notes can be blended in (see blend() and blend_perceptual())
+  BLEND_RGB = "rgb"
+  BLEND_OKLAB = "oklab"
+  BLEND_OKLCH = "oklch"
+  BLENDS = [BLEND_RGB, BLEND_OKLAB, BLEND_OKLCH]
+
+  def __init__(self, blend: str = BLEND_RGB):
+    if blend not in self.BLENDS:
+      raise ValueError("Unknown blend: " + str(blend))
+    self.blend_mode = blend
+    n = NUM_MIDI_NOTES
+    self.init_value = np.zeros(n, dtype=np.float64)
+    self.final_value = np.zeros(n, dtype=np.float64)
+    self.elapsed = np.zeros(n, dtype=np.float64)
+    self.duration = np.zeros(n, dtype=np.float64)
+    self.curve = np.zeros(n, dtype=np.int8)
+    self.curr_value = np.zeros(n, dtype=np.float64)
+    # Every note starts with its colour from the palette, whose Oklab colours and
+    # chromas were converted once at start up (see NoteUtils.MIDI_NOTE_OKLAB), so a
+    # note-on only converts a colour that isn't the note's palette colour
+    self.colour = np.array(MIDI_NOTE_COLOURS, dtype=np.float64)
+    self.oklab_colour = np.array(MIDI_NOTE_OKLAB, dtype=np.float64)
+    self.oklab_chroma = np.array(MIDI_NOTE_OKLAB_CHROMA, dtype=np.float64)
+    self.active = np.zeros(n, dtype=bool)
+    # Order in which the notes' animations were started, colours are blended in this order
+    self.start_order = np.zeros(n, dtype=np.int64)
+    self._next_start_order = 0
+
+    # Per-slot constants derived from the values above whenever a slot is (re)started
+    self._timed = np.zeros(n, dtype=bool)
+    self._is_sqrtstep = np.ones(n, dtype=bool)
+    self._delta = np.zeros(n, dtype=np.float64)
+    self._flat = np.ones(n, dtype=bool)
+    self._smooth_denom = np.ones(n, dtype=np.float64)
+    # Per-frame scratch
+    self._progress = np.ones(n, dtype=np.float64)
+    self._sqrtstep = np.zeros(n, dtype=np.float64)
+    self._smoothstep = np.zeros(n, dtype=np.float64)
+    self._retired = np.zeros(n, dtype=bool)
+
+    # Active notes in start order (cached until the set of active notes changes)
+    self._ordered_dirty = True
+    self._ordered_notes = np.zeros(0, dtype=np.int64)
+    self._ordered_pitch_classes = np.zeros(0, dtype=np.int64)
+    self._ordered_positions = np.zeros(0, dtype=np.int64)
+
+    # Results of the latest update(), indexed the same as active_notes
+    self.active_notes = self._ordered_notes
+    self.contributing = np.zeros(0, dtype=bool)
+    self.pitch_class_brightness = np.zeros(NUM_PITCH_CLASSES, dtype=np.float64)
+
+    self._note_pitch_classes = np.arange(n) % NUM_PITCH_CLASSES
+    self._black = np.zeros(3, dtype=np.float64)
+
+  def is_active(self, note: int):
+    return bool(self.active[note])
+
+  def num_active(self):
+    return int(np.count_nonzero(self.active))
+
+  # Active notes sharing the pitch class of the given note (excluding the note itself),
+  # limited to the range of an 88 key piano (A0..C8)
+  def active_notes_in_pitch_class(self, note: int):
+    candidates = np.arange(note % NUM_PITCH_CLASSES + 12, 109, NUM_PITCH_CLASSES)
+    candidates = candidates[(candidates >= 21) & (candidates != note)]
+    return candidates[self.active[candidates]]
+
+  # Starts (or restarts) the animation of a note, equivalent to constructing a new
+  # Animation (for an inactive note) or calling Animation.reset() on an active one.
+  # Passing colour=None keeps the note's current colour (its palette colour unless
+  # it's been given another).
+  def start(self, note: int, init_value: float, final_value: float, duration_s: float, curve: int, colour=None):
+    if not self.active[note]:
+      self.active[note] = True
+      self.start_order[note] = self._next_start_order
+      self._next_start_order += 1
+      self._ordered_dirty = True
+    self.init_value[note] = init_value
+    self.final_value[note] = final_value
+    self.elapsed[note] = 0.0
+    if (init_value - final_value) < 1e-6:
+      self.init_value[note] = final_value
+      self.duration[note] = 0.0
+    elif duration_s is not None:
+      self.duration[note] = duration_s
+    self.curve[note] = curve
+    self.curr_value[note] = init_value
+    if colour is not None:
+      self.colour[note] = colour
+      if self.blend_mode != self.BLEND_RGB:
+        self.oklab_colour[note] = srgb_to_oklab(self.colour[note])
+        self.oklab_chroma[note] = math.hypot(self.oklab_colour[note, 1], self.oklab_colour[note, 2])
+
+    self._timed[note] = self.duration[note] > 0.0
+    if not self._timed[note]:
+      self._progress[note] = 1.0
+    self._is_sqrtstep[note] = curve == self.CURVE_SQRTSTEP
+    self._delta[note] = self.final_value[note] - self.init_value[note]
+    self._flat[note] = abs(self._delta[note]) < 1e-6
+    self._smooth_denom[note] = 1.0 if self._flat[note] else self._delta[note]
+
+  def _update_ordered_notes(self):
+    notes = np.flatnonzero(self.active)
+    notes = notes[np.argsort(self.start_order[notes], kind='stable')]
+    self._ordered_notes = notes
+    self._ordered_pitch_classes = self._note_pitch_classes[notes]
+    self._ordered_positions = np.arange(notes.size)
+    self._ordered_dirty = False
+
+  # Advances all active animations by dt seconds, retires the ones that are done
+  # and dark, and returns the blended colour of the brightest note per pitch class.
+  def update(self, dt: float):
+    if self._ordered_dirty:
+      self._update_ordered_notes()
+    notes = self._ordered_notes
+    if notes.size == 0:
+      self.active_notes = notes
+      self.contributing = np.zeros(0, dtype=bool)
+      self.pitch_class_brightness[:] = 0.0
+      return self._black.copy()
+
+    # Interpolate every slot at once (inactive slots are simply ignored)
+    np.add(self.elapsed, dt, out=self.elapsed, where=self.active)
+    progress = self._progress
+    np.divide(self.elapsed, self.duration, out=progress, where=self._timed)
+    np.minimum(progress, 1.0, out=progress)
+    # sqrtstep: lerp from the initial to the final value by sqrt(progress)
+    sqrtstep = self._sqrtstep
+    np.sqrt(progress, out=sqrtstep)
+    sqrtstep *= self._delta
+    sqrtstep += self.init_value
+    # smoothstep: v*v*(3 - 2v) with v the clamped position of progress between the values
+    v = self._smoothstep
+    np.subtract(progress, self.init_value, out=v)
+    v /= self._smooth_denom
+    np.maximum(v, 0.0, out=v)
+    np.minimum(v, 1.0, out=v)
+    smoothstep = (3.0 - 2.0 * v) * v * v
+    np.copyto(smoothstep, self.final_value, where=self._flat)
+    np.copyto(self.curr_value, np.where(self._is_sqrtstep, sqrtstep, smoothstep), where=self.active)
+    brightness = self.curr_value[notes]
+
+    # A note contributes if it's brighter than every earlier note of its pitch class
+    pitch_classes = self._ordered_pitch_classes
+    positions = self._ordered_positions
+    running_max = np.full((NUM_PITCH_CLASSES, notes.size + 1), -np.inf)
+    running_max[pitch_classes, positions + 1] = brightness
+    np.maximum.accumulate(running_max, axis=1, out=running_max)
+    contributing = brightness > running_max[pitch_classes, positions]
+    np.maximum(running_max[:, -1], 0.0, out=self.pitch_class_brightness)
+
+    self.active_notes = notes
+    self.contributing = contributing
+
+    # Finished animations that no longer contribute any colour are retired
+    retired = self._retired
+    np.greater_equal(self.elapsed, self.duration, out=retired)
+    retired &= self.active
+    retired &= self.curr_value == 0.0
+    if retired.any():
+      self.active &= ~retired
+      self._ordered_dirty = True
+
+    contributing_notes = notes[contributing]
+    if self.blend_mode == self.BLEND_RGB:
+      return self.blend(brightness[contributing], self.colour[contributing_notes])
+    return self.blend_perceptual(brightness[contributing], contributing_notes)
+
+  # Each colour of the sequential blend
+  #   total = colour * b + (1 - b / sum(b)) * total
+  # ends up weighted by its brightness times the (1 - b / sum(b)) factors of every
+  # colour blended after it. Returns None if there's nothing to blend.
+  @staticmethod
+  def _blend_weights(brightness: np.ndarray):
+    total_brightness = brightness.sum()
+    if brightness.size == 0 or not total_brightness > 0.0:
+      return None
+    keep = 1.0 - brightness / total_brightness
+    later_keep = np.ones_like(keep)
+    later_keep[:-1] = np.cumprod(keep[:0:-1])[::-1]
+    return brightness * later_keep
+
+  # Vectorized form of the sequential blend in RGB
+  def blend(self, brightness: np.ndarray, colours: np.ndarray):
+    weights = self._blend_weights(brightness)
+    if weights is None:
+      return self._black.copy()
+    total_colour = weights @ colours
+    np.maximum(total_colour, 0.0, out=total_colour)
+    np.minimum(total_colour, 1.0, out=total_colour)
+    return total_colour
+
+  # The sequential blend's weights, but the colours of the notes are mixed in Oklab
+  # and the mix is then scaled by the total weight (so a single note comes out the
+  # same as in RGB). BLEND_OKLCH also keeps the weighted mean chroma of the colours,
+  # so that opposite hues don't cancel out to grey.
+  def blend_perceptual(self, brightness: np.ndarray, notes: np.ndarray):
+    weights = self._blend_weights(brightness)
+    if weights is None:
+      return self._black.copy()
+    total_weight = weights.sum()
+    lab = (weights @ self.oklab_colour[notes]) / total_weight
+    if self.blend_mode == self.BLEND_OKLCH:
+      chroma = math.hypot(lab[1], lab[2])
+      if chroma > 1e-9:
+        lab[1:] *= (weights @ self.oklab_chroma[notes]) / total_weight / chroma
+    return oklab_to_srgb(lab) * min(total_weight, 1.0)
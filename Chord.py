@@ -0,0 +1,207 @@
+from typing import NamedTuple, Tuple
+
+from NoteUtils import NUM_PITCH_CLASSES
+from KeySpelling import Key, spell
+
+# Chord naming ported from web/js/chord.js (and its vocabulary from
+# web/js/chord-qualities.js), so the LED app can react to the harmony of the
+# held notes. Instead of matching every root and quality against the held notes
+# like the JS does, every answer is looked up in tables built once at import,
+# indexed by the 12-bit mask of the held pitch classes (bit pc set, 0 = C) and
+# the bass pitch class, so getting the chord of a frame's notes is O(1).
+
+# name: display suffix, intervals: semitones from the root, required: the tones
+# an implied (partial) chord must have, one_of: of which an implied chord must
+# have at least one (only '7' has any)
+class ChordQuality(NamedTuple):
+  name: str
+  intervals: Tuple[int, ...]
+  required: Tuple[int, ...]
+  one_of: Tuple[int, ...] = ()
+
+# Simplest first, in the same order as the JS (which the mic's fuzzy scorer relies on)
+CHORD_QUALITIES = (
+  ChordQuality('', (0, 4, 7), (0, 4)),
+  ChordQuality('m', (0, 3, 7), (0, 3)),
+  ChordQuality('dim', (0, 3, 6), (0, 3, 6)),
+  ChordQuality('aug', (0, 4, 8), (0, 4, 8)),
+  ChordQuality('sus2', (0, 2, 7), (0, 2, 7)),
+  ChordQuality('sus4', (0, 5, 7), (0, 5, 7)),
+  ChordQuality('7', (0, 4, 7, 10), (0, 10), (4, 7)),
+  ChordQuality('maj7', (0, 4, 7, 11), (0, 4, 11)),
+  ChordQuality('m7', (0, 3, 7, 10), (0, 3, 10)),
+  ChordQuality('ø7', (0, 3, 6, 10), (0, 3, 6, 10)),
+  ChordQuality('dim7', (0, 3, 6, 9), (0, 3, 6, 9)),
+  ChordQuality('6', (0, 4, 7, 9), (0, 4, 9)),
+  ChordQuality('m6', (0, 3, 7, 9), (0, 3, 9)),
+)
+DIM7 = 'dim7'
+
+NUM_MASKS = 1 << NUM_PITCH_CLASSES
+# Bass pitch class index for when there's no bass (e.g., a chroma without one)
+NO_BASS = NUM_PITCH_CLASSES
+
+# A chord identity: root pitch class (0 = C) and quality
+class Chord(NamedTuple):
+  root: int
+  quality: ChordQuality
+
+  def name(self, key: Key = None):
+    return spell(self.root, key) + self.quality.name
+
+# The chord names of a set of pitch classes, preferred interpretation first,
+# whether they're all rotations of one symmetric chord (dim7, aug) and whether
+# the lead root was picked for a reason (the bass, a dim7's leading tone)
+class ChordNames(NamedTuple):
+  names: Tuple[str, ...]
+  symmetric: bool
+  root_confident: bool
+
+def pitch_class_mask(pitch_classes):
+  mask = 0
+  for pc in pitch_classes:
+    mask |= 1 << (pc % NUM_PITCH_CLASSES)
+  return mask
+
+def mask_pitch_classes(mask: int):
+  return [pc for pc in range(NUM_PITCH_CLASSES) if mask & (1 << pc)]
+
+def _interval_mask(root: int, intervals):
+  return pitch_class_mask(root + interval for interval in intervals)
+
+def _build_tables():
+  exact = [() for _ in range(NUM_MASKS)]
+  # Per held mask, every chord its tones could imply: (chord, quality index, tones present)
+  implied_candidates = [[] for _ in range(NUM_MASKS)]
+  for qi, quality in enumerate(CHORD_QUALITIES):
+    for root in range(NUM_PITCH_CLASSES):
+      chord = Chord(root, quality)
+      chord_mask = _interval_mask(root, quality.intervals)
+      exact[chord_mask] += (chord,)
+      required_mask = _interval_mask(root, quality.required)
+      one_of_mask = _interval_mask(root, quality.one_of)
+      # Every held set inside the chord's tones with all of its required tones
+      submask = chord_mask
+      while True:
+        if submask & required_mask == required_mask and (one_of_mask == 0 or submask & one_of_mask):
+          implied_candidates[submask].append((chord, qi, bin(submask).count('1')))
+        if submask == 0:
+          break
+        submask = (submask - 1) & chord_mask
+
+  # Exact chords with the bass-rooted one first, then by root (the qualities
+  # were added in root order within each quality, so sort by root)
+  exact = [tuple(sorted(chords, key=lambda chord: chord.root)) for chords in exact]
+  no_chords = ((),) * (NUM_PITCH_CLASSES + 1)
+  exact_by_bass = [
+    tuple(tuple(sorted(chords, key=lambda chord: chord.root != bass)) for bass in range(NUM_PITCH_CLASSES + 1))
+    if chords else no_chords
+    for chords in exact
+  ]
+
+  # Implied chord of every non-chord set of 2+ pitch classes, per lowest pitch
+  # class: the simplest quality, then rooted on the lowest note, then the most
+  # tones present; None if the top two are tied
+  implied = []
+  for mask in range(NUM_MASKS):
+    row = [None] * NUM_PITCH_CLASSES
+    candidates = implied_candidates[mask]
+    if bin(mask).count('1') >= 2 and not exact[mask] and candidates:
+      for lowest in mask_pitch_classes(mask):
+        ranked = sorted(
+          candidates,
+          key=lambda c: (len(c[0].quality.intervals), c[1], c[0].root != lowest, -c[2])
+        )
+        if len(ranked) > 1:
+          a, b = ranked[0], ranked[1]
+          if (len(a[0].quality.intervals), a[1], a[0].root != lowest, a[2]) == \
+             (len(b[0].quality.intervals), b[1], b[0].root != lowest, b[2]):
+            continue
+        row[lowest] = ranked[0][0]
+    implied.append(tuple(row))
+  return exact_by_bass, implied
+
+_EXACT_BY_BASS, _IMPLIED = _build_tables()
+
+# The chords the pitch classes in mask form exactly (aliases, e.g., C6 and Am7),
+# the one rooted on the bass first, then by root. Empty if they aren't a chord.
+def exact_chords(mask: int, bass_pc: int = None):
+  return _EXACT_BY_BASS[mask][NO_BASS if bass_pc is None else bass_pc]
+
+# The chord the pitch classes in mask imply without being exactly a chord (e.g.,
+# E B D implies E7), lowest_pc breaks ties. None if there isn't one or it's ambiguous.
+def implied_chord_of_mask(mask: int, lowest_pc: int):
+  return _IMPLIED[mask][lowest_pc]
+
+# All the exact names of the pitch classes, see ChordNames. A dim7 leads with
+# the key's leading tone (its diatonic vii°7) if that's one of its roots,
+# otherwise every chord leads with the bass.
+def chord_names_detailed(pitch_classes, bass_pc: int = None, key: Key = None):
+  chords = exact_chords(pitch_class_mask(pitch_classes), bass_pc)
+  if len(chords) == 0:
+    return ChordNames((), False, False)
+  root_confident = bass_pc is not None
+  if key is not None and any(chord.quality.name == DIM7 for chord in chords):
+    leading_tone = (key.tonic - 1) % NUM_PITCH_CLASSES
+    if any(chord.root == leading_tone and chord.quality.name == DIM7 for chord in chords):
+      chords = sorted(chords, key=lambda chord: (chord.root != leading_tone, chord.root))
+      root_confident = True
+  symmetric = len(chords) > 1 and all(chord.quality == chords[0].quality for chord in chords)
+  return ChordNames(tuple(chord.name(key) for chord in chords), symmetric, root_confident)
+
+def chord_names(pitch_classes, bass_pc: int = None, key: Key = None):
+  return chord_names_detailed(pitch_classes, bass_pc, key).names
+
+# Pitch classes of the MIDI notes, ordered by the lowest note of each
+def ordered_pitch_classes(midi_notes):
+  lowest = {}
+  for note in midi_notes:
+    pc = note % NUM_PITCH_CLASSES
+    if pc not in lowest or note < lowest[pc]:
+      lowest[pc] = note
+  return sorted(lowest, key=lowest.get)
+
+def _note_names(pitch_classes, key: Key, ordered_pcs):
+  order = ordered_pcs if ordered_pcs is not None else sorted(pitch_classes)
+  return " ".join(spell(pc, key) for pc in order)
+
+# The readout of a set of pitch classes: every name of the chord they form
+# joined with " / " (bass first), else their note names (in ordered_pcs order)
+def name_from_pitch_classes(pitch_classes, bass_pc: int = None, key: Key = None, ordered_pcs=None):
+  pitch_classes = set(pitch_classes)
+  if len(pitch_classes) == 0:
+    return ''
+  names = chord_names(pitch_classes, bass_pc, key)
+  if len(names) > 0:
+    return " / ".join(names)
+  return _note_names(pitch_classes, key, ordered_pcs)
+
+# Same as name_from_pitch_classes() split into (main, synonyms): a symmetric
+# chord with a confident root shows that one name, its synonyms separately
+def display_from_pitch_classes(pitch_classes, bass_pc: int = None, key: Key = None, ordered_pcs=None):
+  pitch_classes = set(pitch_classes)
+  if len(pitch_classes) == 0:
+    return '', []
+  names, symmetric, root_confident = chord_names_detailed(pitch_classes, bass_pc, key)
+  if len(names) > 0:
+    if symmetric and root_confident:
+      return names[0], list(names[1:])
+    return " / ".join(names), []
+  return _note_names(pitch_classes, key, ordered_pcs), []
+
+# The readout of held MIDI notes, the lowest note is the bass
+def name_from_midi_notes(midi_notes, key: Key = None):
+  order = ordered_pitch_classes(midi_notes)
+  return name_from_pitch_classes(order, order[0] if order else None, key, order)
+
+def display_from_midi_notes(midi_notes, key: Key = None):
+  order = ordered_pitch_classes(midi_notes)
+  return display_from_pitch_classes(order, order[0] if order else None, key, order)
+
+# Name of the chord the held MIDI notes imply (see implied_chord_of_mask()), or None
+def implied_chord(midi_notes, key: Key = None):
+  order = ordered_pitch_classes(midi_notes)
+  if len(order) < 2:
+    return None
+  chord = implied_chord_of_mask(pitch_class_mask(order), order[0])
+  return chord.name(key) if chord is not None else None
@@ -0,0 +1,416 @@
+import math
+import numpy as np
+
+from NoteUtils import A4_FREQUENCY_HZ, NUM_PITCH_CLASSES
+from PitchEngine import PitchEngine
+from RingBuffer import AudioRingBuffer, HopCursor
+
+# Fundamentals and harmonics are only looked at within the audible band
+F_LO = 20.0
+F_HI = 20000.0
+# The long FFT covers everything below, the short FFT everything above
+SPLIT_HZ = 1000.0
+# Bins under -85dB (Web Audio's dB magnitudes) are exact zeros
+MAG_FLOOR = 10.0 ** (-85.0 / 20.0)
+# A bin must clear -70dB to count as a real partial (for the chroma and bass pick)
+PEAK_FLOOR_MAG = 3.2e-4
+
+# The web view's DSP presets (see web/js/mic-input.js), raw makes the whole DSP stage a no-op
+DSP_PRESETS = {
+  'raw': {'overtone': 0.0, 'whiten': 0.0, 'phon': 0.0, 'focus': 0.0, 'gate': 0.0, 'drums': 0.0},
+  'melodic': {'overtone': 0.35, 'whiten': 0.35, 'phon': 0.35, 'focus': 0.3, 'gate': 0.25, 'drums': 0.3},
+}
+
+# A-weighting-style amplitude gain, normalized near its 1 kHz reference
+def a_weight_gain(f):
+  f2 = f * f
+  ra = (12200.0 ** 2 * f2 * f2) / (
+    (f2 + 20.6 ** 2) * np.sqrt((f2 + 107.7 ** 2) * (f2 + 737.9 ** 2)) * (f2 + 12200.0 ** 2)
+  )
+  return np.power(10.0, (20.0 * np.log10(np.maximum(ra, 1e-12)) + 2.0) / 20.0)
+
+# Web Audio's AnalyserNode window (a Blackman window over N, not N - 1, samples)
+def _analyser_window(fft_size):
+  n = np.arange(fft_size, dtype=np.float64) / fft_size
+  return 0.42 - 0.5 * np.cos(2.0 * np.pi * n) + 0.08 * np.cos(4.0 * np.pi * n)
+
+# Forward and backward one-pole smoother whose window grows with the bin index
+# (frac of the bin's centre frequency, at least min_width bins), i.e., a roughly
+# constant-Q spectral envelope. Each pass is the recurrence
+#   y[i] = (1 - a[i]) * y[i-1] + a[i] * x[i]
+# whose coefficients only depend on the bin, so within a block of bins it has the
+# closed form y[i] = D[i] * (y_prev + cumsum(a * x / D)[i]) with D the cumulative
+# product of (1 - a). The blocks are short enough that D never underflows.
+class _ConstantQSmoother(object):
+  BLOCK_LENGTH = 256
+
+  def __init__(self, first_bin: int, last_bin: int, frac: float, min_width: float):
+    bins = np.arange(first_bin, last_bin + 1, dtype=np.float64)
+    a = 1.0 / np.maximum(frac * bins, min_width)
+    self.forward = self._blocks(a)
+    self.backward = self._blocks(a[::-1])
+
+  def _blocks(self, a):
+    blocks = []
+    for start in range(0, a.size, self.BLOCK_LENGTH):
+      block = slice(start, min(start + self.BLOCK_LENGTH, a.size))
+      decay = np.cumprod(1.0 - a[block])
+      blocks.append((block, decay, a[block] / decay))
+    return blocks
+
+  @staticmethod
+  def _run(blocks, x, out):
+    prev = x[0]
+    for block, decay, gain in blocks:
+      np.multiply(gain, x[block], out=out[block])
+      np.cumsum(out[block], out=out[block])
+      out[block] += prev
+      out[block] *= decay
+      prev = out[block.stop - 1]
+
+  # Smooths x (the band's bins first_bin..last_bin) into out
+  def smooth(self, x, out):
+    self._run(self.forward, x, out)
+    self._run(self.backward, out[::-1], out[::-1])
+
+# One resolution of the dual-resolution analysis: an rfft frame of fft_size
+# samples whose bins first_bin..last_bin cover [lo_hz, hi_hz]
+class _Band(object):
+  def __init__(self, sample_rate: int, fft_size: int, smoothing: float, lo_hz: float, hi_hz: float):
+    self.fft_size = fft_size
+    self.smoothing = smoothing
+    self.window = _analyser_window(fft_size)
+    num_bins = fft_size // 2
+    self.hz = sample_rate / 2.0 / num_bins
+    self.first_bin = max(2, int(math.ceil(lo_hz / self.hz)))
+    self.last_bin = min(num_bins - 2, int(math.floor(hi_hz / self.hz)))
+    # The band's magnitudes include a guard bin each side (for the peak tests)
+    self.guarded = slice(self.first_bin - 1, self.last_bin + 2)
+    self.num_used = self.last_bin - self.first_bin + 1
+    self.smoothed = np.zeros(self.last_bin + 2 - (self.first_bin - 1), dtype=np.float64)
+
+  # Web Audio's smoothed magnitudes (|X[k]| / N, averaged over time) of the band's guarded bins
+  def analyse(self, frame):
+    spectrum = np.abs(np.fft.rfft(frame * self.window)[self.guarded]) / self.fft_size
+    self.smoothed *= self.smoothing
+    self.smoothed += (1.0 - self.smoothing) * spectrum
+    return self.smoothed
+
+# Polyphonic pitch engine ported from the web view's mic pipeline (see
+# createMicInput() in web/js/mic-input.js): every hop, a long FFT (fine
+# resolution for the lows) and a short FFT (fast response for the highs) go
+# through the same adaptive makeup gain and DSP stack (drum cut, phon weight,
+# gate, whiten, overtone cut, peak focus) and are folded onto the 12 pitch
+# classes. The per-bin loops of the JS are vectorized over maps precomputed at
+# construction (bin -> pitch class/note, the overtone cut's harmonic targets).
+#
+# The hop is one animation frame of the web view, so its per-frame constants
+# (analyser and chroma smoothing) carry over unchanged. A pitch class is reported
+# while its share of the (more lightly smoothed) chroma is above NOTE_ON_SHARE
+# (with hysteresis), in the octave of its lowest strong partial, so chords come
+# out as several notes.
+#
+# Besides the notes, pc_energy (energy per pitch class), chroma (smoothed chroma),
+# level (0-1, overall smoothed energy) and bass_pitch_class (the lowest strong
+# pitch class, -1 if none) describe the latest hop; pitch classes are 0 = C.
+class ChromaPitchEngine(PitchEngine):
+  HOP_LENGTH_S = 1.0 / 60.0
+  HARM_FFT_SIZE = 16384 # ~2.9 Hz bins at 48 kHz, separates semitones down to ~G1
+  HARM_SMOOTHING = 0.35
+  FAST_FFT_SIZE = 4096 # ~85ms window, highs stay snappy
+  FAST_SMOOTHING = 0.4
+  # Adaptive makeup gain: at most +20dB, towards the raw spectral total the tuning assumes
+  MAKEUP_MAX = 10.0
+  MAKEUP_TARGET = 1.0
+  # Most spectral peaks the overtone cut treats as fundamentals
+  PEAK_CAP = 80
+  CHROMA_MAX_HZ = 2200.0
+  CHROMA_SMOOTHING = 0.07
+  # The notes follow the chroma pick smoothed per hop by this much (the web
+  # view's CHROMA_SMOOTHING is tuned for a steady chord readout, which would
+  # delay note events by a few hundred ms)
+  NOTE_SMOOTHING = 0.3
+  # Pitch classes need this share of the note chroma to come on and keep NOTE_OFF_SHARE to stay on
+  NOTE_ON_SHARE = 0.15
+  NOTE_OFF_SHARE = 0.1
+  OCTAVE_PICK_SHARE = 0.5
+  # Semitones from a note up to its 3rd, 5th and 6th harmonics (the 2nd and 4th
+  # are the same pitch class), a weaker note this far above a stronger one is
+  # taken to be that note's harmonic
+  HARMONIC_INTERVALS = (19, 28, 31)
+
+  def __init__(
+    self, sample_rate: int, min_note: int, max_note: int, scale: float = 1.0, dsp_preset: str = 'melodic',
+    tuning_hz: float = A4_FREQUENCY_HZ
+  ):
+    if dsp_preset not in DSP_PRESETS:
+      raise ValueError("Unknown DSP preset: " + str(dsp_preset))
+    self.sample_rate = sample_rate
+    self.min_note = min_note
+    self.max_note = max_note
+    self.dsp = dict(DSP_PRESETS[dsp_preset])
+    self.hop_length = max(1, int(round(sample_rate * self.HOP_LENGTH_S)))
+    self.window_length = self.HARM_FFT_SIZE
+    self.hop_s = self.hop_length / sample_rate
+    self.audio_ring = AudioRingBuffer(max(self.window_length, sample_rate), scale=scale)
+    self.hop_cursor = HopCursor(self.audio_ring, self.window_length, self.hop_length)
+    # The analysers start out on silence (like the web view's), so the first hop
+    # is due after hop_length samples rather than a whole long FFT frame
+    self.audio_ring.write(np.zeros(self.window_length - self.hop_length, dtype=np.float32))
+
+    self.bands = [
+      _Band(sample_rate, self.HARM_FFT_SIZE, self.HARM_SMOOTHING, F_LO, SPLIT_HZ),
+      _Band(sample_rate, self.FAST_FFT_SIZE, self.FAST_SMOOTHING, SPLIT_HZ, F_HI),
+    ]
+    # Both bands' guarded magnitudes live in one array (low band first, so its
+    # bins are in ascending frequency), per-band views are sliced out of it
+    offset = 0
+    used = []
+    freqs = []
+    for band in self.bands:
+      band.offset = offset
+      band.used = slice(offset + 1, offset + 1 + band.num_used)
+      used.append(np.arange(band.used.start, band.used.stop))
+      freqs.append(np.arange(band.first_bin, band.last_bin + 1) * band.hz)
+      offset += band.smoothed.size
+    self._mag = np.zeros(offset, dtype=np.float64)
+    self._ema = np.zeros(offset, dtype=np.float64)
+    self._env = np.zeros(offset, dtype=np.float64)
+    self._used = np.concatenate(used)
+    self._used_hz = np.concatenate(freqs)
+
+    # Per used bin: pitch class, nearest note (relative to A4 = tuning_hz),
+    # chroma weight and phon gain
+    semitones = 12.0 * np.log2(self._used_hz / tuning_hz)
+    self._used_pc = ((np.floor(semitones + 0.5).astype(np.int64) % NUM_PITCH_CLASSES) + 9) % NUM_PITCH_CLASSES
+    self._used_note = np.floor(69.0 + semitones + 0.5).astype(np.int64)
+    octave_pos = np.clip(np.log2(self._used_hz / F_LO) / math.log2(F_HI / F_LO), 0.0, 1.0)
+    self._chroma_weight = 1.0 - 0.35 * octave_pos
+    self._chroma_bins = (self._used_hz < self.CHROMA_MAX_HZ)
+    self._phon_gain = np.power(np.clip(a_weight_gain(self._used_hz), 0.06, 1.25), self.dsp['phon'])
+    for band in self.bands:
+      band.whiten_smoother = _ConstantQSmoother(band.first_bin, band.last_bin, 0.5, 8.0)
+      band.focus_smoother = _ConstantQSmoother(band.first_bin, band.last_bin, 0.06, 4.0)
+    self._build_overtone_targets()
+
+    # Adaptive makeup gain trackers
+    self._makeup_env = 0.0
+    self._makeup_noise = 1.0
+    self._makeup_gain = 1.0
+    self._total_agc = 1e-9
+    self._chroma_agc = 1e-6
+    self._note_chroma = np.zeros(NUM_PITCH_CLASSES, dtype=np.float64)
+    self._note_agc = 1e-6
+    self._chroma_raw = np.zeros(NUM_PITCH_CLASSES, dtype=np.float64)
+    self._pc_notes = np.full(NUM_PITCH_CLASSES, -1, dtype=np.int64) # Latest octave of each pitch class
+    self._pc_note_strength = np.zeros(NUM_PITCH_CLASSES, dtype=np.float64) # Of its partial in the latest hop
+    self._active_pcs = np.zeros(NUM_PITCH_CLASSES, dtype=bool)
+    self._empty_notes = np.array([], dtype=np.int64)
+    self.pc_energy = np.zeros(NUM_PITCH_CLASSES, dtype=np.float64)
+    self.chroma = np.zeros(NUM_PITCH_CLASSES, dtype=np.float64)
+    self.level = 0.0
+    self.bass_pitch_class = -1
+
+  # For every used bin (as a candidate fundamental), the bins near its harmonics
+  # 2-12 that the overtone cut attenuates: flattened into one array of targets,
+  # their Gaussian weights and the harmonic's cap factor (k^-0.6), with each bin's
+  # share given by _overtone_start[i]:_overtone_start[i+1]
+  def _build_overtone_targets(self):
+    targets = []
+    weights = []
+    caps = []
+    starts = [0]
+    for f in self._used_hz:
+      for k in range(2, 13):
+        fk = f * k
+        if fk > F_HI:
+          break
+        band = self.bands[0] if fk < SPLIT_HZ else self.bands[1]
+        centre = int(math.floor(fk / band.hz + 0.5))
+        # Tolerance for stretch/inharmonicity, ~0.8% of the harmonic
+        tol = min(max(fk * 0.008 / band.hz, 1.5), 8.0)
+        r = int(math.ceil(tol))
+        for d in range(-r, r + 1):
+          j = centre + d
+          if band.first_bin <= j <= band.last_bin:
+            targets.append(band.offset + 1 + j - band.first_bin)
+            weights.append(math.exp(-d * d / (2.0 * tol * tol)))
+            caps.append(k ** -0.6)
+      starts.append(len(targets))
+    self._overtone_targets = np.array(targets, dtype=np.int64)
+    self._overtone_weights = np.array(weights, dtype=np.float64)
+    self._overtone_caps = np.array(caps, dtype=np.float64)
+    self._overtone_start = np.array(starts, dtype=np.int64)
+
+  def analyse_hops(self, audio_chunks):
+    for chunk in audio_chunks:
+      self.audio_ring.write(chunk)
+    return [self._analyse(window) for window in self.hop_cursor.windows()]
+
+  def _analyse(self, window):
+    mag = self._mag
+    raw_total = 0.0
+    for band in self.bands:
+      frame = window[window.size - band.fft_size:]
+      band_mag = mag[band.offset:band.offset + band.smoothed.size]
+      np.copyto(band_mag, band.analyse(frame))
+      band_mag[band_mag < MAG_FLOOR] = 0.0
+      raw_total += mag[band.used].sum()
+
+    gain = self._update_makeup(raw_total)
+    if gain > 1.001:
+      mag *= gain
+    if any(amount > 0.0 for amount in self.dsp.values()):
+      self._apply_dsp()
+    total = self._fold()
+    self._track_level(total)
+    self.chroma += (self._chroma_raw - self.chroma) * self.CHROMA_SMOOTHING
+    self._chroma_agc = max(self._chroma_agc * 0.995, self.chroma.sum(), 1e-6)
+    self._note_chroma += (self._chroma_raw - self._note_chroma) * self.NOTE_SMOOTHING
+    return self._detect_notes()
+
+  # Makeup gain for quiet sources, only granted to signal standing clear of the
+  # tracked noise floor (so silence is never normalized)
+  def _update_makeup(self, total):
+    dt = self.hop_s
+    self._makeup_env += (total - self._makeup_env) * (1.0 - math.exp(-dt / (0.06 if total > self._makeup_env else 2.0)))
+    self._makeup_noise += (total - self._makeup_noise) * (1.0 - math.exp(-dt / (0.4 if total < self._makeup_noise else 30.0)))
+    g = min(max(self.MAKEUP_TARGET / max(self._makeup_env, 1e-6), 1.0), self.MAKEUP_MAX)
+    snr = self._makeup_env / (3.0 * max(self._makeup_noise, 1e-6))
+    if snr < 1.0:
+      g = 1.0 + (g - 1.0) * snr ** 4
+    self._makeup_gain += (g - self._makeup_gain) * (1.0 - math.exp(-dt / (0.15 if g < self._makeup_gain else 0.6)))
+    return self._makeup_gain
+
+  # The DSP stack, in the web view's order: drum cut (on the raw temporal stats),
+  # phon weight, gate, whiten, overtone cut, peak focus
+  def _apply_dsp(self):
+    dsp = self.dsp
+    mag = self._mag
+    used = self._used
+    m = mag[used]
+
+    # Drum cut: bins jumping far above their own ~300ms average are pulled back towards it
+    ema = self._ema[used]
+    self._ema[used] = ema + (m - ema) * (1.0 - math.exp(-self.hop_s / 0.3))
+    if dsp['drums'] > 0.0:
+      jumped = m > ema * 1.8
+      m[jumped] *= np.power((ema[jumped] * 1.8 + 1e-12) / m[jumped], dsp['drums'])
+
+    if dsp['phon'] > 0.0:
+      m *= self._phon_gain
+
+    peak = m.max()
+    # Soft noise gate, the knee goes from -72dB to -32dB below the frame's peak
+    if dsp['gate'] > 0.0 and peak > 0.0:
+      threshold = peak * 10.0 ** ((-72.0 + 40.0 * dsp['gate']) / 20.0)
+      m2 = m * m
+      m *= m2 / (m2 + threshold * threshold)
+
+    # Whitening: divide by a ~half octave wide envelope, boosting by at most 6x
+    if dsp['whiten'] > 0.0:
+      mag[used] = m
+      env = self._smooth_envelope('whiten_smoother')
+      ref = env.mean() + 1e-12
+      m *= np.minimum(np.power(ref / (env + 0.05 * ref), dsp['whiten']), 6.0)
+    mag[used] = m
+
+    if dsp['overtone'] > 0.0:
+      self._suppress_overtones(peak)
+
+    # Peak focus: contrast against a ~semitone wide local mean
+    if dsp['focus'] > 0.0:
+      env = self._smooth_envelope('focus_smoother')
+      m = mag[used]
+      lit = env > 0.0
+      m[lit] *= np.minimum(np.power(m[lit] / env[lit], dsp['focus'] * 1.5), 4.0)
+      mag[used] = m
+
+  # The constant-Q envelope of every band's used bins, in used bin order
+  def _smooth_envelope(self, smoother_name):
+    for band in self.bands:
+      getattr(band, smoother_name).smooth(self._mag[band.used], self._env[band.used])
+    return self._env[self._used]
+
+  # Local peaks of the used bins (in ascending frequency) above floor
+  def _peaks(self, floor):
+    m = self._mag[self._used]
+    below = self._mag[self._used - 1]
+    above = self._mag[self._used + 1]
+    return np.flatnonzero((m > floor) & (m > below) & (m >= above))
+
+  # Every local peak is a candidate fundamental, in ascending frequency. Energy
+  # near its harmonics is cut by however much of it the fundamental can explain,
+  # so a harmonic that gets cut explains less of its own multiples in turn.
+  # Harmonic windows of the same fundamental that overlap are both applied to
+  # the bin as it was before that fundamental (the JS applies them one at a time).
+  def _suppress_overtones(self, frame_peak):
+    floor = frame_peak * 0.004
+    if floor <= 0.0:
+      return
+    mag = self._mag
+    amount = self.dsp['overtone']
+    for i in self._peaks(floor)[:self.PEAK_CAP]:
+      fundamental = mag[self._used[i]] # May itself have been cut already
+      if fundamental <= 0.0:
+        continue
+      share = slice(self._overtone_start[i], self._overtone_start[i+1])
+      targets = self._overtone_targets[share]
+      harmonics = mag[targets]
+      confidence = np.minimum(fundamental * self._overtone_caps[share] / np.maximum(harmonics, 1e-30), 1.0)
+      np.multiply.at(mag, targets, 1.0 - amount * confidence * self._overtone_weights[share])
+
+  # Folds the used bins onto the pitch classes: pc_energy sums every bin's
+  # magnitude, the chroma pick sums the peaks (below CHROMA_MAX_HZ) and the bass
+  # is the lowest peak. Also notes the octave of each pitch class's strongest peak.
+  # Returns the total magnitude.
+  def _fold(self):
+    m = self._mag[self._used]
+    self.pc_energy[:] = np.bincount(self._used_pc, weights=m, minlength=NUM_PITCH_CLASSES)
+    peaks = self._peaks(PEAK_FLOOR_MAG)
+    self.bass_pitch_class = int(self._used_pc[peaks[0]]) if peaks.size > 0 else -1
+
+    chroma_peaks = peaks[self._chroma_bins[peaks]]
+    contributions = np.sqrt(m[chroma_peaks]) * self._chroma_weight[chroma_peaks]
+    pcs = self._used_pc[chroma_peaks]
+    self._chroma_raw[:] = np.bincount(pcs, weights=contributions, minlength=NUM_PITCH_CLASSES)
+
+    # Each pitch class's note is its lowest partial within OCTAVE_PICK_SHARE of
+    # its strongest one (the overtone cut leaves the fundamental on top, but not
+    # always by much)
+    notes = self._used_note[chroma_peaks]
+    in_range = (notes >= self.min_note) & (notes <= self.max_note)
+    strongest = np.zeros(NUM_PITCH_CLASSES, dtype=np.float64)
+    np.maximum.at(strongest, pcs[in_range], contributions[in_range])
+    picked = in_range & (contributions >= self.OCTAVE_PICK_SHARE * strongest[pcs])
+    # Highest first, so the lowest picked partial is the one that sticks
+    self._pc_notes[pcs[picked][::-1]] = notes[picked][::-1]
+    self._pc_note_strength[:] = 0.0
+    self._pc_note_strength[pcs[picked][::-1]] = contributions[picked][::-1]
+    return float(m.sum())
+
+  # Overall level, against an automatic gain control that decays slowly
+  def _track_level(self, total):
+    self._total_agc = max(self._total_agc * 0.995, total, 1e-9)
+    self.level += (min(total / self._total_agc * 1.1, 1.0) - self.level) * 0.12
+
+  # Same gate as the web view's chord estimate: nothing while the chroma is
+  # quiet relative to its recent peak
+  def _detect_notes(self):
+    total = self._note_chroma.sum()
+    self._note_agc = max(self._note_agc * 0.995, total, 1e-6)
+    if total < 0.15 * self._note_agc or self._note_agc < 1e-3:
+      self._active_pcs[:] = False
+      return self._empty_notes
+    share = self._note_chroma / total
+    self._active_pcs = np.where(self._active_pcs, share >= self.NOTE_OFF_SHARE, share >= self.NOTE_ON_SHARE)
+    notes = np.unique(self._pc_notes[self._active_pcs & (self._pc_notes >= 0)])
+    if notes.size == 0:
+      return self._empty_notes
+    kept = []
+    for note in notes.tolist():
+      strength = self._pc_note_strength[note % NUM_PITCH_CLASSES]
+      if not any(note - lower in self.HARMONIC_INTERVALS and strength < self._pc_note_strength[lower % NUM_PITCH_CLASSES]
+                 for lower in kept):
+        kept.append(note)
+    return np.array(kept, dtype=np.int64)
@@ -1,6 +1,4 @@
 import numpy as np
-from colormath.color_objects import sRGBColor, LCHuvColor
-from colormath.color_conversions import convert_color
 
 _GAMMA_LOOKUP = [
      0,   0,   0,   0,   0,   0,   0,   0,   0,   0,   0,   0,   0,   0,   0,   0,
@@ -21,14 +19,101 @@ _GAMMA_LOOKUP = [
    216, 219, 221, 224, 226, 229, 231, 234, 237, 239, 242, 244, 247, 250, 252, 255,
 ]
 
+# _GAMMA_LOOKUP[i] is int(pow(i/255, GAMMA)*255 + 0.5)
+GAMMA = 2.7
+
 def gamma(value: int):
   return _GAMMA_LOOKUP[value]
 
-def rgb_to_lch(rgb):
-  return np.array(convert_color(sRGBColor(*rgb), LCHuvColor).get_value_tuple(), dtype=np.float32)
+# Output stage that turns a (num_leds, 3) frame of RGB values in [0,1] into the
+# 8-bit values sent to the LEDs. Gamma correction and the global brightness are
+# applied together with a single lookup table over the whole frame.
+#
+# Without dithering the values are exactly what the NeoPixel driver used to send,
+# int(gamma(round(value*255)) * brightness). A dimmed gamma curve only has a
+# handful of 8-bit steps at the low end though, so slow fades visibly band. With
+# dithering the lookup table holds the ideal gamma corrected value in 8.8 fixed
+# point instead, and every LED channel carries the fraction it couldn't show over
+# to the next frame (first order sigma-delta), so over a few frames the LED
+# averages out to the in-between level.
+class GammaOutputStage(object):
+  # Number of input levels of the dithered lookup table
+  DITHER_LUT_SIZE = 4096
+
+  def __init__(self, num_leds: int, brightness: float = 1.0, dither: bool = False):
+    assert 0.0 <= brightness <= 1.0
+    self.num_leds = num_leds
+    self.brightness = brightness
+    self.dither = dither
+    self.output = np.zeros((num_leds, 3), dtype=np.uint8)
+    self._scaled = np.zeros((num_leds, 3), dtype=np.float32)
+    self._indices = np.zeros((num_leds, 3), dtype=np.intp)
+    if dither:
+      self._lut_scale = self.DITHER_LUT_SIZE - 1
+      levels = np.linspace(0.0, 1.0, self.DITHER_LUT_SIZE)
+      # At most 255*256, so adding a carried fraction (< 256) can't overflow 16 bits
+      self._lut = np.floor(np.power(levels, GAMMA) * (255.0 * 256.0) * brightness).astype(np.uint16)
+      self._fixed = np.zeros((num_leds, 3), dtype=np.uint16)
+      # Starting every channel at a different fraction keeps LEDs showing the same
+      # level from flickering in lockstep
+      self._carry = np.random.default_rng(0).integers(0, 256, (num_leds, 3)).astype(np.uint16)
+    else:
+      self._lut_scale = 255
+      self._lut = (np.array(_GAMMA_LOOKUP, dtype=np.float64) * brightness).astype(np.uint8)
+
+  # Returns the 8-bit frame (reused between calls) for the given frame
+  def process(self, frame: np.ndarray):
+    np.multiply(frame, self._lut_scale, out=self._scaled)
+    np.rint(self._scaled, out=self._scaled)
+    self._indices[:] = self._scaled
+    if not self.dither:
+      np.take(self._lut, self._indices, out=self.output)
+      return self.output
+    np.take(self._lut, self._indices, out=self._fixed)
+    self._carry += self._fixed
+    np.right_shift(self._carry, 8, out=self._fixed)
+    self.output[:] = self._fixed
+    self._carry &= 0xFF
+    return self.output
+
+# Closed-form sRGB <-> Oklab conversions (https://bottosson.github.io/posts/oklab/),
+# vectorized over the last axis so whole palettes convert in one call. Oklab is a
+# perceptual colour space: straight line mixes in it keep a steady lightness and
+# hue, where mixing in sRGB darkens and muddies the colours.
+_LINEAR_SRGB_TO_LMS = np.array([
+  [0.4122214708, 0.5363325363, 0.0514459929],
+  [0.2119034982, 0.6806995451, 0.1073969566],
+  [0.0883024619, 0.2817188376, 0.6299787005],
+])
+_LMS_TO_OKLAB = np.array([
+  [0.2104542553,  0.7936177850, -0.0040720468],
+  [1.9779984951, -2.4285922050,  0.4505937099],
+  [0.0259040371,  0.7827717662, -0.8086757660],
+])
+_OKLAB_TO_LMS = np.array([
+  [1.0,  0.3963377774,  0.2158037573],
+  [1.0, -0.1055613458, -0.0638541728],
+  [1.0, -0.0894841775, -1.2914855480],
+])
+_LMS_TO_LINEAR_SRGB = np.array([
+  [ 4.0767416621, -3.3077115913,  0.2309699292],
+  [-1.2684380046,  2.6097574011, -0.3413193965],
+  [-0.0041960863, -0.7034186147,  1.7076147010],
+])
+
+def srgb_to_linear(rgb):
+  rgb = np.asarray(rgb, dtype=np.float64)
+  return np.where(rgb <= 0.04045, rgb / 12.92, np.power((rgb + 0.055) / 1.055, 2.4))
+
+def linear_to_srgb(linear):
+  linear = np.maximum(np.asarray(linear, dtype=np.float64), 0.0)
+  return np.where(linear <= 0.0031308, linear * 12.92, 1.055 * np.power(linear, 1.0 / 2.4) - 0.055)
+
+def srgb_to_oklab(rgb):
+  lms = srgb_to_linear(rgb) @ _LINEAR_SRGB_TO_LMS.T
+  return np.cbrt(lms) @ _LMS_TO_OKLAB.T
 
-def lch_to_rgb(lch):
-  rgb = convert_color(LCHuvColor(*lch), sRGBColor)
-  return np.array([
-    rgb.clamped_rgb_r, rgb.clamped_rgb_g, rgb.clamped_rgb_b
-  ], dtype=np.float32)
+# Colours outside of the sRGB gamut are clamped to [0,1]
+def oklab_to_srgb(lab):
+  lms = np.power(np.asarray(lab, dtype=np.float64) @ _OKLAB_TO_LMS.T, 3)
+  return np.clip(linear_to_srgb(lms @ _LMS_TO_LINEAR_SRGB.T), 0.0, 1.0)
@@ -1,57 +1,273 @@
+import time
+from multiprocessing import Event
+from typing import NamedTuple
 
-from multiprocessing import Queue
+import numpy as np
 
+from NoteUtils import NoteData
+from SharedRingBuffer import SharedRingBuffer
+
+# Events travel from the note detectors (each in its own process) to the Animator
+# as fixed-size binary records, one lock-free shared memory ring per issuer (each
+# issuer is a single producer). The Animator drains every ring in bulk once per
+# frame, and is woken up by a shared flag when it's waiting for events.
+#
+# Backpressure: if an issuer's ring is full, NOTE_ON events are dropped (a missed
+# note on is a missed flash of colour) while every other event (NOTE_OFF and
+# (dis)connects) waits for room - dropping those would leave notes stuck on.
+# Dropped events are counted per issuer. Back-to-back duplicate note events from
+# an issuer (e.g., repeated note ons for a held note) are coalesced into the
+# latest one when they're drained, since handling both would change nothing.
+#
+# Every input (each MIDI port, each mic) is an issuer of its own, registered when
+# the event monitor is made (see make_issuers()). Issuers are numbered in
+# priority order and everything kept per issuer (rings, callbacks, ...) is a list
+# indexed by that number, so finding an event's issuer and its callback costs
+# the same however many issuers there are.
 class EventMonitor(object):
-  
+
+  # The kinds of issuer, also the names of the first issuer of each kind
   EVENT_ISSUER_MIC = "MIC"
   EVENT_ISSUER_MIDI = "MIDI"
-  # Lower value means higher priority
-  ISSUER_PRIORITY = {
-    EVENT_ISSUER_MIDI: 0,
-    EVENT_ISSUER_MIC: 1,
-  }
+  # Names of the default issuers (one MIDI port, one mic) in priority order
+  ISSUERS = [EVENT_ISSUER_MIDI, EVENT_ISSUER_MIC]
+  # Records hold their issuer's number in a uint8
+  MAX_ISSUERS = 256
 
   EVENT_TYPE_CONNECTED = "CONNECTED"
   EVENT_TYPE_DISCONNECTED = "DISCONNECTED"
   EVENT_TYPE_NOTE_ON = "NOTE_ON"
   EVENT_TYPE_NOTE_OFF = "NOTE_OFF"
+  # Records hold the index of their event type in this list
+  EVENT_TYPES = [EVENT_TYPE_CONNECTED, EVENT_TYPE_DISCONNECTED, EVENT_TYPE_NOTE_ON, EVENT_TYPE_NOTE_OFF]
+  NOTE_EVENT_TYPES = {EVENT_TYPE_NOTE_ON, EVENT_TYPE_NOTE_OFF}
+
+  # Note intensity in [0,1] is sent as a MIDI style velocity in [0,127]
+  MAX_VELOCITY = 127
+  EVENT_RECORD_DTYPE = np.dtype([
+    ('issuer', np.uint8),
+    ('type', np.uint8),
+    ('note', np.uint8),
+    ('velocity', np.uint8),
+    ('timestamp', np.float64), # time.monotonic() when the event was captured (see on_event())
+  ], align=True)
+
+  # Events that can be waiting in each issuer's ring
+  EVENT_RING_SIZE = 4096
+  # How long an event that can't be dropped waits for room in a full ring before
+  # it's dropped anyway (i.e., the Animator has stopped draining events). After a
+  # timeout the issuer stops waiting until its ring has room again.
+  BACKPRESSURE_TIMEOUT_S = 1.0
+  BACKPRESSURE_POLL_S = 0.001
+
+  # issuers: the Issuers whose events are monitored, one MIDI port and one mic if None
+  def __init__(self, issuers=None):
+    if issuers is None:
+      issuers = make_issuers(1, 1)
+    if len(issuers) > self.MAX_ISSUERS:
+      raise ValueError("At most %d event issuers are supported" % self.MAX_ISSUERS)
+    # Every issuer in priority order, records hold their issuer's index in this list
+    self.issuers = sorted(issuers, key=lambda issuer: issuer.priority)
+    self.issuer_names = [issuer.name for issuer in self.issuers]
+    self._issuer_codes = {name: code for code, name in enumerate(self.issuer_names)}
+    if len(self._issuer_codes) != len(self.issuers):
+      raise ValueError("Event issuer names must be unique: " + ", ".join(self.issuer_names))
+    self.event_rings = [
+      SharedRingBuffer(self.EVENT_RING_SIZE, dtype=self.EVENT_RECORD_DTYPE) for _ in self.issuers
+    ]
+    # Set by the producers after every write, so a waiting consumer wakes up right away
+    self.events_available = Event()
+    # One record per issuer that is filled in and written by on_event()
+    self._records = [np.zeros(1, dtype=self.EVENT_RECORD_DTYPE) for _ in self.issuers]
+    self._stalled = [False] * len(self.issuers)
+    self._event_type_codes = {event_type: code for code, event_type in enumerate(self.EVENT_TYPES)}
+    self._is_note_event_code = np.array([event_type in self.NOTE_EVENT_TYPES for event_type in self.EVENT_TYPES])
+    self.coalesced_events = 0
+    # Events drained by the latest process_events() and in total
+    self.drained_events = 0
+    self.total_drained_events = 0
+    # Records of the note events handled by the latest process_events(), e.g. to
+    # follow them through to the LEDs (see LatencyStats)
+    self.processed_note_records = np.zeros(0, dtype=self.EVENT_RECORD_DTYPE)
+    # Per issuer number, the callback of each event type (by its index in EVENT_TYPES)
+    self.callbacks = self._no_callbacks()
+
+  def _no_callbacks(self):
+    return [[None] * len(self.EVENT_TYPES) for _ in self.issuers]
 
-  MAX_EVENTS_PER_FRAME = 32
+  # Callbacks are only called by the consumer, so they stay behind when the event
+  # monitor is handed to a producer process
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state['callbacks'] = self._no_callbacks()
+    return state
+
+  def close(self):
+    for ring in self.event_rings:
+      ring.close()
+
+  def issuer_code(self, issuer: str):
+    return self._issuer_codes[issuer]
 
-  def __init__(self):
-    self.event_queue = Queue(maxsize=self.MAX_EVENTS_PER_FRAME*2)
-    self.callbacks = {
-      self.EVENT_ISSUER_MIC: {},
-      self.EVENT_ISSUER_MIDI: {},
-    }
-  
   def set_event_callback(self, issuer, event_type, callback):
-    self.callbacks[issuer][event_type] = callback
-  
-  # Called from the midi and mic note detectors on their respective threads
-  def on_event(self, issuer, event_type, event_data=None):
-    self.event_queue.put_nowait((issuer, event_type, event_data))
+    self.callbacks[self._issuer_codes[issuer]][self._event_type_codes[event_type]] = callback
+
+  # Called from the midi and mic note detectors on their respective threads.
+  # capture_time is the time.monotonic() when the input behind the event was
+  # captured (e.g., the MIDI message was received), now if it's None.
+  # Returns True if the event was sent, False if it was dropped (see the backpressure notes above).
+  def on_event(self, issuer, event_type, event_data: NoteData = None, capture_time: float = None):
+    code = self._issuer_codes[issuer]
+    record = self._records[code]
+    record[0] = self._record_fields(code, event_type, event_data, capture_time)
+    return self._write_record(code, event_type, record)
+
+  # Sends a batch of (event_type, event_data, capture_time) events (see
+  # on_event()) from the issuer with a single ring write and wake-up, e.g. the
+  # MIDI messages that arrived together. A batch that doesn't fit in the ring
+  # is sent one event at a time, so each event gets the usual backpressure.
+  # Returns the number of events that were sent.
+  def on_events(self, issuer, events):
+    num_events = len(events)
+    if num_events == 0:
+      return 0
+    code = self._issuer_codes[issuer]
+    records = np.zeros(num_events, dtype=self.EVENT_RECORD_DTYPE)
+    for i, (event_type, event_data, capture_time) in enumerate(events):
+      records[i] = self._record_fields(code, event_type, event_data, capture_time)
+    ring = self.event_rings[code]
+    if ring.writable() >= num_events and ring.write(records):
+      self._stalled[code] = False
+      self.events_available.set()
+      return num_events
+    return sum(self._write_record(code, event[0], records[i:i+1]) for i, event in enumerate(events))
+
+  def _record_fields(self, code: int, event_type, event_data: NoteData, capture_time: float):
+    note, velocity = 0, 0
+    if event_data is not None:
+      note, velocity = event_data.note, round(event_data.intensity * self.MAX_VELOCITY)
+    if capture_time is None:
+      capture_time = time.monotonic()
+    return (code, self._event_type_codes[event_type], note, velocity, capture_time)
 
-  # Called from the main thread
+  # Writes one event's record for issuer number code, waiting for room if it can't be dropped
+  def _write_record(self, code: int, event_type, record: np.ndarray):
+    ring = self.event_rings[code]
+    if ring.writable() > 0:
+      self._stalled[code] = False
+    elif event_type != self.EVENT_TYPE_NOTE_ON and not self._stalled[code]:
+      deadline = time.monotonic() + self.BACKPRESSURE_TIMEOUT_S
+      while ring.writable() == 0:
+        if time.monotonic() >= deadline:
+          self._stalled[code] = True
+          break
+        self.events_available.set()
+        time.sleep(self.BACKPRESSURE_POLL_S)
+    written = ring.write(record)
+    if written:
+      self.events_available.set()
+    return written
+
+  # Number of events from the issuer waiting to be processed
+  def pending_events(self, issuer):
+    return self.event_rings[self._issuer_codes[issuer]].readable()
+
+  # Number of events from each issuer that were dropped because its ring was full
+  def dropped_events(self):
+    return {issuer: ring.overruns()[0] for issuer, ring in zip(self.issuer_names, self.event_rings)}
+
+  # Prints the dropped and coalesced event counts so far
+  def report(self):
+    dropped = self.dropped_events()
+    print("Events dropped: %s, coalesced: %d" % (
+      ", ".join("%s %d" % (issuer, dropped[issuer]) for issuer in self.issuer_names), self.coalesced_events
+    ))
+
+  # Updates the metrics read from the event rings (see Metrics)
+  def update_metrics(self, metrics):
+    for issuer, ring in zip(self.issuer_names, self.event_rings):
+      metrics.set("chromesthesia_event_queue_depth", ring.readable(), issuer)
+      metrics.set("chromesthesia_events_dropped_total", ring.overruns()[0], issuer)
+
+  def _has_events(self):
+    return any(ring.readable() > 0 for ring in self.event_rings)
+
+  # Called from the main thread: blocks until an event arrives or the timeout (in
+  # seconds, None = forever) expires. Returns True if there are events to process.
+  def wait_for_events(self, timeout=None):
+    if self._has_events():
+      return True
+    self.events_available.wait(timeout)
+    # Anything written after this is flagged again, so it can't be missed by the next wait
+    self.events_available.clear()
+    return self._has_events()
+
+  # Drops note events that are immediately followed by the same event for the same note
+  def _coalesce(self, records):
+    if records.size < 2:
+      return records
+    types = records['type']
+    notes = records['note']
+    repeated = (types[:-1] == types[1:]) & (notes[:-1] == notes[1:]) & self._is_note_event_code[types[:-1]]
+    num_repeated = int(np.count_nonzero(repeated))
+    if num_repeated == 0:
+      return records
+    self.coalesced_events += num_repeated
+    keep = np.ones(records.size, dtype=bool)
+    keep[:-1] = ~repeated
+    return records[keep]
+
+  # Called from the main thread: processes every waiting event, issuers in priority order
   def process_events(self):
-    # Events are sorted by issuer and then by event type
-    events = []
-    while not self.event_queue.empty() and len(events) < self.MAX_EVENTS_PER_FRAME:
-      events.append(self.event_queue.get())
-    events.sort(key=lambda event: self.ISSUER_PRIORITY[event[0]])
-
-    #events = self.event_queue.getAll(blocking=False)
-    for event in events:
-      issuer, event_type, event_data = event
-      if issuer not in self.callbacks:
-        print("Unhandled issuer: ", issuer)
+    processed_note_records = []
+    self.drained_events = 0
+    for code, ring in enumerate(self.event_rings):
+      segments = ring.peek()
+      if len(segments) == 0:
         continue
-      issuer_callbacks = self.callbacks[issuer]
-      if event_type in issuer_callbacks:
-        if event_data is not None:
-          issuer_callbacks[event_type](event_data)
+      # Copy the records out so their space can be handed straight back to the producer
+      records = np.concatenate(segments)
+      ring.release(records.size)
+      self.drained_events += records.size
+      records = self._coalesce(records)
+      processed_note_records.append(records[self._is_note_event_code[records['type']]])
+
+      issuer = self.issuer_names[code]
+      issuer_callbacks = self.callbacks[code]
+      is_note_event_code = self._is_note_event_code
+      for type_code, note, velocity in zip(
+        records['type'].tolist(), records['note'].tolist(), records['velocity'].tolist()
+      ):
+        callback = issuer_callbacks[type_code]
+        if callback is None:
+          print("Unhandled event: ", (issuer, self.EVENT_TYPES[type_code], note))
+          continue
+        if is_note_event_code[type_code]:
+          callback(NoteData(issuers={issuer}, note=note, intensity=velocity / self.MAX_VELOCITY))
         else:
-          issuer_callbacks[event_type]()
-      else:
-        print("Unhandled event: ", event)
+          callback()
+
+    self.total_drained_events += self.drained_events
+    if len(processed_note_records) == 0:
+      self.processed_note_records = self.processed_note_records[:0]
+    else:
+      self.processed_note_records = np.concatenate(processed_note_records)
+
+# An input whose events the event monitor carries: its name (unique, e.g., the
+# label of its metrics), kind (EventMonitor.EVENT_ISSUER_MIDI/EVENT_ISSUER_MIC)
+# and priority (events of lower values are handled first)
+class Issuer(NamedTuple):
+  name: str
+  kind: str
+  priority: int
 
+# The issuers of num_midi MIDI ports and num_mic mics: every MIDI port before
+# every mic, each kind in order. The first of each kind is named after the kind
+# (MIDI, MIC), so one of each is the default setup, the rest are numbered (MIDI2, ...).
+def make_issuers(num_midi: int, num_mic: int):
+  issuers = []
+  for kind, count in [(EventMonitor.EVENT_ISSUER_MIDI, num_midi), (EventMonitor.EVENT_ISSUER_MIC, num_mic)]:
+    for i in range(count):
+      name = kind if i == 0 else "%s%d" % (kind, i + 1)
+      issuers.append(Issuer(name, kind, len(issuers)))
+  return issuers
@@ -0,0 +1,134 @@
+import os
+import struct
+from dataclasses import dataclass
+
+import numpy as np
+
+# One record per frame sent to the LEDs: when it was sent (seconds since the
+# recording started) and the (num_leds, 3) uint8 RGB values
+def recording_dtype(num_leds: int):
+  return np.dtype([('time', '<f8'), ('leds', 'u1', (num_leds, 3))])
+
+# Records the frames sent to the LEDs into a memory-mapped .npy file of
+# recording_dtype records, which np.load() (or load_recording()) reads back.
+#
+# The file grows in chunks and close() writes the final frame count into the
+# header and trims the unused space off the end. Rewriting the header is a
+# syscall, so rather than after every frame (adding it to the render loop being
+# recorded) it's only rewritten every HEADER_FLUSH_FRAMES frames: if the process
+# is killed before close(), the recording is still readable, up to the last flush.
+class FrameRecorder(object):
+  HEADER_LEN = 256 # Fixed (64 byte aligned) so the header can be rewritten in place
+  INITIAL_CAPACITY = 1024
+  HEADER_FLUSH_FRAMES = 256 # A few seconds at the usual frame rates
+
+  def __init__(self, path: str, num_leds: int):
+    self.path = path
+    self.num_leds = num_leds
+    self.dtype = recording_dtype(num_leds)
+    self.num_frames = 0
+    self._file = open(path, 'w+b')
+    self._capacity = 0
+    self._records = None
+    self._grow(self.INITIAL_CAPACITY)
+    self._write_header()
+
+  def _write_header(self):
+    magic = b'\x93NUMPY\x01\x00'
+    header_len = self.HEADER_LEN - len(magic) - 2
+    header = "{'descr': %r, 'fortran_order': False, 'shape': (%d,), }" % (
+      np.lib.format.dtype_to_descr(self.dtype), self.num_frames
+    )
+    assert len(header) < header_len
+    os.pwrite(self._file.fileno(), magic + struct.pack('<H', header_len) + (header.ljust(header_len - 1) + '\n').encode('latin1'), 0)
+
+  def _grow(self, capacity: int):
+    if self._records is not None:
+      self._records.flush()
+    self._file.truncate(self.HEADER_LEN + capacity * self.dtype.itemsize)
+    self._records = np.memmap(self._file, dtype=self.dtype, mode='r+', offset=self.HEADER_LEN, shape=(capacity,))
+    self._capacity = capacity
+
+  def record(self, time_s: float, frame: np.ndarray):
+    if self.num_frames == self._capacity:
+      self._grow(2 * self._capacity)
+    record = self._records[self.num_frames]
+    record['time'] = time_s
+    record['leds'] = frame
+    self.num_frames += 1
+    if self.num_frames % self.HEADER_FLUSH_FRAMES == 0:
+      self._write_header()
+
+  # Makes the recording so far readable (e.g. by load_recording()) before close()
+  def flush(self):
+    if self._records is not None:
+      self._write_header()
+
+  def close(self):
+    if self._records is None:
+      return
+    self._records.flush()
+    self._records = None
+    self._write_header()
+    self._file.truncate(self.HEADER_LEN + self.num_frames * self.dtype.itemsize)
+    self._file.close()
+
+# Returns the (times, frames) of a recording, memory-mapped
+def load_recording(path: str):
+  records = np.load(path, mmap_mode='r')
+  return records['time'], records['leds']
+
+# Time of the first frame with any LED lit (0 if there's none)
+def first_lit_time(times: np.ndarray, frames: np.ndarray):
+  lit = np.flatnonzero(frames.reshape(len(frames), -1).any(axis=1))
+  return float(times[lit[0]]) if lit.size > 0 else 0.0
+
+@dataclass
+class RecordingComparison:
+  frames_compared: int = 0
+  mismatched_frames: int = 0
+  max_difference: int = 0 # Largest difference (in LED levels) of the mismatched frames
+  first_mismatch_time_s: float = None
+
+  @property
+  def matches(self):
+    return self.mismatched_frames == 0
+
+# The LEDs show each frame of a recording until the next one, so every frame of
+# either recording has to match what the other recording showed at the same time,
+# to within tolerance LED levels. time_tolerance_s allows for the frames of the
+# two recordings being sent at slightly different times (e.g., from real time
+# MIDI or audio playback): a frame matches if the other recording showed a
+# matching frame at any point within time_tolerance_s of it.
+#
+# The recordings start when the Animator does, which is a slightly different time
+# relative to the input each run, so with align they are lined up on their first
+# lit frame instead.
+def compare_recordings(path_a: str, path_b: str, tolerance: int = 0, time_tolerance_s: float = 0.0, align: bool = False):
+  times_a, frames_a = load_recording(path_a)
+  times_b, frames_b = load_recording(path_b)
+  if frames_a.shape[1:] != frames_b.shape[1:]:
+    raise ValueError("The recordings are of different numbers of LEDs: %d and %d" % (frames_a.shape[1], frames_b.shape[1]))
+  if align:
+    times_a = times_a - first_lit_time(times_a, frames_a)
+    times_b = times_b - first_lit_time(times_b, frames_b)
+  comparison = RecordingComparison()
+  for times, frames, other_times, other_frames in [
+    (times_a, frames_a, times_b, frames_b), (times_b, frames_b, times_a, frames_a)
+  ]:
+    if len(other_times) == 0:
+      other_times = np.zeros(1)
+      other_frames = np.zeros((1,) + frames.shape[1:], dtype=np.uint8)
+    # Range of the other recording's frames shown within the time tolerance of each frame
+    first = np.maximum(np.searchsorted(other_times, times - time_tolerance_s, side='right') - 1, 0)
+    last = np.maximum(np.searchsorted(other_times, times + time_tolerance_s, side='right') - 1, 0)
+    for i in range(len(times)):
+      other = other_frames[first[i]:last[i] + 1].astype(np.int16)
+      difference = int(np.abs(other - frames[i]).max(axis=(1, 2)).min())
+      comparison.frames_compared += 1
+      if difference > tolerance:
+        comparison.mismatched_frames += 1
+        comparison.max_difference = max(comparison.max_difference, difference)
+        if comparison.first_mismatch_time_s is None or times[i] < comparison.first_mismatch_time_s:
+          comparison.first_mismatch_time_s = float(times[i])
+  return comparison
@@ -0,0 +1,61 @@
+import time
+
+# Paces the Animator's frames at a target frame rate and keeps track of how long
+# frames take. Frames are scheduled one frame period after the previous frame
+# started; a frame whose work takes longer than the frame period is an overrun.
+class FrameScheduler(object):
+  def __init__(self, target_fps: float):
+    assert target_fps > 0.0
+    self.frame_period_s = 1.0 / target_fps
+    self.next_frame_time = time.monotonic()
+    self.frame_start_time = self.next_frame_time
+    self.last_frame_time_s = 0.0
+    self.total_frames = 0
+    self.total_overruns = 0
+    self.reset_interval_stats()
+
+  def reset_interval_stats(self):
+    self.interval_start_time = time.monotonic()
+    self.interval_frames = 0
+    self.interval_overruns = 0
+    self.interval_frame_time_s = 0.0
+    self.interval_max_frame_time_s = 0.0
+
+  # Seconds left until the next frame is due (0 if it's already due)
+  def time_until_next_frame(self):
+    return max(0.0, self.next_frame_time - time.monotonic())
+
+  # How long to wait for events before the next frame: until it's due, or for as
+  # long as it takes an event to arrive (None) when there's nothing to animate
+  def wait_timeout(self, idle: bool):
+    return None if idle else self.time_until_next_frame()
+
+  # Returns the start time of the frame
+  def begin_frame(self):
+    self.frame_start_time = time.monotonic()
+    return self.frame_start_time
+
+  def end_frame(self):
+    now = time.monotonic()
+    frame_time_s = now - self.frame_start_time
+    self.last_frame_time_s = frame_time_s
+    self.total_frames += 1
+    self.interval_frames += 1
+    self.interval_frame_time_s += frame_time_s
+    self.interval_max_frame_time_s = max(self.interval_max_frame_time_s, frame_time_s)
+    if frame_time_s > self.frame_period_s:
+      self.total_overruns += 1
+      self.interval_overruns += 1
+    # Late frames don't try to catch up, the schedule just restarts from now
+    self.next_frame_time = max(self.frame_start_time + self.frame_period_s, now)
+
+  # Prints the frame statistics gathered since the last report and starts a new interval
+  def report(self, label="Animator"):
+    elapsed_s = max(time.monotonic() - self.interval_start_time, 1e-9)
+    mean_frame_time_ms = 1000.0 * self.interval_frame_time_s / max(self.interval_frames, 1)
+    print("%s frames: %d (%.1f fps, target %.1f), frame time mean %.3fms max %.3fms, overruns: %d (total %d)" % (
+      label, self.interval_frames, self.interval_frames / elapsed_s, 1.0 / self.frame_period_s,
+      mean_frame_time_ms, 1000.0 * self.interval_max_frame_time_s,
+      self.interval_overruns, self.total_overruns
+    ))
+    self.reset_interval_stats()
@@ -0,0 +1,239 @@
+import re
+from typing import NamedTuple
+
+import numpy as np
+
+from NoteUtils import CHROMATIC_NOTE_NAMES, NUM_PITCH_CLASSES
+
+# Key aware note spelling, ported from web/js/key-spelling.js so the LED app
+# names notes and chords exactly like the web view. Pitch classes are 0 = C.
+
+MODE_MAJOR = 'major'
+MODE_MINOR = 'minor'
+
+# An estimated key: tonic pitch class (0 = C) and MODE_MAJOR/MODE_MINOR
+class Key(NamedTuple):
+  tonic: int
+  mode: str
+
+  def name(self):
+    return "%s %s" % (spell(self.tonic, self), self.mode)
+
+# Spelling while the key is undecided: the five accidentals are flats (the same
+# names as the note colours, see NoteUtils.CHROMATIC_NOTE_NAMES)
+DEFAULT_SPELLING = tuple(CHROMATIC_NOTE_NAMES)
+
+# Plain directional spellings for chromatic notes (and for whole keys whose
+# diatonic spelling would need double accidentals)
+SHARP_SPELLING = ('C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B')
+FLAT_SPELLING = ('C', 'Db', 'D', 'Eb', 'E', 'F', 'Gb', 'G', 'Ab', 'A', 'Bb', 'B')
+
+LETTERS = ['C', 'D', 'E', 'F', 'G', 'A', 'B']
+_NATURAL_PCS = {'C': 0, 'D': 2, 'E': 4, 'F': 5, 'G': 7, 'A': 9, 'B': 11}
+_MAJOR_STEPS = [0, 2, 4, 5, 7, 9, 11]
+
+# Tonic letter and key signature (sharps > 0, flats < 0) of every major key by
+# tonic pitch class. Pitch class 6 is Gb major, like the default spelling.
+_MAJOR_KEYS = {
+  0: ('C', 0), 7: ('G', 1), 2: ('D', 2), 9: ('A', 3), 4: ('E', 4), 11: ('B', 5),
+  6: ('G', -6), 5: ('F', -1), 10: ('B', -2), 3: ('E', -3), 8: ('A', -4), 1: ('D', -5),
+}
+# Tonic letter of every minor key by tonic pitch class (e.g., Eb minor, not D# minor)
+_MINOR_LETTERS = ['C', 'C', 'D', 'E', 'E', 'F', 'F', 'G', 'G', 'A', 'B', 'B']
+
+_DOUBLE_ACCIDENTAL = re.compile(r'##|bb')
+
+# Signed semitones (-6..6) from a natural letter up to the pitch class
+def _delta_to_pc(letter: str, pc: int):
+  d = (pc - _NATURAL_PCS[letter]) % NUM_PITCH_CLASSES
+  return d - NUM_PITCH_CLASSES if d > 6 else d
+
+def _with_accidentals(letter: str, n: int):
+  return letter + ('#' * n if n > 0 else 'b' * -n)
+
+# Spelling of every pitch class in the major key on tonic_pc: the diatonic
+# degrees walk the letters up from the tonic's, chromatic notes follow the
+# key's direction
+def build_major_table(tonic_pc: int):
+  letter, signature = _MAJOR_KEYS[tonic_pc]
+  first_letter = LETTERS.index(letter)
+  table = [None] * NUM_PITCH_CLASSES
+  for degree, step in enumerate(_MAJOR_STEPS):
+    degree_letter = LETTERS[(first_letter + degree) % len(LETTERS)]
+    degree_pc = (tonic_pc + step) % NUM_PITCH_CLASSES
+    table[degree_pc] = _with_accidentals(degree_letter, _delta_to_pc(degree_letter, degree_pc))
+  chromatic = SHARP_SPELLING if signature >= 0 else FLAT_SPELLING
+  if any(name is not None and _DOUBLE_ACCIDENTAL.search(name) for name in table):
+    return chromatic
+  return tuple(name if name is not None else chromatic[pc] for pc, name in enumerate(table))
+
+# A minor key borrows its relative major's spelling (the natural minor scale),
+# with the raised 7th patched in as a leading tone (D minor's is C#, never Db)
+def _build_minor_table(tonic_pc: int):
+  table = list(build_major_table((tonic_pc + 3) % NUM_PITCH_CLASSES))
+  letter = LETTERS[(LETTERS.index(_MINOR_LETTERS[tonic_pc]) + 6) % len(LETTERS)]
+  leading_tone_pc = (tonic_pc + 11) % NUM_PITCH_CLASSES
+  name = _with_accidentals(letter, _delta_to_pc(letter, leading_tone_pc))
+  # G# minor's F## is left with the borrowed spelling, like build_major_table()
+  if not _DOUBLE_ACCIDENTAL.search(name):
+    table[leading_tone_pc] = name
+  return tuple(table)
+
+# Every key's spelling table, built once
+_KEY_TABLES = {}
+for _tonic in range(NUM_PITCH_CLASSES):
+  _KEY_TABLES[Key(_tonic, MODE_MAJOR)] = build_major_table(_tonic)
+  _KEY_TABLES[Key(_tonic, MODE_MINOR)] = _build_minor_table(_tonic)
+
+# Spelling table (indexed by pitch class) of the key, DEFAULT_SPELLING for None
+def table_for_key(key: Key = None):
+  if key is None:
+    return DEFAULT_SPELLING
+  return _KEY_TABLES[Key(key.tonic % NUM_PITCH_CLASSES, MODE_MINOR if key.mode == MODE_MINOR else MODE_MAJOR)]
+
+# Name of the pitch class (0 = C) in the key (None = undecided)
+def spell(pc: int, key: Key = None):
+  return table_for_key(key)[pc % NUM_PITCH_CLASSES]
+
+# Krumhansl-Schmuckler key profiles, weight of each degree above the tonic
+KS_MAJOR = (6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88)
+KS_MINOR = (6.33, 2.68, 3.52, 5.38, 2.60, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17)
+
+# Every key in the order the JS scores them (ties go to the first)
+KEYS = tuple(Key(tonic, mode) for tonic in range(NUM_PITCH_CLASSES) for mode in (MODE_MAJOR, MODE_MINOR))
+
+def _build_profile_matrix():
+  rows = []
+  for key in KEYS:
+    profile = np.array(KS_MAJOR if key.mode == MODE_MAJOR else KS_MINOR)
+    row = np.roll(profile, key.tonic)
+    row -= row.mean()
+    rows.append(row / np.linalg.norm(row))
+  return np.array(rows)
+
+# Centred, unit length profile of every key (rows in KEYS order): the Pearson
+# correlations of a histogram with all 24 keys are this times the histogram
+# centred and scaled to unit length
+_PROFILE_MATRIX = _build_profile_matrix()
+
+# Time decayed pitch class histogram correlated against the key profiles,
+# ported from createKeyEstimator() in web/js/key-spelling.js. Note-ons deposit
+# weight (add_note_on(), from MIDI and the mic), decay_to() decays it to the
+# current time and estimate_key() gives the key, or None while undecided.
+#
+# Decay is kept as one scale factor on the histogram, so decaying every frame
+# is a multiply, and since scaling a histogram changes neither its correlations
+# nor which pitch classes hold a share of it, the 24 keys are only rescored
+# (one matrix product) after a deposit.
+class KeyEstimator(object):
+  SOURCE_MIDI = 'midi'
+  SOURCE_MIC = 'mic'
+  DEFAULT_HALF_LIFE_MIDI_S = 2.0
+  DEFAULT_HALF_LIFE_MIC_S = 4.0
+  DEFAULT_CONFIDENCE_MARGIN = 0.03
+  # Below this much total weight the key is undecided
+  MIN_TOTAL = 0.5
+  # One chord alone correlates best with SOME key (and that key would then
+  # respell the chord), so a key needs this many pitch classes sounding...
+  MIN_DISTINCT_PCS = 5
+  # ... each with at least this share of the total weight, so the residue of
+  # decayed notes doesn't count as sounding
+  PC_PRESENT_FRACTION = 0.1
+  # The scale factor is folded back into the histogram before it underflows
+  MIN_SCALE = 1e-100
+
+  def __init__(
+    self,
+    half_life_midi_s: float = DEFAULT_HALF_LIFE_MIDI_S,
+    half_life_mic_s: float = DEFAULT_HALF_LIFE_MIC_S,
+    confidence_margin: float = DEFAULT_CONFIDENCE_MARGIN
+  ):
+    self.half_life_midi_s = half_life_midi_s
+    self.half_life_mic_s = half_life_mic_s
+    self.confidence_margin = confidence_margin
+    # The weight of each pitch class (0 = C) is histogram[pc] * scale
+    self.histogram = np.zeros(NUM_PITCH_CLASSES, dtype=np.float64)
+    self.scale = 1.0
+    self.total = 0.0
+    self.last_time = 0.0
+    self.seeded = False
+    # Best key of the histogram's shape and its lead over the runner-up
+    # (None if there's too little evidence), rescored after deposits
+    self.shape_key = None
+    self.shape_lead = 0.0
+    self.shape_scored = True
+
+  def reset(self):
+    self.histogram[:] = 0.0
+    self.scale = 1.0
+    self.total = 0.0
+    self.last_time = 0.0
+    self.seeded = False
+    self.shape_key = None
+    self.shape_lead = 0.0
+    self.shape_scored = True
+
+  def weight(self, pc: int):
+    return self.histogram[pc % NUM_PITCH_CLASSES] * self.scale
+
+  def _deposit(self, pc: int, weight: float):
+    self.histogram[pc] += weight / self.scale
+    self.total += weight
+    self.shape_scored = False
+
+  # MIDI weight: lower notes count more (from 1.0 at A0 down to 0.2 at the
+  # top of the 88 keys), times the velocity (0-1)
+  def add_note_on(self, midi_note: int, velocity: float = 1.0):
+    bass = max(0.2, 1.0 - (midi_note - 21) / 87.0)
+    self._deposit(midi_note % NUM_PITCH_CLASSES, bass * max(velocity, 0.05))
+
+  # Decays the histogram from the last call to now (seconds) with the half-life
+  # of the source (SOURCE_MIDI/SOURCE_MIC), the first call only sets the clock
+  def decay_to(self, now: float, source: str):
+    if not self.seeded:
+      self.seeded = True
+      self.last_time = now
+      return
+    half_life = self.half_life_mic_s if source == KeyEstimator.SOURCE_MIC else self.half_life_midi_s
+    dt = max(now - self.last_time, 0.0)
+    self.last_time = now
+    if dt > 0.0 and half_life > 0.0:
+      factor = 0.5 ** (dt / half_life)
+      self.scale *= factor
+      self.total *= factor
+      if self.scale < KeyEstimator.MIN_SCALE:
+        self.histogram *= self.scale
+        self.scale = 1.0
+
+  def _score_shape(self):
+    self.shape_key = None
+    self.shape_lead = 0.0
+    histogram = self.histogram
+    peak = histogram.max()
+    if peak <= 0.0:
+      return
+    if np.count_nonzero(histogram >= histogram.sum() * KeyEstimator.PC_PRESENT_FRACTION) < KeyEstimator.MIN_DISTINCT_PCS:
+      return
+    centred = histogram / peak
+    centred -= centred.mean()
+    norm = np.linalg.norm(centred)
+    if norm < 1e-12:
+      return
+    scores = _PROFILE_MATRIX @ (centred / norm)
+    best = int(np.argmax(scores))
+    best_score = scores[best]
+    scores[best] = -2.0
+    self.shape_key = KEYS[best]
+    self.shape_lead = best_score - scores.max()
+
+  # The estimated key, or None while undecided (too little or too few pitch
+  # classes of evidence, or no key clearly ahead of the rest)
+  def estimate_key(self):
+    if self.total < KeyEstimator.MIN_TOTAL:
+      return None
+    if not self.shape_scored:
+      self._score_shape()
+      self.shape_scored = True
+    if self.shape_lead < self.confidence_margin:
+      return None
+    return self.shape_key
@@ -0,0 +1,79 @@
+import threading
+
+import numpy as np
+
+# Histograms of how long note events take from being captured (the MIDI message
+# received, the audio that the note was detected in arriving from the mic) to the
+# first LED frame they change being written to the LEDs, one per event issuer.
+# Latencies go into log spaced bins, so adding events never allocates and the
+# percentiles are accurate to within a bin (BINS_PER_DECADE per factor of 10).
+#
+# The writer threads of every LED zone add to the same histograms (and the
+# Animator reads them), so they're only touched under a lock.
+class LatencyStats(object):
+  MIN_LATENCY_S = 1e-4
+  MAX_LATENCY_S = 10.0
+  BINS_PER_DECADE = 50
+  PERCENTILES = [50, 95, 99]
+
+  def __init__(self, issuers):
+    self.issuers = list(issuers)
+    num_decades = np.log10(self.MAX_LATENCY_S / self.MIN_LATENCY_S)
+    self.num_bins = int(round(num_decades * self.BINS_PER_DECADE))
+    # Upper edge of every bin, latencies past the last edge are counted in the last bin
+    self.bin_edges_s = self.MIN_LATENCY_S * np.power(10.0, np.arange(1, self.num_bins + 1) / self.BINS_PER_DECADE)
+    self.counts = np.zeros((len(self.issuers), self.num_bins), dtype=np.int64)
+    self.max_latency_s = np.zeros(len(self.issuers), dtype=np.float64)
+    self._lock = threading.RLock()
+
+  # The lock is left behind when the stats are handed to another process
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    del state['_lock']
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self._lock = threading.RLock()
+
+  # Adds latencies (in seconds) of events, issuer_codes are the events' issuers' indices in issuers
+  def add(self, issuer_codes: np.ndarray, latencies_s: np.ndarray):
+    if latencies_s.size == 0:
+      return
+    bins = np.minimum(np.searchsorted(self.bin_edges_s, latencies_s), self.num_bins - 1)
+    with self._lock:
+      np.add.at(self.counts, (issuer_codes, bins), 1)
+      np.maximum.at(self.max_latency_s, issuer_codes, latencies_s)
+
+  def num_events(self, issuer):
+    with self._lock:
+      return int(self.counts[self.issuers.index(issuer)].sum())
+
+  # The latency (upper edge of its bin, or the max) that percentile % of the
+  # issuer's events took at most, None if there aren't any events
+  def percentile(self, issuer, percentile: float):
+    code = self.issuers.index(issuer)
+    with self._lock:
+      counts = self.counts[code].copy()
+      max_latency_s = float(self.max_latency_s[code])
+    total = counts.sum()
+    if total == 0:
+      return None
+    rank = int(np.searchsorted(np.cumsum(counts), percentile / 100.0 * total))
+    return min(float(self.bin_edges_s[min(rank, self.num_bins - 1)]), max_latency_s)
+
+  # Prints the latency percentiles of every issuer with events so far
+  def report(self):
+    with self._lock:
+      self._report()
+
+  def _report(self):
+    for code, issuer in enumerate(self.issuers):
+      num_events = self.num_events(issuer)
+      if num_events == 0:
+        continue
+      print("Input to LED latency %s: %d events, %s, max %.1fms" % (
+        issuer, num_events,
+        ", ".join("p%d %.1fms" % (p, 1000.0 * self.percentile(issuer, p)) for p in self.PERCENTILES),
+        1000.0 * self.max_latency_s[code]
+      ))
@@ -0,0 +1,78 @@
+import numpy as np
+
+from AnimationEngine import AnimationEngine
+from NoteUtils import NUM_PITCH_CLASSES
+
+# How the animated notes are laid out along the LED strip
+LED_MAPPING_FILL = "fill"               # Every LED shows the blended colour of all notes
+LED_MAPPING_PITCH_CLASS = "pitch-class" # The strip is split into 12 segments, C to B
+LED_MAPPING_KEYBOARD = "keyboard"       # The strip is laid out like an 88 key piano, A0 to C8
+LED_MAPPINGS = [LED_MAPPING_FILL, LED_MAPPING_PITCH_CLASS, LED_MAPPING_KEYBOARD]
+
+PIANO_LOWEST_NOTE = 21  # A0
+PIANO_HIGHEST_NOTE = 108 # C8
+
+# Renders the state of an AnimationEngine into a (num_leds, 3) float32 frame buffer
+# of RGB values in [0,1], one row per LED. Every mapping is precomputed as a LED
+# lookup or weight matrix, so a frame costs a few numpy calls however long the strip is.
+class LedFrameRenderer(object):
+  def __init__(self, mapping: str, num_leds: int):
+    if mapping not in LED_MAPPINGS:
+      raise ValueError("Unknown LED mapping: " + str(mapping))
+    assert num_leds > 0
+    self.mapping = mapping
+    self.num_leds = num_leds
+    self.frame = np.zeros((num_leds, 3), dtype=np.float32)
+
+    if mapping == LED_MAPPING_PITCH_CLASS:
+      # Equal segments in chromatic order (strips with fewer than 12 LEDs skip some pitch classes)
+      self.led_pitch_classes = (np.arange(num_leds) * NUM_PITCH_CLASSES) // num_leds
+      self._pitch_class_colours = np.zeros((NUM_PITCH_CLASSES, 3), dtype=np.float32)
+    elif mapping == LED_MAPPING_KEYBOARD:
+      self.key_weights = self._keyboard_weights(num_leds)
+      self._key_colours = np.zeros((self.key_weights.shape[1], 3), dtype=np.float32)
+
+  # Weight of every piano key (columns) on every LED (rows): the fraction of the LED's
+  # stretch of the keyboard covered by the key, relative to the smaller of the two.
+  # So on a dense strip each key lights its own run of LEDs at full brightness and on
+  # a sparse strip each LED shows the keys it covers (split across neighbouring LEDs).
+  @staticmethod
+  def _keyboard_weights(num_leds: int):
+    num_keys = PIANO_HIGHEST_NOTE - PIANO_LOWEST_NOTE + 1
+    keys_per_led = num_keys / num_leds
+    led_start = np.arange(num_leds)[:, None] * keys_per_led
+    key_start = np.arange(num_keys)[None, :]
+    overlap = np.minimum(led_start + keys_per_led, key_start + 1) - np.maximum(led_start, key_start)
+    return (np.maximum(overlap, 0.0) / min(keys_per_led, 1.0)).astype(np.float32)
+
+  # Each pitch class shows the colours of its active notes (as set by the engine,
+  # e.g. by AnimationEngine.start()) averaged by their brightness, at the
+  # brightness of its brightest note
+  def _render_pitch_class_colours(self, engine: AnimationEngine):
+    notes = engine.active_notes
+    pitch_classes = notes % NUM_PITCH_CLASSES
+    brightness = np.maximum(engine.curr_value[notes], 0.0)
+    colour_sums = np.zeros((NUM_PITCH_CLASSES, 3), dtype=np.float64)
+    np.add.at(colour_sums, pitch_classes, engine.colour[notes] * brightness[:, None])
+    total_brightness = np.bincount(pitch_classes, weights=brightness, minlength=NUM_PITCH_CLASSES)
+    scale = np.divide(
+      engine.pitch_class_brightness, total_brightness,
+      out=np.zeros(NUM_PITCH_CLASSES, dtype=np.float64), where=total_brightness > 0.0
+    )
+    np.multiply(colour_sums, scale[:, None], out=self._pitch_class_colours, casting='same_kind')
+
+  # Returns the frame buffer (reused between calls) for the engine's latest update(),
+  # total_colour is the blended colour returned by that update
+  def render(self, engine: AnimationEngine, total_colour: np.ndarray):
+    frame = self.frame
+    if self.mapping == LED_MAPPING_FILL:
+      frame[:] = total_colour
+    elif self.mapping == LED_MAPPING_PITCH_CLASS:
+      self._render_pitch_class_colours(engine)
+      np.take(self._pitch_class_colours, self.led_pitch_classes, axis=0, out=frame)
+    else:
+      keys = slice(PIANO_LOWEST_NOTE, PIANO_HIGHEST_NOTE + 1)
+      np.multiply(engine.colour[keys], engine.curr_value[keys, None], out=self._key_colours, casting='same_kind')
+      np.matmul(self.key_weights, self._key_colours, out=frame)
+      np.minimum(frame, 1.0, out=frame)
+    return frame
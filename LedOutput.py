@@ -0,0 +1,300 @@
+import socket
+import threading
+import time
+
+import numpy as np
+
+from LatencyStats import LatencyStats
+
+# Where the LED frames are sent
+LED_OUTPUT_NEOPIXEL = "neopixel" # NeoPixel strip on the SPI bus
+LED_OUTPUT_NULL = "null"         # Nowhere (keeps the last frame, for testing and benchmarking)
+LED_OUTPUT_DDP = "ddp"           # DDP over UDP, e.g. to WLED, xLights or another receiver on the network
+LED_OUTPUT_SIM = "sim"           # Nowhere, but taking as long as a NeoPixel strip's SPI transfer would
+LED_OUTPUTS = [LED_OUTPUT_NEOPIXEL, LED_OUTPUT_NULL, LED_OUTPUT_DDP, LED_OUTPUT_SIM]
+
+DDP_PORT = 4048
+
+# Interface of the LED output backends: write() takes a (num_leds, 3) uint8 RGB
+# frame and doesn't return until it's been sent.
+class LedOutput(object):
+  def write(self, frame: np.ndarray):
+    raise NotImplementedError
+
+  def close(self):
+    pass
+
+def create_led_output(output: str, num_leds: int, ddp_host: str = None, ddp_port: int = DDP_PORT, spi_bus: int = 0):
+  if output == LED_OUTPUT_NEOPIXEL:
+    return NeoPixelSpiOutput(num_leds, spi_bus)
+  elif output == LED_OUTPUT_NULL:
+    return NullOutput(num_leds)
+  elif output == LED_OUTPUT_SIM:
+    return NullOutput(num_leds, NullOutput.neopixel_write_time_s(num_leds))
+  elif output == LED_OUTPUT_DDP:
+    if not ddp_host:
+      raise ValueError("The DDP output needs a host to send to")
+    return DdpOutput(num_leds, ddp_host, ddp_port)
+  raise ValueError("Unknown LED output: " + str(output))
+
+# Encodes LED bytes the way NeoPixel_SPI sends them: every bit of every byte
+# (MSB first) becomes a whole SPI byte, bit1 for a 1 and bit0 for a 0.
+def neopixel_spi_encode(led_bytes: np.ndarray, bit0: int, bit1: int, out: np.ndarray = None):
+  bits = np.unpackbits(np.ascontiguousarray(led_bytes, dtype=np.uint8).reshape(-1))
+  if out is None:
+    out = np.empty(bits.size, dtype=np.uint8)
+  out[:] = bit0
+  out[bits.astype(bool)] = bit1
+  return out
+
+# NeoPixel strip on the SPI bus that's written a whole frame at a time.
+#
+# NeoPixel_SPI (through adafruit_pixelbuf) sets pixels one at a time and turns each
+# bit into an SPI byte in a Python loop, which costs milliseconds per show() on a
+# Pi with a few hundred LEDs. Here the frame goes straight into the driver's pixel
+# buffer and is encoded for the SPI bus with numpy, then sent in one SPI write.
+# That reaches into attributes the driver doesn't make public (FAST_PATH_ATTRIBUTES),
+# so if a driver version doesn't have them all the frames go through its public
+# API (setting the pixels and show()) instead, slower but still right.
+#
+# spi_bus picks the board's SPI bus the strip's data line is on: 0 is the
+# default bus (board.SPI()), N the bus on the SCK_N/MOSI_N pins (e.g. SPI1 on a
+# Pi with dtoverlay=spi1-1cs). NeoPixels have no chip select, so every strip
+# needs a bus of its own.
+#
+# pixels is the driver's NeoPixel_SPI, made here if None.
+class NeoPixelSpiOutput(LedOutput):
+  FAST_PATH_ATTRIBUTES = ("_byteorder", "_post_brightness_buffer", "_bit0", "_bit1", "_spi", "_reset")
+
+  def __init__(self, num_leds: int, spi_bus: int = 0, pixels=None):
+    self.num_leds = num_leds
+    self.spi_bus = spi_bus
+    if pixels is None:
+      import board
+      import neopixel_spi as neopixel
+      pixels = neopixel.NeoPixel_SPI(
+        self._open_spi(board, spi_bus),
+        num_leds,
+        bpp=3,
+        # The brightness is applied by the output stage (see ColourUtils.GammaOutputStage)
+        brightness=1.0,
+        pixel_order=neopixel.RGB,
+        auto_write=False,
+      )
+    self.pixels = pixels
+    self.fast_path = self._has_fast_path(pixels, num_leds)
+    if not self.fast_path:
+      print("NeoPixel driver internals not as expected, writing the LEDs through its (slower) public API")
+    self._led_bytes = np.zeros((num_leds, 3), dtype=np.uint8)
+    if self.fast_path:
+      # Position of the R, G and B bytes of each pixel in the driver's buffer
+      self._channel_order = list(pixels._byteorder[:3])
+      self._spi_bytes = np.zeros(num_leds * 3 * 8, dtype=np.uint8)
+    self.write(self._led_bytes)
+
+  # Whether the driver has the internals the fast path writes to, as it expects them
+  @staticmethod
+  def _has_fast_path(pixels, num_leds: int):
+    if not all(hasattr(pixels, name) for name in NeoPixelSpiOutput.FAST_PATH_ATTRIBUTES):
+      return False
+    try:
+      return (
+        sorted(pixels._byteorder[:3]) == [0, 1, 2]
+        and len(pixels._post_brightness_buffer) == num_leds * 3
+        and isinstance(pixels._bit0, int) and isinstance(pixels._bit1, int)
+        and isinstance(pixels._reset, (bytes, bytearray))
+      )
+    except TypeError:
+      return False
+
+  @staticmethod
+  def _open_spi(board, spi_bus: int):
+    if spi_bus == 0:
+      return board.SPI()
+    clock = getattr(board, "SCK_%d" % spi_bus, None)
+    mosi = getattr(board, "MOSI_%d" % spi_bus, None)
+    if clock is None or mosi is None:
+      raise ValueError("The board has no SPI bus %d (is it enabled?)" % spi_bus)
+    import busio
+    return busio.SPI(clock, MOSI=mosi)
+
+  # Writes a (num_leds, 3) uint8 RGB frame to the strip
+  def write(self, frame: np.ndarray):
+    if not self.fast_path:
+      self.pixels[:] = [tuple(rgb) for rgb in np.asarray(frame, dtype=np.uint8).tolist()]
+      self.pixels.show()
+      return
+    led_bytes = self._led_bytes
+    led_bytes[:, self._channel_order] = frame
+    pixels = self.pixels
+    pixels._post_brightness_buffer[:] = led_bytes.tobytes()
+    neopixel_spi_encode(led_bytes, pixels._bit0, pixels._bit1, out=self._spi_bytes)
+    with pixels._spi as spi:
+      spi.write(pixels._reset + self._spi_bytes.tobytes() + pixels._reset)
+
+  def close(self):
+    self.write(np.zeros((self.num_leds, 3), dtype=np.uint8))
+
+# Simulated sink: keeps a copy of the last frame and counts the frames written.
+# write_time_s makes every write take that long, to stand in for a slow bus.
+class NullOutput(LedOutput):
+  # A NeoPixel takes 24 bits at 800kHz, then the strip latches the frame after a reset gap
+  NEOPIXEL_LED_TIME_S = 24 / 800000.0
+  NEOPIXEL_RESET_TIME_S = 300e-6
+
+  def __init__(self, num_leds: int, write_time_s: float = 0.0):
+    self.num_leds = num_leds
+    self.write_time_s = write_time_s
+    self.last_frame = np.zeros((num_leds, 3), dtype=np.uint8)
+    self.frames_written = 0
+
+  def write(self, frame: np.ndarray):
+    if self.write_time_s > 0.0:
+      time.sleep(self.write_time_s)
+    self.last_frame[:] = frame
+    self.frames_written += 1
+
+  # How long writing a frame to a NeoPixel strip of num_leds takes on the SPI bus
+  @staticmethod
+  def neopixel_write_time_s(num_leds: int):
+    return num_leds * NullOutput.NEOPIXEL_LED_TIME_S + NullOutput.NEOPIXEL_RESET_TIME_S
+
+# Distributed Display Protocol (http://www.3waylabs.com/ddp/) over UDP. Each frame
+# is sent as RGB data packets of at most DDP_MAX_DATA_LEN bytes, the last one
+# flagged with push so the receiver shows the whole frame at once.
+class DdpOutput(LedOutput):
+  DDP_HEADER_LEN = 10
+  DDP_MAX_DATA_LEN = 480 * 3 # A whole number of pixels that fits in a standard MTU
+  DDP_FLAGS_VERSION_1 = 0x40
+  DDP_FLAGS_PUSH = 0x01
+  DDP_DATA_TYPE_RGB8 = 0x0B # RGB, 8 bits per channel
+  DDP_ID_DISPLAY = 0x01
+
+  def __init__(self, num_leds: int, host: str, port: int = DDP_PORT):
+    self.num_leds = num_leds
+    self.address = (host, port)
+    self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    self.sequence = 0
+    data_len = num_leds * 3
+    self._packet_offsets = list(range(0, data_len, self.DDP_MAX_DATA_LEN))
+    # Reused packet buffers, only the sequence number and the data change between frames
+    self._packets = []
+    for offset in self._packet_offsets:
+      length = min(self.DDP_MAX_DATA_LEN, data_len - offset)
+      packet = bytearray(self.DDP_HEADER_LEN + length)
+      packet[0] = self.DDP_FLAGS_VERSION_1
+      packet[2] = self.DDP_DATA_TYPE_RGB8
+      packet[3] = self.DDP_ID_DISPLAY
+      packet[4:8] = offset.to_bytes(4, 'big')
+      packet[8:10] = length.to_bytes(2, 'big')
+      self._packets.append(packet)
+    self._packets[-1][0] |= self.DDP_FLAGS_PUSH
+
+  def write(self, frame: np.ndarray):
+    # Sequence numbers 1-15, 0 means the receiver shouldn't check them
+    self.sequence = self.sequence % 15 + 1
+    data = np.ascontiguousarray(frame, dtype=np.uint8).tobytes()
+    for offset, packet in zip(self._packet_offsets, self._packets):
+      packet[1] = self.sequence
+      packet[self.DDP_HEADER_LEN:] = data[offset:offset + len(packet) - self.DDP_HEADER_LEN]
+      self.socket.sendto(packet, self.address)
+
+  def close(self):
+    self.write(np.zeros((self.num_leds, 3), dtype=np.uint8))
+    self.socket.close()
+
+# Sends the frames to an LedOutput from a dedicated thread, so the time the
+# output takes (e.g., an SPI transfer) doesn't add to the Animator's frame time.
+# Only the latest frame is kept: if the output is slower than the frame rate the
+# frames in between are skipped instead of queueing up, and frames that are the
+# same as the last one sent aren't sent again.
+#
+# With latency_stats, the capture times of the events behind each frame are
+# followed through to when the frame has been written (see LatencyStats).
+#
+# Each writer has its own thread, so the writers of several outputs (see
+# LedZones) send their frames in parallel. name tells them apart in report().
+class AsyncLedWriter(object):
+  def __init__(self, output: LedOutput, num_leds: int, latency_stats: LatencyStats = None, name: str = None):
+    self.output = output
+    self.name = name
+    self.latency_stats = latency_stats
+    self._condition = threading.Condition()
+    self._pending = np.zeros((num_leds, 3), dtype=np.uint8)
+    self._has_pending = False
+    # Event records (see EventMonitor.EVENT_RECORD_DTYPE) waiting for a frame to be written
+    self._pending_event_records = []
+    self._closed = False
+    # Only touched by the writer thread
+    self._sending = np.zeros((num_leds, 3), dtype=np.uint8)
+    self._last_sent = None
+    self.frames_submitted = 0
+    self.frames_written = 0
+    self.frames_skipped = 0   # Replaced by a newer frame before they could be sent
+    self.frames_unchanged = 0 # Same as the last frame sent
+    self.write_time_s = 0.0
+    thread_name = "AsyncLedWriter" if name is None else "AsyncLedWriter-" + name
+    self._thread = threading.Thread(target=self._run, name=thread_name, daemon=True)
+    self._thread.start()
+
+  # Hands a (num_leds, 3) uint8 frame to the writer thread (the frame is copied), never blocks on the output.
+  # event_records are the records of the events that changed the frame.
+  def submit(self, frame: np.ndarray, event_records: np.ndarray = None):
+    with self._condition:
+      if self._has_pending:
+        self.frames_skipped += 1
+      self._pending[:] = frame
+      self._has_pending = True
+      if self.latency_stats is not None and event_records is not None and event_records.size > 0:
+        self._pending_event_records.append(event_records)
+      self.frames_submitted += 1
+      self._condition.notify()
+
+  def _run(self):
+    while True:
+      with self._condition:
+        while not self._has_pending and not self._closed:
+          self._condition.wait()
+        if not self._has_pending:
+          return
+        self._pending, self._sending = self._sending, self._pending
+        self._has_pending = False
+        event_records = self._pending_event_records
+        self._pending_event_records = []
+      if self._last_sent is not None and np.array_equal(self._sending, self._last_sent):
+        self.frames_unchanged += 1
+        # The events haven't changed the LEDs yet, they carry over to the next frame
+        if len(event_records) > 0:
+          with self._condition:
+            self._pending_event_records[:0] = event_records
+        continue
+      start = time.perf_counter()
+      self.output.write(self._sending)
+      self.write_time_s += time.perf_counter() - start
+      self.frames_written += 1
+      if self.latency_stats is not None and len(event_records) > 0:
+        self._add_latencies(event_records)
+      if self._last_sent is None:
+        self._last_sent = self._sending.copy()
+      else:
+        self._last_sent[:] = self._sending
+
+  # The events behind the frame that was just written have reached the LEDs
+  def _add_latencies(self, event_records):
+    written_time = time.monotonic()
+    event_records = np.concatenate(event_records)
+    self.latency_stats.add(event_records['issuer'], written_time - event_records['timestamp'])
+
+  # Sends any pending frame, stops the writer thread and closes the output
+  def close(self):
+    with self._condition:
+      self._closed = True
+      self._condition.notify()
+    self._thread.join()
+    self.output.close()
+
+  def report(self):
+    mean_write_time_ms = 1000.0 * self.write_time_s / max(self.frames_written, 1)
+    print("LED writer%s frames: %d submitted, %d written (mean write time %.3fms), %d skipped, %d unchanged" % (
+      "" if self.name is None else " (%s)" % self.name, self.frames_submitted, self.frames_written, mean_write_time_ms, self.frames_skipped, self.frames_unchanged
+    ))
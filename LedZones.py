@@ -0,0 +1,158 @@
+import argparse
+import json
+from typing import List, NamedTuple
+
+import numpy as np
+
+from AnimationEngine import AnimationEngine
+from ColourUtils import GammaOutputStage
+from LatencyStats import LatencyStats
+from LedMapping import LED_MAPPINGS, LedFrameRenderer
+from LedOutput import LED_OUTPUTS, LED_OUTPUT_NEOPIXEL, LED_OUTPUT_NULL, LED_OUTPUT_DDP, LED_OUTPUT_SIM, DDP_PORT, AsyncLedWriter, create_led_output
+
+# A strip driven as a zone of its own: its own output, LED count, mapping and
+# brightness. The fields are named like the command line flags they default to.
+class LedZoneConfig(NamedTuple):
+  name: str
+  num_leds: int
+  led_mapping: str
+  brightness: float
+  dither: bool = False
+  output: str = LED_OUTPUT_NEOPIXEL
+  spi_bus: int = 0
+  ddp_host: str = None
+  ddp_port: int = DDP_PORT
+
+# The single zone of the command line flags (used without --led-zones)
+def zone_from_args(args: argparse.Namespace):
+  return LedZoneConfig(
+    "strip", args.num_leds, args.led_mapping, args.brightness, args.dither,
+    args.output, args.spi_bus, args.ddp_host, args.ddp_port
+  )
+
+# Types every field of LedZoneConfig must have (bools aren't taken for numbers)
+_ZONE_FIELD_TYPES = {
+  'name': (str,), 'num_leds': (int,), 'led_mapping': (str,), 'brightness': (int, float), 'dither': (bool,),
+  'output': (str,), 'spi_bus': (int,), 'ddp_host': (str, type(None)), 'ddp_port': (int,),
+}
+
+def _check_field_types(config: LedZoneConfig):
+  for field, types in _ZONE_FIELD_TYPES.items():
+    value = getattr(config, field)
+    if not isinstance(value, types) or (isinstance(value, bool) and bool not in types):
+      raise ValueError("LED zone %s has a %s of the wrong type: %r" % (config.name, field, value))
+
+# Raises ValueError if the zones can't be driven together. With no_hw every zone
+# but the simulated ones goes nowhere (see LedZone.open()), so the checks of
+# where their frames would be sent are skipped.
+def check_zone_configs(configs: List[LedZoneConfig], no_hw: bool = False):
+  if len(configs) == 0:
+    raise ValueError("At least one LED zone is needed")
+  names = set()
+  spi_buses = set()
+  for config in configs:
+    _check_field_types(config)
+    if config.name in names:
+      raise ValueError("LED zone %s is given twice" % config.name)
+    names.add(config.name)
+    if config.num_leds <= 0:
+      raise ValueError("LED zone %s needs a positive number of LEDs" % config.name)
+    if config.led_mapping not in LED_MAPPINGS:
+      raise ValueError("LED zone %s has an unknown LED mapping: %s" % (config.name, config.led_mapping))
+    if not 0.0 <= config.brightness <= 1.0:
+      raise ValueError("LED zone %s needs a brightness in [0,1]" % config.name)
+    if config.output not in LED_OUTPUTS:
+      raise ValueError("LED zone %s has an unknown LED output: %s" % (config.name, config.output))
+    if config.spi_bus < 0:
+      raise ValueError("LED zone %s has a negative SPI bus" % config.name)
+    if not 0 < config.ddp_port < 65536:
+      raise ValueError("LED zone %s has an invalid DDP port: %d" % (config.name, config.ddp_port))
+    if no_hw:
+      continue
+    if config.output == LED_OUTPUT_DDP and not config.ddp_host:
+      raise ValueError("LED zone %s needs a ddp_host to send to" % config.name)
+    if config.output == LED_OUTPUT_NEOPIXEL:
+      # The strips would all show the frames sent on the bus
+      if config.spi_bus in spi_buses:
+        raise ValueError("LED zone %s shares SPI bus %d with another NeoPixel zone" % (config.name, config.spi_bus))
+      spi_buses.add(config.spi_bus)
+
+# Reads the zones from a JSON file holding a list of objects with the fields of
+# LedZoneConfig, e.g. [{"name": "keys", "num_leds": 88, "led_mapping": "keyboard",
+# "spi_bus": 0}, {"name": "wall", "num_leds": 300, "spi_bus": 1}]. Fields that are
+# left out are taken from the command line flags, names from the zone's position.
+def load_zone_configs(path: str, args: argparse.Namespace):
+  with open(path) as f:
+    zones = json.load(f)
+  if not isinstance(zones, list):
+    raise ValueError("The LED zones must be a list of zones")
+  defaults = zone_from_args(args)
+  configs = []
+  for i, zone in enumerate(zones):
+    if not isinstance(zone, dict):
+      raise ValueError("LED zone %d isn't an object" % (i + 1))
+    unknown = set(zone) - set(LedZoneConfig._fields)
+    if unknown:
+      raise ValueError("LED zone %d has unknown fields: %s" % (i + 1, ", ".join(sorted(unknown))))
+    configs.append(defaults._replace(name="zone%d" % (i + 1))._replace(**zone))
+  check_zone_configs(configs, args.no_hw)
+  return configs
+
+# The zones of --led-zones, or the single zone of the command line flags
+def led_zone_configs(args: argparse.Namespace):
+  if getattr(args, "led_zones", None):
+    return load_zone_configs(args.led_zones, args)
+  configs = [zone_from_args(args)]
+  check_zone_configs(configs, args.no_hw)
+  return configs
+
+# The output pipeline of a zone: renders the animated notes with the zone's
+# mapping, runs them through its output stage and hands the LED values that
+# changed to its own AsyncLedWriter. Every zone's writer thread sends its frames
+# in parallel with the others, so the frame time doesn't grow with the number of
+# zones, only the rendering (a few numpy calls per zone) does.
+class LedZone(object):
+  def __init__(self, config: LedZoneConfig):
+    self.config = config
+    self.name = config.name
+    self.num_leds = config.num_leds
+    self.renderer = LedFrameRenderer(config.led_mapping, config.num_leds)
+    # Gamma corrects, dims and (optionally) dithers the frames into the values sent to the LEDs
+    self.output_stage = GammaOutputStage(config.num_leds, config.brightness, dither=config.dither)
+    # Opened by open(), in the process that drives the zone
+    self.writer = None
+    # The values last sent to the LEDs, to tell whether they've changed
+    self.led_values = None
+
+  def open(self, no_hw: bool = False, latency_stats: LatencyStats = None):
+    config = self.config
+    # Simulated strips need no hardware
+    output = LED_OUTPUT_NULL if no_hw and config.output != LED_OUTPUT_SIM else config.output
+    output = create_led_output(
+      output, config.num_leds,
+      ddp_host=config.ddp_host, ddp_port=config.ddp_port, spi_bus=config.spi_bus
+    )
+    self.writer = AsyncLedWriter(output, config.num_leds, latency_stats, name=config.name)
+
+  def close(self):
+    if self.writer is not None:
+      self.writer.close()
+      self.writer = None
+
+  def is_dark(self):
+    return self.led_values is not None and not np.any(self.led_values)
+
+  # Renders the engine's latest update() (total_colour is the colour it returned)
+  # and submits the LED values if they've changed, along with the records of the
+  # events behind them. Returns whether they changed.
+  def update(self, engine: AnimationEngine, total_colour: np.ndarray, event_records: np.ndarray = None):
+    frame = self.renderer.render(engine, total_colour)
+    led_values = self.output_stage.process(frame)
+    if self.led_values is not None and np.array_equal(self.led_values, led_values):
+      return False
+    self.writer.submit(led_values, event_records)
+    if self.led_values is None:
+      self.led_values = led_values.copy()
+    else:
+      self.led_values[:] = led_values
+    return True
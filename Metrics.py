@@ -0,0 +1,147 @@
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from EventMonitor import EventMonitor
+from SharedRingBuffer import _attach_shared_memory
+
+# Every metric: (name, type, help, label name or None). Labelled metrics have a
+# value per event issuer (each MIDI port and mic, see make_issuers() in
+# EventMonitor), so each input's process only writes its own. Counters only ever
+# go up, rate() of a counter in Prometheus gives the per second rate (e.g., of
+# MIDI messages).
+METRICS = [
+  ("chromesthesia_animator_frames_total", "counter", "Frames run by the Animator.", None),
+  ("chromesthesia_animator_frame_overruns_total", "counter", "Frames whose work took longer than the frame period.", None),
+  ("chromesthesia_animator_frame_seconds_total", "counter", "Time spent doing the work of the Animator's frames.", None),
+  ("chromesthesia_animator_frame_seconds", "gauge", "Time the work of the latest frame took.", None),
+  ("chromesthesia_animator_events_total", "counter", "Events drained from the event rings by the Animator.", None),
+  ("chromesthesia_animator_frame_events", "gauge", "Events drained by the latest frame.", None),
+  ("chromesthesia_event_queue_depth", "gauge", "Events waiting in the issuer's event ring.", "issuer"),
+  ("chromesthesia_events_dropped_total", "counter", "Events dropped because the issuer's event ring was full.", "issuer"),
+  ("chromesthesia_events_coalesced_total", "counter", "Repeated note events coalesced into the latest one.", None),
+  ("chromesthesia_led_frames_written_total", "counter", "Frames written to the LEDs.", None),
+  ("chromesthesia_led_frames_skipped_total", "counter", "Frames replaced by a newer frame before they could be written.", None),
+  ("chromesthesia_led_write_seconds_total", "counter", "Time spent writing frames to the LEDs.", None),
+  ("chromesthesia_mic_hops_total", "counter", "Hops of mic audio analysed by the pitch engine.", "issuer"),
+  ("chromesthesia_mic_analysis_seconds_total", "counter", "Time spent analysing mic audio.", "issuer"),
+  ("chromesthesia_mic_hop_analysis_seconds", "gauge", "Analysis time per hop of the latest mic audio analysed.", "issuer"),
+  ("chromesthesia_mic_audio_status_errors_total", "counter", "Audio callbacks flagged with an input overflow/underflow status.", "issuer"),
+  ("chromesthesia_mic_samples_dropped_total", "counter", "Mic samples dropped because the analysis fell behind.", "issuer"),
+  ("chromesthesia_midi_messages_total", "counter", "MIDI messages received.", "issuer"),
+  ("chromesthesia_midi_batches_total", "counter", "Batches of MIDI messages that arrived together, forwarded as one write of events.", "issuer"),
+]
+
+# Counters and gauges of every stage of the app, held in one block of shared
+# memory so that every process can update its own metrics without locks (each
+# value only ever has one writer) and the main process can read them all, e.g.
+# to serve them to Prometheus (see MetricsServer).
+#
+# With shared=False the values are in ordinary memory, for components that run
+# without a metrics endpoint. Instances can be pickled (e.g., passed to another
+# Process), in which case the copy attaches to the same shared memory block.
+class Metrics(object):
+  # issuers: names of the event issuers of the labelled metrics, the default issuers if None
+  def __init__(self, shared: bool = True, issuers=None):
+    self.issuers = list(issuers) if issuers is not None else list(EventMonitor.ISSUERS)
+    self._slots = []
+    for name, _, _, label in METRICS:
+      if label is None:
+        self._slots.append((name, None))
+      else:
+        self._slots += [(name, issuer) for issuer in self.issuers]
+    self._index = {slot: i for i, slot in enumerate(self._slots)}
+    self._owner_pid = os.getpid()
+    self._shm = None
+    if shared:
+      self._shm = shared_memory.SharedMemory(create=True, size=len(self._slots) * np.dtype(np.float64).itemsize)
+      self.values = np.ndarray((len(self._slots),), dtype=np.float64, buffer=self._shm.buf)
+      self.values[:] = 0.0
+    else:
+      self.values = np.zeros(len(self._slots), dtype=np.float64)
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    del state['values']
+    if self._shm is not None:
+      state['_shm'] = self._shm.name
+    else:
+      state['values'] = self.values
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    if self._shm is not None:
+      self._shm = _attach_shared_memory(self._shm)
+      self._owner_pid = None
+      self.values = np.ndarray((len(self._slots),), dtype=np.float64, buffer=self._shm.buf)
+
+  def close(self):
+    if self._shm is None:
+      return
+    self.values = self.values.copy()
+    self._shm.close()
+    if self._owner_pid == os.getpid():
+      self._shm.unlink()
+    self._shm = None
+
+  def inc(self, name: str, amount: float = 1.0, issuer: str = None):
+    self.values[self._index[(name, issuer)]] += amount
+
+  def set(self, name: str, value: float, issuer: str = None):
+    self.values[self._index[(name, issuer)]] = value
+
+  def get(self, name: str, issuer: str = None):
+    return float(self.values[self._index[(name, issuer)]])
+
+  # The metrics in the Prometheus text exposition format
+  def prometheus_text(self):
+    lines = []
+    for name, metric_type, help_text, label in METRICS:
+      lines.append("# HELP %s %s" % (name, help_text))
+      lines.append("# TYPE %s %s" % (name, metric_type))
+      if label is None:
+        lines.append("%s %r" % (name, self.get(name)))
+      else:
+        for issuer in self.issuers:
+          lines.append('%s{%s="%s"} %r' % (name, label, issuer, self.get(name, issuer)))
+    return "\n".join(lines) + "\n"
+
+# Serves the metrics in the Prometheus text format at http://host:port/metrics
+# from a background thread. collect() is called before every scrape, to update
+# the metrics that are read rather than counted (e.g., event queue depths).
+class MetricsServer(object):
+  def __init__(self, metrics: Metrics, host: str, port: int, collect=None):
+    self.metrics = metrics
+    self.collect = collect
+    server = self
+
+    class Handler(BaseHTTPRequestHandler):
+      def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+          self.send_error(404)
+          return
+        if server.collect is not None:
+          server.collect()
+        body = server.metrics.prometheus_text().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+      def log_message(self, format, *args):
+        pass
+
+    self.http_server = ThreadingHTTPServer((host, port), Handler)
+    self.http_server.daemon_threads = True
+    self.port = self.http_server.server_address[1]
+    self._thread = threading.Thread(target=self.http_server.serve_forever, name="MetricsServer", daemon=True)
+    self._thread.start()
+
+  def close(self):
+    self.http_server.shutdown()
+    self.http_server.server_close()
@@ -1,47 +1,82 @@
 import argparse
 import sys
-import math
 import time
 from multiprocessing import Process
-import pyaudio
 import numpy as np
-import librosa
 from EventMonitor import EventMonitor
 
-from ItemStore import ItemStore
-from NoteUtils import NoteData, note_data_from_midi_name
-
-def round_up_to_even(f):
-  return int(math.ceil(f / 2.) * 2)
+from SharedRingBuffer import SharedRingBuffer
+from NoteUtils import NoteData, MIDI_NOTE_NAMES, NUM_MIDI_NOTES
+from Metrics import Metrics
+from MicWorkerPool import PyinWorkerPool
+from PitchEngine import create_pitch_engine, round_up_to_even
 
 class MicNoteDetector(Process):
+  # Seconds of audio that can be waiting for analysis before the audio callback starts dropping it
+  AUDIO_HANDOFF_BUFFER_S = 1.0
+  # How often the analysis loop checks that the stream is still alive while waiting for audio
+  STREAM_CHECK_TIME_S = 0.1
+  # Number of updates per second for gathering frames of audio from the mic
+  # This number needs to be high enough to provide the FFT with enough data
+  # to resolve the frequencies with reasonable latency
+  # >= 4096 seems to be a good choice
+  PREF_UPDATES_PER_SECOND = 4096
 
-  def __init__(self, event_monitor: EventMonitor, args: argparse.Namespace):
+  # issuer: the name of this input's event issuer. device_name: (part of) the
+  # name of the audio input device to listen to, the built-in microphone (or the
+  # default device) if None.
+  def __init__(
+    self,
+    event_monitor: EventMonitor,
+    args: argparse.Namespace,
+    metrics: Metrics = None,
+    issuer: str = EventMonitor.EVENT_ISSUER_MIC,
+    device_name: str = None
+  ):
     super(MicNoteDetector, self).__init__()
     self.event_monitor = event_monitor
+    self.metrics = metrics if metrics is not None else Metrics(shared=False)
     self.args = args
+    self.issuer = issuer
+    self.device_name = device_name
+    # pyaudio is only imported by the mic process, once it looks for a mic (see _init_audio())
+    self.pyaudio = None
     self.audio = None
     self.stream = None
     self.mic_idx = -1
-    # Audio data gathered from the microphone in a separate thread (see the audio_callback() method).
-    # Emptied and gathered in the main thread (see the run() method).
-    self.audio_thread_store = ItemStore()
+    self.pitch_engine = None
+    self.active_notes = {}
+    # Which MIDI note numbers are in active_notes
+    self.active_note_mask = np.zeros(NUM_MIDI_NOTES, dtype=bool)
+    self.reported_overruns = 0
+    # Audio samples gathered from the microphone in a separate thread (see the _audio_callback() method)
+    # and consumed by the analysis loop (see the _start_audio_stream() method). Created once the
+    # stream's sample rate is known.
+    self.audio_handoff = None
+    # time.monotonic() when the latest audio arrived from the mic
+    self.last_audio_time = 0.0
 
   def _close_stream(self):
     if self.stream is not None:
       self.stream.stop_stream()
       self.stream.close()
       self.event_monitor.on_event(
-        EventMonitor.EVENT_ISSUER_MIC,
+        self.issuer,
         EventMonitor.EVENT_TYPE_DISCONNECTED,
       )
     self.stream = None
+    if self.audio_handoff is not None:
+      self.audio_handoff.close()
+    self.audio_handoff = None
 
   def _init_audio(self):
     self._close_stream()
     if self.audio is not None:
       self.audio.terminate()
-    self.audio = pyaudio.PyAudio()
+    if self.pyaudio is None:
+      import pyaudio
+      self.pyaudio = pyaudio
+    self.audio = self.pyaudio.PyAudio()
     self.mic_idx  = -1
 
   def _find_mic(self):
@@ -49,7 +84,12 @@ class MicNoteDetector(Process):
     for i in range(self.audio.get_device_count()):
       device_info = self.audio.get_device_info_by_index(i)
       lc_name = device_info['name'].lower()
-      if 'built-in' in lc_name and 'microphone' in lc_name or \
+      if self.device_name is not None:
+        # Output devices can have matching names too (e.g., a USB interface)
+        if self.device_name.lower() in lc_name and device_info['maxInputChannels'] > 0:
+          mic_idx = i
+          break
+      elif 'built-in' in lc_name and 'microphone' in lc_name or \
         lc_name == 'default':
         mic_idx = i
         break
@@ -57,42 +97,123 @@ class MicNoteDetector(Process):
 
   # NOTE: This function is called in a separate thread by the pyaudio library
   # Make sure to keep it as fast as possible and any cross-thread communication
-  # is done through the audio_thread_store (i.e., kept synchronized with the main thread)
+  # is done through the audio_handoff (a lock-free ring buffer, so this never blocks;
+  # if the analysis falls behind the samples are dropped and counted as overruns)
   def _audio_callback(self, in_data, frame_count, time_info, status):
+    self._receive_audio(in_data, status)
+    return (None, self.pyaudio.paContinue)
+
+  # Hands a buffer of int16 audio (from the mic or a replayed file) to the analysis loop
+  def _receive_audio(self, in_data, status):
     if status:
+      self.metrics.inc("chromesthesia_mic_audio_status_errors_total", issuer=self.issuer)
       print(status, file=sys.stderr)
-    audio_data = np.frombuffer(in_data, dtype=np.int16)
-    self.audio_thread_store.add(audio_data)
-    return (None, pyaudio.paContinue)
+    self.last_audio_time = time.monotonic()
+    self.audio_handoff.write(np.frombuffer(in_data, dtype=np.int16))
+
+  # Diffs the notes detected during the latest hop against the currently active
+  # notes and sends the corresponding note on/off events, capture_time is the
+  # time.monotonic() when the hop's audio arrived
+  def _update_active_notes(self, unique_notes, capture_time: float = None):
+    # Diffs the hop's notes against the active ones as masks over the MIDI
+    # note numbers, so a hop that changes nothing (most of them) is one compare
+    new_mask = np.zeros(NUM_MIDI_NOTES, dtype=bool)
+    new_mask[unique_notes] = True
+    old_mask = self.active_note_mask
+    if np.array_equal(new_mask, old_mask):
+      return
+    self.active_note_mask = new_mask
+
+    # All notes that aren't in the unique_notes list are off now
+    for midi_note in np.flatnonzero(old_mask & ~new_mask).tolist():
+      self.event_monitor.on_event(
+        self.issuer,
+        EventMonitor.EVENT_TYPE_NOTE_OFF,
+        self.active_notes.pop(midi_note),
+        capture_time=capture_time,
+      )
+
+    for midi_note in np.flatnonzero(new_mask & ~old_mask).tolist():
+      note_data = NoteData(
+        issuers={self.issuer},
+        note=midi_note,
+        intensity=1.0,
+      )
+      self.event_monitor.on_event(
+        self.issuer,
+        EventMonitor.EVENT_TYPE_NOTE_ON,
+        note_data,
+        capture_time=capture_time,
+      )
+      self.active_notes[midi_note] = note_data
+
+  @classmethod
+  def _frames_per_buffer(cls, rate):
+    return round_up_to_even(rate / cls.PREF_UPDATES_PER_SECOND)
+
+  def _init_analysis(self, rate):
+    self._close_pitch_engine()
+    if self.args.mic_workers > 0:
+      self.pitch_engine = PyinWorkerPool(rate, self.args.mic_workers, self.args.tuning_hz, self.args.note_hysteresis_cents)
+    else:
+      self.pitch_engine = create_pitch_engine(
+        self.args.pitch_engine, rate, self.args.tuning_hz, self.args.note_hysteresis_cents
+      )
+    self.audio_handoff = SharedRingBuffer(int(rate * self.AUDIO_HANDOFF_BUFFER_S), dtype=np.int16)
+    self.active_notes = {}
+    self.active_note_mask[:] = False
+    self.reported_overruns = 0
+
+  def _update_active_notes_per_hop(self, detected_notes, capture_times):
+    for unique_notes, capture_time in zip(detected_notes, capture_times):
+      self._update_active_notes(unique_notes, capture_time)
+
+  def _close_pitch_engine(self):
+    if self.pitch_engine is not None:
+      self.pitch_engine.close()
+    self.pitch_engine = None
+
+  # Runs the pitch engine over all of the audio waiting in the audio handoff and
+  # sends the resulting note events. Returns the number of hops that were analysed.
+  def _analyse_pending_audio(self):
+    # Read before taking the audio, so it's never later than the arrival of the audio analysed
+    capture_time = self.last_audio_time
+    audio_chunks = self.audio_handoff.peek()
+    if len(audio_chunks) == 0:
+      return 0
+    analysis_start_time = time.perf_counter()
+    # The results can be for audio from earlier calls (see PitchEngine)
+    detected_notes, capture_times = self.pitch_engine.process(audio_chunks, capture_time)
+    analysis_time_s = time.perf_counter() - analysis_start_time
+    self.audio_handoff.release(sum(chunk.size for chunk in audio_chunks))
+
+    # The pitch engine reports the notes for every hop it managed to analyse
+    self._update_active_notes_per_hop(detected_notes, capture_times)
+
+    metrics = self.metrics
+    metrics.inc("chromesthesia_mic_analysis_seconds_total", analysis_time_s, self.issuer)
+    if len(detected_notes) > 0:
+      metrics.inc("chromesthesia_mic_hops_total", len(detected_notes), self.issuer)
+      metrics.set("chromesthesia_mic_hop_analysis_seconds", analysis_time_s / len(detected_notes), self.issuer)
+
+    overrun_writes, overrun_samples = self.audio_handoff.overruns()
+    metrics.set("chromesthesia_mic_samples_dropped_total", overrun_samples, self.issuer)
+    if overrun_writes != self.reported_overruns:
+      print("Mic analysis fell behind, dropped", overrun_samples, "samples so far", file=sys.stderr)
+      self.reported_overruns = overrun_writes
+    return len(detected_notes)
 
   def _start_audio_stream(self):
     device_info = self.audio.get_device_info_by_index(self.mic_idx)
-    print("Microphone/Line-in found:", device_info['name'], ", Sample Rate:", device_info['defaultSampleRate'])
+    print("Microphone/Line-in found:", device_info['name'], ", Sample Rate:", device_info['defaultSampleRate'], "(%s)" % self.issuer)
 
-    FORMAT = pyaudio.paInt16
+    FORMAT = self.pyaudio.paInt16
     CHANNELS = 1
     RATE = int(device_info['defaultSampleRate']) # Hz (samples per second of audio data)
-
-    # Number of updates per second for gathering frames of audio from the mic
-    # This number needs to be high enough to provide the FFT with enough data
-    # to resolve the frequencies with reasonable latency
-    # >= 4096 seems to be a good choice
-    PREF_UPDATES_PER_SECOND = 4096
-
-    # The FFT window should be quite small to resolve the frequencies with reasonable latency
-    # 5 ms seems to be a good choice, anything more seems to miss too many notes
-    PREF_FFT_WINDOW_SIZE_MS = 5
-
-    # Don't touch these
-    FRAMES_PER_BUFFER = round_up_to_even(RATE / PREF_UPDATES_PER_SECOND)
+    FRAMES_PER_BUFFER = self._frames_per_buffer(RATE)
     #DT_PER_FRAME_MS = FRAMES_PER_BUFFER / RATE * 1000 # ms
-    FFT_WINDOW_SIZE = round_up_to_even(RATE * PREF_FFT_WINDOW_SIZE_MS / 1000.0) # Number of samples in the FFT window
-    HALF_FFT_WINDOW_SIZE = FFT_WINDOW_SIZE // 2
-    #FFT_WINDOW_SIZE_MS = FFT_WINDOW_SIZE * 1000 / RATE # ms
-    FFT_MAX_WINDOW_SIZE = 2 * FFT_WINDOW_SIZE # Number of samples in the maximum FFT window
-    NOTE_PROB_THRESHOLD = 0.11
-    #if self.args.no_midi_priority:
-    #  NOTE_PROB_THRESHOLD = 0.5
+
+    self._init_analysis(RATE)
 
     self.stream = self.audio.open(
       format=FORMAT, channels=CHANNELS,
@@ -105,81 +226,100 @@ class MicNoteDetector(Process):
     self.stream.start_stream()
     if self.stream.is_active():
       self.event_monitor.on_event(
-        EventMonitor.EVENT_ISSUER_MIC,
+        self.issuer,
         EventMonitor.EVENT_TYPE_CONNECTED,
       )
 
-    curr_audio_accum = []
-    active_notes = {}
     #avg_rms = 0.0 # TODO: Use RMS to augment the intensity of the notes?
     while self.stream.is_active():
-      curr_audio_accum += self.audio_thread_store.getAll(blocking=True)
-      if len(curr_audio_accum) > FFT_MAX_WINDOW_SIZE:
-        curr_audio_accum = curr_audio_accum[-FFT_MAX_WINDOW_SIZE:]
-      elif len(curr_audio_accum) < FFT_WINDOW_SIZE:
-        continue
-
-      audio_data = np.array(curr_audio_accum, dtype=np.float32).flatten()
-      #audio_data = audio_data * np.hamming(audio_data.size)
-
-      f0, voiced_flag, voiced_probs = librosa.pyin(
-        audio_data,
-        sr=RATE,
-        fmin=librosa.note_to_hz('C2'),
-        fmax=librosa.note_to_hz('C7')
-      )
-
-      # Remove half the window size from the beginning of the audio data to
-      # force a somewhat consistent overlap between the FFT windows
-      curr_audio_accum = curr_audio_accum[-HALF_FFT_WINDOW_SIZE:]
-
-      #rms = np.mean(librosa.feature.rms(y=audio_data))
-
-      masked_note_inds =  (voiced_probs > NOTE_PROB_THRESHOLD) & voiced_flag
-      if np.any(masked_note_inds) > 0:
-        unique_notes = np.unique(librosa.hz_to_note(f0[masked_note_inds], unicode=False))
-
-        # All notes that aren't in the unique_notes list are off now
-        notes_to_remove = []
-        for midi_note_name in active_notes:
-          if midi_note_name not in unique_notes:
-            self.event_monitor.on_event(
-              EventMonitor.EVENT_ISSUER_MIC,
-              EventMonitor.EVENT_TYPE_NOTE_OFF,
-              active_notes[midi_note_name]
-            )
-            notes_to_remove.append(midi_note_name)
-        for midi_note_name in notes_to_remove:
-          del active_notes[midi_note_name]
-
-        for midi_note_name in unique_notes:
-          if midi_note_name not in active_notes:
-            note_name, note_octave = note_data_from_midi_name(midi_note_name)
-            note_data = NoteData(
-              issuers={EventMonitor.EVENT_ISSUER_MIC},
-              note_name=note_name,
-              note_octave=note_octave,
-              intensity=1.0,
-            )
-            self.event_monitor.on_event(
-              EventMonitor.EVENT_ISSUER_MIC,
-              EventMonitor.EVENT_TYPE_NOTE_ON,
-              note_data
-            )
-            active_notes[midi_note_name] = note_data
-      else:
-        # All notes are off now
-        for midi_note_name in active_notes:
-          self.event_monitor.on_event(
-            EventMonitor.EVENT_ISSUER_MIC,
-            EventMonitor.EVENT_TYPE_NOTE_OFF,
-            active_notes[midi_note_name]
-          )
-        active_notes = {}
+      if self.audio_handoff.wait_for_data(timeout=self.STREAM_CHECK_TIME_S):
+        self._analyse_pending_audio()
 
     self._close_stream()
     self.mic_idx = -1
 
+  # Replays an audio file (anything soundfile can read, e.g., WAV/FLAC) through the
+  # exact same hand-off/analysis/event path as the microphone, either paced at
+  # speed x real time or, with a speed of 0, as fast as possible. Prints the
+  # real-time factor, the per-hop analysis time and the detected note timeline,
+  # and returns the timeline: (stream time in seconds, "on"/"off", MIDI note).
+  def _replay_audio_file(self, file_path: str, speed: float):
+    import soundfile
+
+    audio, rate = soundfile.read(file_path, dtype='int16', always_2d=True)
+    # Mix down to mono, like the single channel the mic stream is opened with
+    audio = audio.mean(axis=1).astype(np.int16) if audio.shape[1] > 1 else audio[:, 0].copy()
+    frames_per_buffer = self._frames_per_buffer(rate)
+    duration_s = audio.size / rate
+    print("Replaying audio file:", file_path, ", Sample Rate:", rate, ", Duration:", "%.2fs" % duration_s)
+
+    self._init_analysis(rate)
+    self.event_monitor.on_event(
+      self.issuer,
+      EventMonitor.EVENT_TYPE_CONNECTED,
+    )
+
+    hop_times_s = []
+    note_timeline = []
+    start_time = time.perf_counter()
+    for offset in range(0, audio.size, frames_per_buffer):
+      chunk = audio[offset:offset+frames_per_buffer]
+      stream_time_s = (offset + chunk.size) / rate
+      if speed > 0:
+        sleep_time_s = start_time + stream_time_s / speed - time.perf_counter()
+        if sleep_time_s > 0:
+          time.sleep(sleep_time_s)
+
+      self._receive_audio(chunk.tobytes(), 0)
+      notes_before = set(self.active_notes)
+      analysis_start_time = time.perf_counter()
+      num_hops = self._analyse_pending_audio()
+      if num_hops > 0:
+        analysis_time_s = time.perf_counter() - analysis_start_time
+        hop_times_s += [analysis_time_s / num_hops] * num_hops
+        notes_after = set(self.active_notes)
+        for midi_note in sorted(notes_before - notes_after):
+          note_timeline.append((stream_time_s, "off", midi_note))
+        for midi_note in sorted(notes_after - notes_before):
+          note_timeline.append((stream_time_s, "on", midi_note))
+    # Notes of the audio the pitch engine is still analysing
+    notes_before = set(self.active_notes)
+    detected_notes, capture_times = self.pitch_engine.wait_for_results()
+    self._update_active_notes_per_hop(detected_notes, capture_times)
+    notes_after = set(self.active_notes)
+    for midi_note in sorted(notes_before - notes_after):
+      note_timeline.append((duration_s, "off", midi_note))
+    for midi_note in sorted(notes_after - notes_before):
+      note_timeline.append((duration_s, "on", midi_note))
+    wall_time_s = time.perf_counter() - start_time
+
+    self.event_monitor.on_event(
+      self.issuer,
+      EventMonitor.EVENT_TYPE_DISCONNECTED,
+    )
+    self.audio_handoff.close()
+    self.audio_handoff = None
+
+    hop_times_ms = np.array(hop_times_s) * 1000.0
+    total_analysis_s = float(np.sum(hop_times_s))
+    hop_length_ms = self.pitch_engine.hop_length * 1000.0 / rate
+    print("Mic file replay finished (pitch engine: %s)" % self.args.pitch_engine)
+    print("  Wall time: %.3fs for %.3fs of audio" % (wall_time_s, duration_s))
+    print("  Analysis time: %.3fs, real-time factor: %.4f" % (total_analysis_s, total_analysis_s / max(duration_s, 1e-9)))
+    if hop_times_ms.size > 0:
+      print("  Per-hop analysis (hop = %.1fms, %d hops): mean %.3fms, p50 %.3fms, p95 %.3fms, max %.3fms" % (
+        hop_length_ms, hop_times_ms.size, hop_times_ms.mean(),
+        np.percentile(hop_times_ms, 50), np.percentile(hop_times_ms, 95), hop_times_ms.max()
+      ))
+    print("  Skipped hops:", self.pitch_engine.hop_cursor.skipped_hops)
+    for line in self.pitch_engine.report_lines():
+      print("  " + line)
+    self._close_pitch_engine()
+    print("  Detected notes:")
+    for stream_time_s, event, midi_note in note_timeline:
+      print("    %8.3fs  %-3s  %s" % (stream_time_s, event, MIDI_NOTE_NAMES[midi_note]))
+    return note_timeline
+
   # Main thread - runs forever, constantly trying to find a microphone and
   # start an audio stream from it for note detection.
   def run(self):
@@ -187,6 +327,9 @@ class MicNoteDetector(Process):
     MAX_SLEEP_TIME_S = 16
     find_mic_wait_time_s = INIT_SLEEP_TIME_S
     try:
+      if self.args.mic_file:
+        self._replay_audio_file(self.args.mic_file, self.args.mic_file_speed)
+        return
       self._init_audio()
       while True:
         try:
@@ -206,4 +349,6 @@ class MicNoteDetector(Process):
           self._init_audio()
     except KeyboardInterrupt:
       # For Ctrl+C to work cleanly
-      print("MicNoteDetector terminated. Exiting...")
\ No newline at end of file
+      print("MicNoteDetector terminated. Exiting...")
+    finally:
+      self._close_pitch_engine()
\ No newline at end of file
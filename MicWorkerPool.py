@@ -0,0 +1,189 @@
+import os
+import queue
+import time
+from multiprocessing import Process, Queue, shared_memory
+
+import numpy as np
+
+from NoteUtils import A4_FREQUENCY_HZ
+from PitchEngine import NoteQuantiser, PitchEngine, PyinPitchEngine, RING_BUFFER_S
+from RingBuffer import AudioRingBuffer, HopCursor
+from SharedRingBuffer import _attach_shared_memory
+
+# Runs in each worker process: analyses the windows it's handed (by slot in the
+# shared window buffer) and sends back the voiced pitches detected in them. Analyses a
+# silent window first (pyin's first call compiles librosa's numba code, which can
+# take seconds) and sends None once it's ready. Exits when it's sent None or when
+# the mic process that started it has gone away.
+def _pyin_worker(shm_name: str, num_slots: int, window_length: int, sample_rate: int, tuning_hz: float, tasks: Queue, results: Queue):
+  PARENT_CHECK_TIME_S = 1.0
+  parent_pid = os.getppid()
+  shm = _attach_shared_memory(shm_name)
+  windows = np.ndarray((num_slots, window_length), dtype=np.float32, buffer=shm.buf)
+  engine = PyinPitchEngine(sample_rate, tuning_hz)
+  try:
+    engine.analyse_window(np.zeros(window_length, dtype=np.float32))
+    results.put(None)
+    while True:
+      try:
+        task = tasks.get(timeout=PARENT_CHECK_TIME_S)
+      except queue.Empty:
+        if os.getppid() != parent_pid:
+          break
+        continue
+      if task is None:
+        break
+      seq, slot = task
+      results.put((seq, slot, engine.analyse_window(windows[slot])))
+  except KeyboardInterrupt:
+    pass
+  finally:
+    windows = None
+    shm.close()
+
+# Spreads the pyin analysis of the mic audio over a pool of worker processes, so
+# that a window can take longer to analyse than a hop (e.g., using all four cores
+# of a Raspberry Pi) without the mic falling further and further behind.
+#
+# The windows are copied into slots of a shared memory buffer and only their slot
+# and sequence number go through the task queue, so no audio is pickled. Results
+# come back in whatever order the workers finish and are handed out in window
+# order. Latency stays bounded: there are only SLOTS_PER_WORKER windows per worker
+# in flight (windows that come due while every slot is busy are skipped) and a
+# window whose result takes longer than RESULT_TIMEOUT_S is given up on. A window
+# that was given up on keeps its slot until its late result arrives, since its
+# worker is still reading the slot (and has no room for another window yet).
+#
+# process() returns the results that are ready, which can be for windows from
+# earlier calls, along with the capture times of those windows.
+class PyinWorkerPool(PitchEngine):
+  # Windows in flight per worker: one being analysed and one waiting for it
+  SLOTS_PER_WORKER = 2
+  RESULT_TIMEOUT_S = 1.0
+  STARTUP_TIMEOUT_S = 60.0
+  # Function each worker process runs
+  worker_main = staticmethod(_pyin_worker)
+
+  def __init__(self, sample_rate: int, num_workers: int, tuning_hz: float = A4_FREQUENCY_HZ, hysteresis_cents: float = None):
+    assert num_workers > 0
+    self.sample_rate = sample_rate
+    self.num_workers = num_workers
+    self.window_length = PyinPitchEngine.window_length_for(sample_rate)
+    self.hop_length = PyinPitchEngine.hop_length_for(sample_rate)
+    self.audio_ring = AudioRingBuffer(max(self.window_length, int(sample_rate * RING_BUFFER_S)))
+    self.hop_cursor = HopCursor(self.audio_ring, self.window_length, self.hop_length, max_pending_hops=num_workers)
+
+    self.num_slots = num_workers * self.SLOTS_PER_WORKER
+    self._shm = shared_memory.SharedMemory(create=True, size=self.num_slots * self.window_length * np.dtype(np.float32).itemsize)
+    self._windows = np.ndarray((self.num_slots, self.window_length), dtype=np.float32, buffer=self._shm.buf)
+    self._free_slots = list(range(self.num_slots))
+    self._tasks = Queue()
+    self._results = Queue()
+    self._workers = [
+      Process(
+        target=self.worker_main,
+        args=(self._shm.name, self.num_slots, self.window_length, sample_rate, tuning_hz, self._tasks, self._results),
+        name="PyinWorker-%d" % i,
+        daemon=True,
+      ) for i in range(num_workers)
+    ]
+    for worker in self._workers:
+      worker.start()
+    self._wait_for_workers()
+    # The windows' pitches are quantised here, in window order, since the
+    # quantiser's hysteresis depends on the notes of the window before
+    self.quantiser = NoteQuantiser(tuning_hz, hysteresis_cents)
+
+    self._next_seq = 0
+    self._next_result_seq = 0
+    # seq -> (slot, capture time, submit time) of the windows in flight
+    self._in_flight = {}
+    # seq -> (capture time, pitches) of the windows that finished before an earlier one
+    self._finished = {}
+    # seq -> slot of the windows given up on whose results haven't arrived yet
+    self._late = {}
+    self.skipped_windows = 0 # Came due while every slot was busy
+    self.timed_out_windows = 0
+
+  # Waits for every worker to be warmed up, so the first windows don't time out
+  def _wait_for_workers(self):
+    deadline = time.monotonic() + self.STARTUP_TIMEOUT_S
+    for _ in self._workers:
+      try:
+        self._results.get(timeout=max(0.0, deadline - time.monotonic()))
+      except queue.Empty:
+        self.close()
+        raise RuntimeError("Pyin workers didn't start within %.0fs" % self.STARTUP_TIMEOUT_S)
+
+  def close(self):
+    if self._shm is None:
+      return
+    for _ in self._workers:
+      self._tasks.put(None)
+    for worker in self._workers:
+      worker.join(timeout=self.RESULT_TIMEOUT_S)
+      if worker.is_alive():
+        worker.terminate()
+    self._windows = None
+    self._shm.close()
+    self._shm.unlink()
+    self._shm = None
+
+  def process(self, audio_chunks, capture_time: float = None):
+    for chunk in audio_chunks:
+      self.audio_ring.write(chunk)
+    for audio_data in self.hop_cursor.windows():
+      if len(self._free_slots) == 0:
+        self.skipped_windows += 1
+        continue
+      slot = self._free_slots.pop()
+      self._windows[slot] = audio_data
+      self._in_flight[self._next_seq] = (slot, capture_time, time.monotonic())
+      self._tasks.put((self._next_seq, slot))
+      self._next_seq += 1
+    return self._collect_results(block_until=None)
+
+  # Waits (up to RESULT_TIMEOUT_S) for every window in flight and returns their results
+  def wait_for_results(self):
+    return self._collect_results(block_until=time.monotonic() + self.RESULT_TIMEOUT_S)
+
+  def report_lines(self):
+    return ["Worker pool (%d workers): per-hop times are hand-off times, %d windows skipped (every worker busy), %d timed out" % (
+      self.num_workers, self.skipped_windows, self.timed_out_windows
+    )]
+
+  def _collect_results(self, block_until: float = None):
+    while True:
+      try:
+        if block_until is not None and len(self._in_flight) > 0:
+          seq, slot, f0_hz = self._results.get(timeout=max(0.0, block_until - time.monotonic()))
+        else:
+          seq, slot, f0_hz = self._results.get_nowait()
+      except queue.Empty:
+        break
+      if seq not in self._in_flight:
+        # Timed out already, its worker is done with the slot now
+        self._free_slots.append(self._late.pop(seq))
+        continue
+      _, capture_time, _ = self._in_flight.pop(seq)
+      self._free_slots.append(slot)
+      self._finished[seq] = (capture_time, f0_hz)
+      if block_until is not None and len(self._in_flight) == 0:
+        break
+
+    # Gives up on the oldest windows if their results are overdue
+    now = time.monotonic()
+    while self._next_result_seq in self._in_flight and now - self._in_flight[self._next_result_seq][2] > self.RESULT_TIMEOUT_S:
+      slot, _, _ = self._in_flight.pop(self._next_result_seq)
+      self._late[self._next_result_seq] = slot
+      self.timed_out_windows += 1
+      self._next_result_seq += 1
+
+    results = []
+    capture_times = []
+    while self._next_result_seq in self._finished:
+      capture_time, f0_hz = self._finished.pop(self._next_result_seq)
+      results.append(self.quantiser.quantise(f0_hz))
+      capture_times.append(capture_time)
+      self._next_result_seq += 1
+    return results, capture_times
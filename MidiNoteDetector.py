@@ -1,21 +1,59 @@
 import time
 import argparse
+import collections
+import threading
 from multiprocessing import Process
 
 import mido
-import librosa
 
 from EventMonitor import EventMonitor
-from NoteUtils import NoteData, note_data_from_midi_name
+from NoteUtils import NoteData
+from Metrics import Metrics
 
+# Listens to a MIDI port (or plays a MIDI file) and sends the note events to the
+# EventMonitor. Live messages are delivered by the MIDI backend's callback on its
+# own thread (or, with --midi-input poll, polled for), stamped as they arrive and
+# handed to this process's loop, which forwards every message waiting as one
+# batch of events. The loop only waits for messages until the next port check,
+# so a disconnected device is noticed within MIDI_PORT_CHECK_TIME_S however
+# quiet the keyboard is.
 class MidiNoteDetector(Process):
+  MIDI_INPUT_CALLBACK = "callback"
+  MIDI_INPUT_POLL = "poll"
+  MIDI_INPUT_MODES = [MIDI_INPUT_CALLBACK, MIDI_INPUT_POLL]
+  # How often the MIDI ports are enumerated, to notice the device being unplugged or plugged in
+  MIDI_PORT_CHECK_TIME_S = 1.0
+  # How often the port is polled for messages with MIDI_INPUT_POLL
+  MIDI_POLL_TIME_S = 0.001
+  DEFAULT_PORT_NAME = "USB MIDI Interface"
 
-  def __init__(self, event_monitor: EventMonitor, args: argparse.Namespace):
+  # issuer: the name of this input's event issuer. port_name: (part of) the
+  # name of the MIDI port to listen to, DEFAULT_PORT_NAME if None; of several
+  # ports whose names match, the port_index-th (so two identical keyboards can
+  # each have a detector).
+  def __init__(
+    self,
+    event_monitor: EventMonitor,
+    args: argparse.Namespace,
+    metrics: Metrics = None,
+    issuer: str = EventMonitor.EVENT_ISSUER_MIDI,
+    port_name: str = None,
+    port_index: int = 0
+  ):
     super(MidiNoteDetector, self).__init__()
     self.event_monitor = event_monitor
+    self.metrics = metrics if metrics is not None else Metrics(shared=False)
     self.args = args
+    self.issuer = issuer
+    self.port_name = port_name
+    self.port_index = port_index
     self.midi_port = None
     self.active_notes = {}
+    # (message, time.monotonic() when it was received) waiting to be forwarded,
+    # appended to by the MIDI backend's thread, and set when one arrives. Made
+    # afresh for every port that's opened (see _reset_received_messages()).
+    self.received_messages = None
+    self.messages_received = None
 
   def _clean_up_midi_port(self, disconnected=False):
     if self.midi_port is not None:
@@ -23,7 +61,7 @@ class MidiNoteDetector(Process):
       del self.midi_port
       if disconnected:
         self.event_monitor.on_event(
-          EventMonitor.EVENT_ISSUER_MIDI,
+          self.issuer,
           EventMonitor.EVENT_TYPE_DISCONNECTED,
         )
     self.midi_port = None
@@ -37,101 +75,211 @@ class MidiNoteDetector(Process):
     elif midi.isController():
       print('CONTROLLER', midi.getControllerNumber(), midi.getControllerValue())
 
-  def _update_active_notes(self, midi):
+  # capture_time is the time.monotonic() when the message was received. The
+  # message's note event is added to events if it's given (to be sent with a
+  # batch), otherwise it's sent right away.
+  def _update_active_notes(self, midi, capture_time: float = None, events: list = None):
+    # Every MIDI message comes through here
+    self.metrics.inc("chromesthesia_midi_messages_total", issuer=self.issuer)
     MIN_VELOCITY = 5.0
     SATURATION_VELOCITY = 32.0
 
+    event = None
     if midi.type == 'note_on':
-      midi_note_name = librosa.midi_to_note(midi.note, octave=True, unicode=False)
       if midi.velocity >= MIN_VELOCITY:
-        note_name, note_octave = note_data_from_midi_name(midi_note_name)
-        self.active_notes[midi_note_name] = NoteData(
-          issuers={EventMonitor.EVENT_ISSUER_MIDI},
-          note_name=note_name,
-          note_octave=note_octave,
+        self.active_notes[midi.note] = NoteData(
+          issuers={self.issuer},
+          note=midi.note,
           intensity=1.0#max(0.0, min(1.0, midi.velocity / SATURATION_VELOCITY))
         )
-        self.event_monitor.on_event(
-          EventMonitor.EVENT_ISSUER_MIDI,
-          EventMonitor.EVENT_TYPE_NOTE_ON,
-          self.active_notes[midi_note_name]
-        )
-      else:
-        if midi_note_name in self.active_notes:
-          self.event_monitor.on_event(
-            EventMonitor.EVENT_ISSUER_MIDI,
-            EventMonitor.EVENT_TYPE_NOTE_OFF,
-            self.active_notes[midi_note_name]
-          )
-          self.active_notes.pop(midi_note_name, None)
+        event = (EventMonitor.EVENT_TYPE_NOTE_ON, self.active_notes[midi.note], capture_time)
+      elif midi.note in self.active_notes:
+        event = (EventMonitor.EVENT_TYPE_NOTE_OFF, self.active_notes.pop(midi.note), capture_time)
 
     elif midi.type == 'note_off':
-      midi_note_name = librosa.midi_to_note(midi.note, octave=True, unicode=False)
-      if midi_note_name in self.active_notes:
-        self.event_monitor.on_event(
-          EventMonitor.EVENT_ISSUER_MIDI,
-          EventMonitor.EVENT_TYPE_NOTE_OFF,
-          self.active_notes[midi_note_name]
-        )
-        self.active_notes.pop(midi_note_name, None)
+      if midi.note in self.active_notes:
+        event = (EventMonitor.EVENT_TYPE_NOTE_OFF, self.active_notes.pop(midi.note), capture_time)
+
+    if event is None:
+      return
+    if events is not None:
+      events.append(event)
+    else:
+      self.event_monitor.on_event(self.issuer, *event)
+
+  # Called by the MIDI backend on its own thread for every message of the port
+  def _receive_midi_message(self, msg):
+    self.received_messages.append((msg, time.monotonic()))
+    self.messages_received.set()
+
+  # Waits up to timeout seconds for messages to arrive at the port
+  def _wait_for_messages(self, timeout: float):
+    if self.args.midi_input == self.MIDI_INPUT_POLL:
+      deadline = time.monotonic() + timeout
+      while True:
+        for msg in self.midi_port.iter_pending():
+          self._receive_midi_message(msg)
+        remaining_s = deadline - time.monotonic()
+        if self.received_messages or remaining_s <= 0:
+          return
+        time.sleep(min(self.MIDI_POLL_TIME_S, remaining_s))
+    self.messages_received.wait(max(timeout, 0.0))
+
+  # Sends the events of every message waiting as one batch
+  def _forward_received_messages(self):
+    # Cleared before draining, so a message that arrives meanwhile sets it again
+    self.messages_received.clear()
+    events = []
+    num_messages = 0
+    while self.received_messages:
+      msg, capture_time = self.received_messages.popleft()
+      self._update_active_notes(msg, capture_time, events)
+      num_messages += 1
+    if num_messages > 0:
+      self.metrics.inc("chromesthesia_midi_batches_total", issuer=self.issuer)
+      self.event_monitor.on_events(self.issuer, events)
+
+  def _find_midi_port(self):
+    wanted = (self.port_name if self.port_name is not None else self.DEFAULT_PORT_NAME).lower()
+    matches = [port_name for port_name in mido.get_input_names() if wanted in port_name.lower()]
+    return matches[self.port_index] if self.port_index < len(matches) else None
+
+  def _reset_received_messages(self):
+    self.received_messages = collections.deque()
+    self.messages_received = threading.Event()
+
+  def _open_midi_port(self, port_name: str):
+    self._reset_received_messages()
+    if self.args.midi_input == self.MIDI_INPUT_POLL:
+      self.midi_port = mido.open_input(port_name)
+    else:
+      self.midi_port = mido.open_input(port_name, callback=self._receive_midi_message)
+
+  # Forwards the port's messages until it disappears from the MIDI ports
+  def _listen(self, port_name: str):
+    next_port_check_time = time.monotonic() + self.MIDI_PORT_CHECK_TIME_S
+    while True:
+      self._wait_for_messages(next_port_check_time - time.monotonic())
+      self._forward_received_messages()
+
+      # The RtMidi library doesn't tell us when the device disconnects, so the
+      # port list is checked on a timer of its own
+      if time.monotonic() >= next_port_check_time:
+        if port_name not in mido.get_input_names():
+          print('MIDI port disconnected:', port_name, '(%s)' % self.issuer)
+          return
+        next_port_check_time = time.monotonic() + self.MIDI_PORT_CHECK_TIME_S
+
+  # Streams a standard MIDI file through the same note handling as a live port,
+  # paced at speed x the file's tempo or, with a speed of 0, as fast as possible.
+  # Prints the message/event throughput and how hard the event queue was pushed.
+  def _play_midi_file(self, file_path: str, speed: float):
+    midi_file = mido.MidiFile(file_path)
+    print("Playing MIDI file:", file_path, ", Duration:", "%.2fs" % midi_file.length)
+
+    self.active_notes = {}
+    self.event_monitor.on_event(
+      self.issuer,
+      EventMonitor.EVENT_TYPE_CONNECTED,
+    )
+
+    num_messages = 0
+    num_note_messages = 0
+    max_queue_depth = 0
+    file_time_s = 0.0
+    start_time = time.perf_counter()
+    # Iterating a MidiFile merges its tracks and gives each message's delta time in seconds
+    for msg in midi_file:
+      file_time_s += msg.time
+      if msg.is_meta:
+        continue
+      if speed > 0:
+        sleep_time_s = start_time + file_time_s / speed - time.perf_counter()
+        if sleep_time_s > 0:
+          time.sleep(sleep_time_s)
+
+      num_messages += 1
+      if msg.type == 'note_on' or msg.type == 'note_off':
+        num_note_messages += 1
+      self._update_active_notes(msg)
+      max_queue_depth = max(max_queue_depth, self.event_monitor.pending_events(self.issuer))
+    wall_time_s = time.perf_counter() - start_time
+
+    # Releases any notes that are still held
+    self.event_monitor.on_event(
+      self.issuer,
+      EventMonitor.EVENT_TYPE_DISCONNECTED,
+    )
+
+    print("MIDI file playback finished")
+    print("  Wall time: %.3fs for %.3fs of MIDI (speed: %s)" % (
+      wall_time_s, file_time_s, "unthrottled" if speed <= 0 else "%gx" % speed
+    ))
+    print("  Messages: %d (%d note on/off), %.1f messages/s" % (
+      num_messages, num_note_messages, num_messages / max(wall_time_s, 1e-9)
+    ))
+    print("  Events dropped (event ring full): %d" % self.event_monitor.dropped_events()[self.issuer])
+    print("  Peak event ring depth: %d / %d" % (max_queue_depth, EventMonitor.EVENT_RING_SIZE))
+
+  # Streams a MIDI file through the note handling in simulated time rather than
+  # real time: render_frame(time_s) is called for every frame_period_s of the file,
+  # after the events of the messages before time_s have been sent, and then until
+  # it returns True (the Animator has gone idle) once the file has finished.
+  def render_midi_file(self, file_path: str, frame_period_s: float, render_frame):
+    midi_file = mido.MidiFile(file_path)
+    self.active_notes = {}
+    self.event_monitor.on_event(
+      self.issuer,
+      EventMonitor.EVENT_TYPE_CONNECTED,
+    )
+    num_frames = 0
+    file_time_s = 0.0
+    for msg in midi_file:
+      file_time_s += msg.time
+      if msg.is_meta:
+        continue
+      while num_frames * frame_period_s < file_time_s:
+        render_frame(num_frames * frame_period_s)
+        num_frames += 1
+      self._update_active_notes(msg)
+    # Releases any notes that are still held and lets them fade out
+    self.event_monitor.on_event(
+      self.issuer,
+      EventMonitor.EVENT_TYPE_DISCONNECTED,
+    )
+    while not render_frame(num_frames * frame_period_s):
+      num_frames += 1
 
   def run(self):
-    MIDI_PORT_CHECK_TIME_S = 5.0
-    INIT_SLEEP_TIME_S = 1
-    MAX_SLEEP_TIME_S = 16
+    if self.args.midi_file:
+      try:
+        self._play_midi_file(self.args.midi_file, self.args.midi_file_speed)
+      except KeyboardInterrupt:
+        print("MidiNoteDetector terminated. Exiting...")
+      return
 
     try:
-      midi_ports = []
-      find_midi_wait_time_s = INIT_SLEEP_TIME_S
+      searching = False
       while True:
-        midi_ports = mido.get_input_names()
-        found_port_idx = -1
-        # Find the midi port name that we're looking for
-        for i, port_name in enumerate(midi_ports):
-          if self.args.midi_port_name.lower() in port_name.lower():
-            found_port_idx = i
-            break
-        if found_port_idx == -1:
-          if find_midi_wait_time_s == INIT_SLEEP_TIME_S:
-            print("No MIDI ports found. Sleeping for a bit then retrying...")
-          time.sleep(find_midi_wait_time_s)
-          find_midi_wait_time_s = min(2*find_midi_wait_time_s, MAX_SLEEP_TIME_S)
+        port_name = self._find_midi_port()
+        if port_name is None:
+          if not searching:
+            print("No MIDI ports found. Retrying every %gs..." % self.MIDI_PORT_CHECK_TIME_S)
+            searching = True
+          time.sleep(self.MIDI_PORT_CHECK_TIME_S)
           continue
-        else:
-          find_midi_wait_time_s = INIT_SLEEP_TIME_S
+        searching = False
 
-        port_name = midi_ports[found_port_idx]
-        self.midi_port = mido.open_input(port_name)
-        print('MIDI port found:', port_name)
+        self._open_midi_port(port_name)
+        print('MIDI port found:', port_name, '(%s)' % self.issuer)
+        self.active_notes = {}
         self.event_monitor.on_event(
-          EventMonitor.EVENT_ISSUER_MIDI,
+          self.issuer,
           EventMonitor.EVENT_TYPE_CONNECTED,
         )
-
-        last_time = time.time()
-        last_port_check_time = last_time
+        self._listen(port_name)
+        self._clean_up_midi_port(disconnected=True)
         self.active_notes = {}
-
-        while True:
-          current_time = time.time()
-          msg = self.midi_port.receive(block=True)
-          if msg:
-            self._update_active_notes(msg)
-            #self._print_midi_message(m)
-
-          # Every so often we should check to see if the midi ports have changed,
-          # Unfortunately, the RtMidi library doesn't provide a way to check if the
-          # port list has changed or if the device has disconnected,
-          # so we have to do it manually.
-          if current_time - last_port_check_time >= MIDI_PORT_CHECK_TIME_S:
-            curr_midi_ports = mido.get_input_names()
-            if len(curr_midi_ports) == 0:
-              self._clean_up_midi_port(disconnected=True)
-              midi_ports = []
-              print('No MIDI ports found, retrying...')
-              break
-            else:
-              midi_ports = curr_midi_ports
     except KeyboardInterrupt:
       # For Ctrl+C to work cleanly
       print("MidiNoteDetector terminated. Exiting...")
\ No newline at end of file
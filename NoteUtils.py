@@ -2,17 +2,36 @@ import os
 import json
 import colorsys
 from typing import Set
-from dataclasses import dataclass
 import numpy as np
 
+from ColourUtils import srgb_to_oklab
+
+NUM_MIDI_NOTES = 128
+NUM_PITCH_CLASSES = 12
+
 # Used to store and transmit data about a note being on/off
 # from the input (e.g., mic, midi) detector threads to the main thread.
-@dataclass
-class NoteData:
-  issuers: Set[str]
-  note_name: str
-  note_octave: int
-  intensity: float = 1.0
+# Notes are identified by their MIDI note number (e.g., 60 for C4) and pitch
+# class (0 = C, ..., 11 = B); names are only looked up (see MIDI_NOTE_NAMES)
+# when printing.
+class NoteData(object):
+  __slots__ = ('issuers', 'note', 'pitch_class', 'intensity')
+
+  def __init__(self, issuers: Set[str], note: int, intensity: float = 1.0):
+    self.issuers = issuers
+    self.note = note
+    self.pitch_class = note % NUM_PITCH_CLASSES
+    self.intensity = intensity
+
+  def __eq__(self, other):
+    if not isinstance(other, NoteData):
+      return NotImplemented
+    return (self.issuers, self.note, self.intensity) == (other.issuers, other.note, other.intensity)
+
+  def __repr__(self):
+    return "NoteData(issuers=%r, note=%d (%s), intensity=%r)" % (
+      self.issuers, self.note, MIDI_NOTE_NAMES[self.note], self.intensity
+    )
 
 # Note colours are the single source of truth shared with the web visualization
 # (web/ view). They live in note_colours.json at the repo root so editing a
@@ -63,9 +82,60 @@ def note_data_from_midi_name(midi_note_name: str):
   note_octave = int(midi_note_name[-1])
   return note_name, note_octave
 
-# Returns the midi note name (<note><octave>) from the given note data
-def midi_name_from_note_data(note_data: NoteData):
-  return note_data.note_name + str(note_data.note_octave)
+# Standardized note names in chromatic order, indexed by pitch class (0 = C)
+CHROMATIC_NOTE_NAMES = ['C', 'Db', 'D', 'Eb', 'E', 'F', 'Gb', 'G', 'Ab', 'A', 'Bb', 'B']
+
+# Standardized midi note name (e.g., 'Db4') of every MIDI note number (C-1 to G9)
+MIDI_NOTE_NAMES = [
+  CHROMATIC_NOTE_NAMES[n % NUM_PITCH_CLASSES] + str(n // NUM_PITCH_CLASSES - 1) for n in range(NUM_MIDI_NOTES)
+]
+_MIDI_NOTE_NUMBERS = {name: n for n, name in enumerate(MIDI_NOTE_NAMES)}
+
+# Colour of every pitch class (indexed as CHROMATIC_NOTE_NAMES) and of every MIDI note number
+PITCH_CLASS_COLOURS = np.array(
+  [NOTE_COLOURS[CIRCLE_OF_FIFTHS_NOTE_NAMES.index(name)] for name in CHROMATIC_NOTE_NAMES], dtype=np.float32
+)
+PITCH_CLASS_COLOURS.flags.writeable = False
+MIDI_NOTE_COLOURS = PITCH_CLASS_COLOURS[np.arange(NUM_MIDI_NOTES) % NUM_PITCH_CLASSES]
+MIDI_NOTE_COLOURS.flags.writeable = False
+# The palette in Oklab (and the chroma of every colour), converted once for the perceptual blends
+MIDI_NOTE_OKLAB = srgb_to_oklab(MIDI_NOTE_COLOURS)
+MIDI_NOTE_OKLAB.flags.writeable = False
+MIDI_NOTE_OKLAB_CHROMA = np.hypot(MIDI_NOTE_OKLAB[:, 1], MIDI_NOTE_OKLAB[:, 2])
+MIDI_NOTE_OKLAB_CHROMA.flags.writeable = False
+
+# Note/frequency conversions (the equal tempered ones librosa has, without
+# loading librosa), with A4 (MIDI note 69) tuned to tuning_hz
+A4_MIDI_NOTE = 69
+A4_FREQUENCY_HZ = 440.0
+
+# Frequency (Hz) of a (possibly fractional) MIDI note number, or of an array of them
+def midi_to_hz(midi_note, tuning_hz: float = A4_FREQUENCY_HZ):
+  return tuning_hz * 2.0 ** ((np.asarray(midi_note, dtype=np.float64) - A4_MIDI_NOTE) / NUM_PITCH_CLASSES)
+
+# (Fractional) MIDI note number of a frequency (Hz), or of an array of them
+def hz_to_midi(frequency_hz, tuning_hz: float = A4_FREQUENCY_HZ):
+  return A4_MIDI_NOTE + NUM_PITCH_CLASSES * np.log2(np.asarray(frequency_hz, dtype=np.float64) / tuning_hz)
+
+# Frequency (Hz) of every MIDI note number (A4 = 440Hz)
+MIDI_NOTE_FREQUENCIES = midi_to_hz(np.arange(NUM_MIDI_NOTES))
+MIDI_NOTE_FREQUENCIES.flags.writeable = False
+
+# The colour of a MIDI note number (that note_to_rgb() gives its note name), without any name lookups
+def midi_note_to_rgb(midi_note: int):
+  return MIDI_NOTE_COLOURS[midi_note]
+
+# MIDI note number (e.g., 60) of the given midi note name (e.g., 'C4' or 'C#4')
+def midi_number_from_midi_name(midi_note_name: str):
+  midi_note = _MIDI_NOTE_NUMBERS.get(midi_note_name)
+  if midi_note is None:
+    note_name, note_octave = note_data_from_midi_name(midi_note_name)
+    midi_note = CHROMATIC_NOTE_NAMES.index(note_name) + NUM_PITCH_CLASSES * (note_octave + 1)
+  return midi_note
+
+# Standardized midi note name (e.g., 'Db4') of the given MIDI note number
+def midi_name_from_midi_number(midi_note: int):
+  return MIDI_NOTE_NAMES[midi_note]
 
 def generate_midi_indices(note_name: str):
   if note_name == 'A' or  note_name == 'B' or note_name == 'Bb':
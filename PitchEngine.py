@@ -0,0 +1,361 @@
+import math
+import numpy as np
+
+from NoteUtils import A4_FREQUENCY_HZ, hz_to_midi, midi_to_hz, midi_number_from_midi_name
+from RingBuffer import AudioRingBuffer, HopCursor
+
+PITCH_ENGINE_PYIN = "pyin"
+PITCH_ENGINE_STREAM = "stream"
+PITCH_ENGINE_CHROMA = "chroma"
+PITCH_ENGINES = [PITCH_ENGINE_PYIN, PITCH_ENGINE_STREAM, PITCH_ENGINE_CHROMA]
+
+# Lowest and highest notes the pitch engines will report
+MIN_NOTE_NAME = 'C2'
+MAX_NOTE_NAME = 'C7'
+MIN_MIDI_NOTE = midi_number_from_midi_name(MIN_NOTE_NAME)
+MAX_MIDI_NOTE = midi_number_from_midi_name(MAX_NOTE_NAME)
+
+# Scale used to bring int16 microphone samples into [-1, 1]
+INT16_SCALE = 1.0 / 32768.0
+# Amount of audio (in seconds) the pitch engines buffer before old audio is dropped
+RING_BUFFER_S = 1.0
+
+# The interface of every pitch engine. process() takes the newest chunks of
+# microphone audio and the capture time (see EventMonitor.on_event()) of the
+# latest of them, and returns the notes of every hop with a result ready along
+# with the capture times of those hops. Each entry of the notes holds the unique
+# MIDI note numbers (e.g., 61 for C#4) detected during that hop; an empty entry
+# means that no notes are sounding. Engines whose results can lag behind the
+# audio (see MicWorkerPool.py) hand out the rest from wait_for_results().
+class PitchEngine(object):
+  def process(self, audio_chunks, capture_time: float = None):
+    detected_notes = self.analyse_hops(audio_chunks)
+    return detected_notes, [capture_time] * len(detected_notes)
+
+  # Analyses every new hop of the chunks right away and returns a list with one
+  # entry of notes per hop (possibly empty if there wasn't enough new audio for a hop)
+  def analyse_hops(self, audio_chunks):
+    raise NotImplementedError()
+
+  # Waits for the results of the audio already processed, as process() does
+  def wait_for_results(self):
+    return [], []
+
+  # Lines on how the engine kept up, for the mic file replay's report
+  def report_lines(self):
+    return []
+
+  def close(self):
+    pass
+
+# tuning_hz is the frequency of A4 the notes are relative to
+def create_pitch_engine(
+  engine_name: str,
+  sample_rate: int,
+  tuning_hz: float = A4_FREQUENCY_HZ,
+  hysteresis_cents: float = None
+):
+  if engine_name == PITCH_ENGINE_PYIN:
+    return PyinPitchEngine(sample_rate, tuning_hz, hysteresis_cents)
+  elif engine_name == PITCH_ENGINE_STREAM:
+    return StreamingPitchEngine(sample_rate, tuning_hz)
+  elif engine_name == PITCH_ENGINE_CHROMA:
+    # Imported here since the chroma engine is a PitchEngine itself
+    from ChromaPitchEngine import ChromaPitchEngine
+    return ChromaPitchEngine(sample_rate, MIN_MIDI_NOTE, MAX_MIDI_NOTE, scale=INT16_SCALE, tuning_hz=tuning_hz)
+  raise ValueError("Unknown pitch engine: " + str(engine_name))
+
+def round_up_to_even(f):
+  return int(math.ceil(f / 2.) * 2)
+
+# Quantises pitch estimates (Hz) to the unique MIDI note numbers they're closest
+# to (A4 tuned to tuning_hz), with hysteresis so a pitch wavering around the
+# boundary between two notes doesn't flip between them (and send a storm of
+# note on/off events): an estimate stays on a note of the previous call for up
+# to hysteresis_cents past the half-way point to the next note.
+class NoteQuantiser(object):
+  DEFAULT_HYSTERESIS_CENTS = 25.0
+  NO_NOTES = np.zeros(0, dtype=np.int64)
+
+  def __init__(self, tuning_hz: float = A4_FREQUENCY_HZ, hysteresis_cents: float = None):
+    self.tuning_hz = tuning_hz
+    if hysteresis_cents is None:
+      hysteresis_cents = self.DEFAULT_HYSTERESIS_CENTS
+    # Furthest (in semitones) an estimate can be from a held note and still be on it
+    self.hold_distance = 0.5 + hysteresis_cents / 100.0
+    self.held_notes = self.NO_NOTES
+
+  def quantise(self, f0_hz: np.ndarray):
+    if f0_hz.size == 0:
+      self.held_notes = self.NO_NOTES
+      return self.held_notes
+    midi = hz_to_midi(f0_hz, self.tuning_hz)
+    notes = np.rint(midi).astype(np.int64)
+    held = self.held_notes
+    if held.size > 0:
+      # Distance of every estimate to every held note, each estimate keeps its nearest held note if it's close enough
+      distance = np.abs(midi[:, None] - held[None, :])
+      nearest = np.argmin(distance, axis=1)
+      keep = distance[np.arange(midi.size), nearest] <= self.hold_distance
+      notes[keep] = held[nearest[keep]]
+    self.held_notes = np.unique(notes)
+    return self.held_notes
+
+# Runs a full librosa.pyin call over a window of the newest audio and quantises
+# the voiced pitches to notes (see NoteQuantiser). librosa (and the
+# numba/scipy/scikit-learn stack pyin loads) is only imported once an engine is
+# made, so only the processes that analyse the mic audio carry it.
+class PyinPitchEngine(PitchEngine):
+  # Analysis window and hop in ms, the windows overlap by half
+  PREF_WINDOW_SIZE_MS = 60
+  PREF_HOP_SIZE_MS = 30
+  NOTE_PROB_THRESHOLD = 0.11
+
+  def __init__(self, sample_rate: int, tuning_hz: float = A4_FREQUENCY_HZ, hysteresis_cents: float = None):
+    self.sample_rate = sample_rate
+    self.window_length = self.window_length_for(sample_rate) # Number of samples in the window
+    self.hop_length = self.hop_length_for(sample_rate)
+    self.fmin = float(midi_to_hz(MIN_MIDI_NOTE, tuning_hz))
+    self.fmax = float(midi_to_hz(MAX_MIDI_NOTE, tuning_hz))
+    self.quantiser = NoteQuantiser(tuning_hz, hysteresis_cents)
+    import librosa
+    self.pyin = librosa.pyin
+    self.audio_ring = AudioRingBuffer(max(self.window_length, int(sample_rate * RING_BUFFER_S)))
+    # pyin is far too slow to catch up on a backlog, so if we fall behind only the
+    # newest window is analysed
+    self.hop_cursor = HopCursor(self.audio_ring, self.window_length, self.hop_length, max_pending_hops=1)
+
+  @classmethod
+  def window_length_for(cls, sample_rate: int):
+    return round_up_to_even(sample_rate * cls.PREF_WINDOW_SIZE_MS / 1000.0)
+
+  @classmethod
+  def hop_length_for(cls, sample_rate: int):
+    return round_up_to_even(sample_rate * cls.PREF_HOP_SIZE_MS / 1000.0)
+
+  def analyse_hops(self, audio_chunks):
+    for chunk in audio_chunks:
+      self.audio_ring.write(chunk)
+
+    return [self.quantiser.quantise(self.analyse_window(audio_data)) for audio_data in self.hop_cursor.windows()]
+
+  # The voiced pitches (Hz) detected in a window of window_length samples
+  def analyse_window(self, audio_data: np.ndarray):
+    #audio_data = audio_data * np.hamming(audio_data.size)
+    f0, voiced_flag, voiced_probs = self.pyin(
+      audio_data,
+      sr=self.sample_rate,
+      fmin=self.fmin,
+      fmax=self.fmax
+    )
+
+    return f0[(voiced_probs > self.NOTE_PROB_THRESHOLD) & voiced_flag]
+
+# Streaming YIN pitch tracker that keeps its state between hops so that each
+# hop only costs work proportional to the newly arrived samples:
+# - The YIN difference function d(tau) over the current frame is kept as a running
+#   sum: each hop adds the rows for the samples entering the frame and subtracts the
+#   rows for the samples leaving it (both computed as FFT cross-correlations).
+# - A semitone HMM (notes MIN_NOTE_NAME..MAX_NOTE_NAME plus an unvoiced state) is
+#   decoded online, carrying the Viterbi scores over from hop to hop, so note
+#   changes need a few consistent hops rather than a whole re-decoded window.
+# - Audio lives in a ring buffer that hands out contiguous views, and all other
+#   per-hop work happens in buffers allocated once at construction.
+class StreamingPitchEngine(PitchEngine):
+  FRAME_LENGTH_S = 0.025
+  HOP_LENGTH_S = 0.01
+  # Cumulative mean normalized difference values at or below the low threshold are
+  # fully voiced, values at or above the high threshold are fully unvoiced
+  YIN_THRESHOLD_LOW = 0.1
+  YIN_THRESHOLD_HIGH = 0.35
+  # Frames quieter than this RMS (full scale = 1.0) are treated as silence
+  SILENCE_RMS = 1e-3
+  # Width (in semitones) of the emission likelihood around the YIN pitch estimate
+  EMISSION_SIGMA_SEMITONES = 0.35
+  EMISSION_FLOOR = 1e-6
+  # Probability of switching between voiced and unvoiced from one hop to the next
+  VOICING_SWITCH_PROB = 0.05
+  # Decay (in semitones) of the probability of jumping between notes between hops
+  NOTE_JUMP_DECAY_SEMITONES = 1.5
+  NOTE_STAY_PROB = 0.9
+  # The running difference function is recomputed from scratch every so often to
+  # stop floating point drift from accumulating
+  RESYNC_HOPS = 500
+
+  def __init__(self, sample_rate: int, tuning_hz: float = A4_FREQUENCY_HZ):
+    self.sample_rate = sample_rate
+    self.tuning_hz = tuning_hz
+    self.min_midi = MIN_MIDI_NOTE
+    self.max_midi = MAX_MIDI_NOTE
+    self.tau_min = max(2, int(math.floor(sample_rate / midi_to_hz(self.max_midi + 0.5, tuning_hz))))
+    self.tau_max = int(math.ceil(sample_rate / midi_to_hz(self.min_midi - 0.5, tuning_hz)))
+    self.frame_length = max(int(round(sample_rate * self.FRAME_LENGTH_S)), self.tau_max)
+    self.hop_length = max(1, int(round(sample_rate * self.HOP_LENGTH_S)))
+    # The frame spans frame_length rows, and each row looks ahead up to tau_max samples
+    self.span_length = self.frame_length + self.tau_max
+
+    # Each hop sees the previous span's first hop followed by the current span
+    self.view_length = self.span_length + self.hop_length
+    self.audio_ring = AudioRingBuffer(
+      max(self.view_length, int(sample_rate * RING_BUFFER_S)), scale=INT16_SCALE
+    )
+    self.hop_cursor = HopCursor(self.audio_ring, self.view_length, self.hop_length)
+    self._skipped_hops = 0
+    self._primed = False
+    self._hops_since_resync = 0
+    self._sq_prefix = np.zeros(self.view_length + 1, dtype=np.float64)
+
+    # Running difference function and scratch buffers for the YIN step
+    self._diff = np.zeros(self.tau_max + 1, dtype=np.float64)
+    self._block_diff = np.zeros(self.tau_max + 1, dtype=np.float64)
+    self._cmnd = np.ones(self.tau_max + 1, dtype=np.float64)
+    self._cumsum = np.zeros(self.tau_max, dtype=np.float64)
+    self._taus = np.arange(self.tau_max + 1, dtype=np.float64)
+    self._hop_fft_size = self._next_pow2(self.hop_length + self.tau_max)
+    self._frame_fft_size = self._next_pow2(self.frame_length + self.tau_max)
+
+    # Online Viterbi state: one state per semitone plus a final unvoiced state
+    self.state_midi = np.arange(self.min_midi, self.max_midi + 1, dtype=np.float64)
+    self.num_voiced_states = self.state_midi.size
+    self.unvoiced_state = self.num_voiced_states
+    num_states = self.num_voiced_states + 1
+    self._log_trans = self._build_log_transitions()
+    self._scores = np.full(num_states, -np.inf, dtype=np.float64)
+    self._scores[self.unvoiced_state] = 0.0
+    self._trellis = np.zeros((num_states, num_states), dtype=np.float64)
+    self._log_emission = np.zeros(num_states, dtype=np.float64)
+    self._empty_notes = np.array([], dtype=np.int64)
+    self._note_arrays = [np.array([int(m)], dtype=np.int64) for m in self.state_midi]
+
+  @staticmethod
+  def _next_pow2(n):
+    return 1 << int(math.ceil(math.log2(n)))
+
+  def _build_log_transitions(self):
+    num_voiced = self.num_voiced_states
+    jumps = np.abs(self.state_midi[:, None] - self.state_midi[None, :])
+    voiced_trans = np.exp(-jumps / self.NOTE_JUMP_DECAY_SEMITONES)
+    np.fill_diagonal(voiced_trans, 0.0)
+    voiced_trans *= (1.0 - self.NOTE_STAY_PROB) / voiced_trans.sum(axis=1, keepdims=True)
+    np.fill_diagonal(voiced_trans, self.NOTE_STAY_PROB)
+
+    trans = np.zeros((num_voiced + 1, num_voiced + 1), dtype=np.float64)
+    trans[:num_voiced, :num_voiced] = voiced_trans * (1.0 - self.VOICING_SWITCH_PROB)
+    trans[:num_voiced, self.unvoiced_state] = self.VOICING_SWITCH_PROB
+    trans[self.unvoiced_state, :num_voiced] = self.VOICING_SWITCH_PROB / num_voiced
+    trans[self.unvoiced_state, self.unvoiced_state] = 1.0 - self.VOICING_SWITCH_PROB
+    with np.errstate(divide='ignore'):
+      return np.log(trans)
+
+  def analyse_hops(self, audio_chunks):
+    for chunk in audio_chunks:
+      self.audio_ring.write(chunk)
+    results = []
+    for view in self.hop_cursor.windows():
+      results.append(self._advance(view))
+    return results
+
+  # Adds up (x[j] - x[j+tau])^2 for the rows j in [start, start+length) of the
+  # audio view into self._block_diff, for every tau in [0, tau_max]
+  def _difference_rows(self, view, start, length, fft_size):
+    end = start + length
+    rows = view[start:end]
+    lookahead = view[start:end+self.tau_max]
+    corr = np.fft.irfft(
+      np.conj(np.fft.rfft(rows, fft_size)) * np.fft.rfft(lookahead, fft_size), fft_size
+    )
+    # sum_j x[j]^2 + sum_j x[j+tau]^2 - 2 * sum_j x[j]*x[j+tau]
+    sq = self._sq_prefix
+    np.subtract(sq[end:end+self.tau_max+1], sq[start:start+self.tau_max+1], out=self._block_diff)
+    self._block_diff += sq[end] - sq[start]
+    self._block_diff -= 2.0 * corr[:self.tau_max+1]
+    return self._block_diff
+
+  # The view holds the hop leaving the frame followed by the current span, i.e., the
+  # previous frame is rows [0, frame_length) and the current frame is rows
+  # [hop_length, hop_length + frame_length)
+  def _advance(self, view):
+    np.cumsum(np.square(view, dtype=np.float64), out=self._sq_prefix[1:])
+
+    # Skipped hops break the running sum, so it has to be rebuilt
+    if self.hop_cursor.skipped_hops != self._skipped_hops:
+      self._skipped_hops = self.hop_cursor.skipped_hops
+      self._primed = False
+
+    if not self._primed or self._hops_since_resync >= self.RESYNC_HOPS:
+      self._diff[:] = self._difference_rows(view, self.hop_length, self.frame_length, self._frame_fft_size)
+      self._primed = True
+      self._hops_since_resync = 0
+    else:
+      # Slide the frame forward by one hop: rows entering the frame are added,
+      # rows leaving the frame are removed
+      self._diff += self._difference_rows(view, self.frame_length, self.hop_length, self._hop_fft_size)
+      self._diff -= self._difference_rows(view, 0, self.hop_length, self._hop_fft_size)
+      self._hops_since_resync += 1
+    np.maximum(self._diff, 0.0, out=self._diff)
+
+    midi_estimate, voiced_prob = self._estimate_pitch(view[self.hop_length:self.hop_length+self.frame_length])
+    state = self._viterbi_step(midi_estimate, voiced_prob)
+    if state == self.unvoiced_state:
+      return self._empty_notes
+    return self._note_arrays[state]
+
+  # YIN pitch estimate over the current frame, returns (fractional midi note, voiced probability)
+  def _estimate_pitch(self, frame):
+    frame_energy = np.dot(frame, frame) / self.frame_length
+    if frame_energy < self.SILENCE_RMS * self.SILENCE_RMS:
+      return 0.0, 0.0
+
+    # Cumulative mean normalized difference function
+    np.cumsum(self._diff[1:], out=self._cumsum)
+    np.maximum(self._cumsum, 1e-12, out=self._cumsum)
+    np.multiply(self._diff[1:], self._taus[1:], out=self._cmnd[1:])
+    self._cmnd[1:] /= self._cumsum
+
+    search = self._cmnd[self.tau_min:self.tau_max]
+    below = search < self.YIN_THRESHOLD_HIGH
+    if not below.any():
+      return 0.0, 0.0
+    # Take the first dip under the threshold (avoids octave errors), then walk
+    # down to the bottom of that dip
+    confident = search < self.YIN_THRESHOLD_LOW
+    i = int(np.argmax(confident)) if confident.any() else int(np.argmin(search))
+    while i + 1 < search.size and search[i+1] < search[i]:
+      i += 1
+    tau = i + self.tau_min
+    cmnd_min = self._cmnd[tau]
+
+    # Parabolic interpolation around the minimum for sub-sample accuracy
+    refined_tau = float(tau)
+    if 1 <= tau < self.tau_max:
+      a, b, c = self._cmnd[tau-1], self._cmnd[tau], self._cmnd[tau+1]
+      denom = a - 2.0 * b + c
+      if denom > 0.0:
+        refined_tau += 0.5 * (a - c) / denom
+
+    voiced_prob = (self.YIN_THRESHOLD_HIGH - cmnd_min) / (self.YIN_THRESHOLD_HIGH - self.YIN_THRESHOLD_LOW)
+    voiced_prob = min(1.0, max(0.0, voiced_prob))
+    midi_estimate = 69.0 + 12.0 * math.log2(self.sample_rate / refined_tau / self.tuning_hz)
+    return midi_estimate, voiced_prob
+
+  # One step of the online Viterbi decoder, returns the most likely current state
+  def _viterbi_step(self, midi_estimate, voiced_prob):
+    emission = self._log_emission
+    voiced = emission[:self.num_voiced_states]
+    np.subtract(self.state_midi, midi_estimate, out=voiced)
+    voiced /= self.EMISSION_SIGMA_SEMITONES
+    np.square(voiced, out=voiced)
+    voiced *= -0.5
+    np.exp(voiced, out=voiced)
+    voiced *= voiced_prob
+    emission[self.unvoiced_state] = 1.0 - voiced_prob
+    np.maximum(emission, self.EMISSION_FLOOR, out=emission)
+    np.log(emission, out=emission)
+
+    np.add(self._scores[:, None], self._log_trans, out=self._trellis)
+    np.max(self._trellis, axis=0, out=self._scores)
+    self._scores += emission
+    # Keep the scores from drifting towards -inf
+    best_state = int(np.argmax(self._scores))
+    self._scores -= self._scores[best_state]
+    return best_state
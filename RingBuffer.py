@@ -0,0 +1,86 @@
+import numpy as np
+
+# Fixed-capacity ring buffer of audio samples. Every sample is stored twice
+# (at i and at i + capacity), so any run of up to `capacity` consecutive samples
+# is available as a contiguous numpy view without copying. Samples are addressed
+# by their absolute position in the stream (0 = the first sample ever written).
+class AudioRingBuffer(object):
+  def __init__(self, capacity: int, scale: float = 1.0, dtype=np.float32):
+    assert capacity > 0
+    self.capacity = capacity
+    # Written samples are multiplied by this (e.g., to bring int16 into [-1, 1])
+    self.scale = scale
+    self._data = np.zeros(2 * capacity, dtype=dtype)
+    # Total number of samples ever written, i.e., the absolute end position of the stream
+    self.num_written = 0
+
+  # Oldest absolute sample position still held by the buffer
+  def oldest_position(self):
+    return max(0, self.num_written - self.capacity)
+
+  def write(self, samples: np.ndarray):
+    n = samples.size
+    if n > self.capacity:
+      # Only the newest samples can be kept
+      self.num_written += n - self.capacity
+      samples = samples[-self.capacity:]
+      n = self.capacity
+    pos = self.num_written % self.capacity
+    first = min(n, self.capacity - pos)
+    for base in (0, self.capacity):
+      np.multiply(samples[:first], self.scale, out=self._data[base+pos:base+pos+first])
+      if first < n:
+        np.multiply(samples[first:], self.scale, out=self._data[base:base+n-first])
+    self.num_written += n
+
+  # Contiguous (zero-copy) view of the `length` samples ending at absolute position
+  # `end` (exclusive). The view is only valid until the next write().
+  def window(self, end: int, length: int):
+    start = end - length
+    if length > self.capacity or end > self.num_written or start < self.oldest_position():
+      raise IndexError("Window [%d, %d) is not held by the ring buffer" % (start, end))
+    offset = start % self.capacity
+    return self._data[offset:offset+length]
+
+  def latest(self, length: int):
+    return self.window(self.num_written, length)
+
+# Walks a ring buffer in windows of `window_length` samples that advance by
+# exactly `hop_length` samples (overlap = window_length - hop_length).
+# If the reader falls behind by more than `max_pending_hops` (or the buffer has
+# already overwritten a due window) the oldest hops are skipped and counted.
+class HopCursor(object):
+  def __init__(self, ring: AudioRingBuffer, window_length: int, hop_length: int, max_pending_hops: int = None):
+    assert 0 < hop_length and 0 < window_length <= ring.capacity
+    self.ring = ring
+    self.window_length = window_length
+    self.hop_length = hop_length
+    self.max_pending_hops = max_pending_hops
+    # Absolute end position of the next window to be read
+    self.next_end = window_length
+    self.skipped_hops = 0
+
+  def pending_hops(self):
+    if self.ring.num_written < self.next_end:
+      return 0
+    return (self.ring.num_written - self.next_end) // self.hop_length + 1
+
+  def _skip_stale_hops(self):
+    pending = self.pending_hops()
+    skip = 0
+    if self.max_pending_hops is not None and pending > self.max_pending_hops:
+      skip = pending - self.max_pending_hops
+    oldest_end = self.ring.oldest_position() + self.window_length
+    if self.next_end + skip * self.hop_length < oldest_end:
+      skip = -(-(oldest_end - self.next_end) // self.hop_length)
+    if skip > 0:
+      self.next_end += skip * self.hop_length
+      self.skipped_hops += skip
+
+  # Yields a view for every window that is due. Each view is only valid until
+  # the ring buffer is written to again.
+  def windows(self):
+    self._skip_stale_hops()
+    while self.next_end <= self.ring.num_written:
+      yield self.ring.window(self.next_end, self.window_length)
+      self.next_end += self.hop_length
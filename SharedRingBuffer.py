@@ -0,0 +1,136 @@
+import os
+import sys
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# Attaches to an existing shared memory block without handing its lifetime to
+# this process' resource tracker (only the creating process should unlink it).
+# Before Python 3.13 attaching always registers the block, but processes started
+# by multiprocessing share their parent's tracker, so that registration is a no-op.
+def _attach_shared_memory(name: str):
+  if sys.version_info >= (3, 13):
+    return shared_memory.SharedMemory(name=name, track=False)
+  return shared_memory.SharedMemory(name=name)
+
+# Single-producer/single-consumer ring buffer in shared memory, used to hand items
+# (e.g., audio samples or structured event records) from a real-time thread or process to a consumer without
+# locks. The producer only ever advances the write index and the consumer only
+# ever advances the read index. The indices are monotonically increasing int64
+# counters held in the shared block; aligned 64-bit stores are atomic on the
+# platforms we run on, and each index is only published after the data it covers
+# has been written/read.
+#
+# The producer never blocks: if there isn't room for a whole write it is dropped
+# and counted as an overrun.
+#
+# Instances can be pickled (e.g., passed to another Process), in which case the
+# copy attaches to the same shared memory block.
+class SharedRingBuffer(object):
+  _WRITE_IDX = 0
+  _READ_IDX = 1
+  _OVERRUN_WRITES = 2
+  _OVERRUN_ITEMS = 3
+  _HEADER_SIZE = 4
+
+  # Used by consumers that wait for data (there's no cross-process notify on the
+  # producer side, since that would mean taking a lock in the producer)
+  POLL_INTERVAL_S = 0.001
+
+  def __init__(self, capacity: int, dtype=np.int16):
+    assert capacity > 0
+    self.capacity = capacity
+    self.dtype = np.dtype(dtype)
+    header_bytes = self._HEADER_SIZE * np.dtype(np.int64).itemsize
+    self._shm = shared_memory.SharedMemory(
+      create=True, size=header_bytes + capacity * self.dtype.itemsize
+    )
+    # Only the creating process unlinks the block (forked children inherit this object as-is)
+    self._owner_pid = os.getpid()
+    self._map_arrays()
+    self._header[:] = 0
+
+  def _map_arrays(self):
+    header_bytes = self._HEADER_SIZE * np.dtype(np.int64).itemsize
+    self._header = np.ndarray((self._HEADER_SIZE,), dtype=np.int64, buffer=self._shm.buf)
+    self._data = np.ndarray((self.capacity,), dtype=self.dtype, buffer=self._shm.buf, offset=header_bytes)
+
+  def __getstate__(self):
+    return {'name': self._shm.name, 'capacity': self.capacity, 'dtype': self.dtype}
+
+  def __setstate__(self, state):
+    self.capacity = state['capacity']
+    self.dtype = np.dtype(state['dtype'])
+    self._shm = _attach_shared_memory(state['name'])
+    self._owner_pid = None
+    self._map_arrays()
+
+  def close(self):
+    if self._shm is None:
+      return
+    self._header = None
+    self._data = None
+    self._shm.close()
+    if self._owner_pid == os.getpid():
+      self._shm.unlink()
+    self._shm = None
+
+  # Number of items written but not yet read
+  def readable(self):
+    return int(self._header[self._WRITE_IDX] - self._header[self._READ_IDX])
+
+  # Number of items that can be written without overrunning
+  def writable(self):
+    return self.capacity - self.readable()
+
+  # Number of writes (and items) dropped because the consumer fell behind
+  def overruns(self):
+    return int(self._header[self._OVERRUN_WRITES]), int(self._header[self._OVERRUN_ITEMS])
+
+  # Producer side: writes all of the given items or none of them.
+  # Returns True if the items were written, False if they were dropped.
+  def write(self, items: np.ndarray):
+    n = items.size
+    write_idx = int(self._header[self._WRITE_IDX])
+    if n > self.capacity - (write_idx - int(self._header[self._READ_IDX])):
+      self._header[self._OVERRUN_WRITES] += 1
+      self._header[self._OVERRUN_ITEMS] += n
+      return False
+    pos = write_idx % self.capacity
+    first = min(n, self.capacity - pos)
+    self._data[pos:pos+first] = items[:first]
+    if first < n:
+      self._data[:n-first] = items[first:]
+    # Publish the data to the consumer
+    self._header[self._WRITE_IDX] = write_idx + n
+    return True
+
+  # Consumer side: returns (up to two) zero-copy views covering up to max_items of
+  # the unread items, oldest first. The views stay valid until release() is called.
+  def peek(self, max_items: int = None):
+    read_idx = int(self._header[self._READ_IDX])
+    n = int(self._header[self._WRITE_IDX]) - read_idx
+    if max_items is not None:
+      n = min(n, max_items)
+    if n <= 0:
+      return []
+    pos = read_idx % self.capacity
+    first = min(n, self.capacity - pos)
+    if first < n:
+      return [self._data[pos:pos+first], self._data[:n-first]]
+    return [self._data[pos:pos+first]]
+
+  # Consumer side: marks n items as read, handing their space back to the producer
+  def release(self, n: int):
+    self._header[self._READ_IDX] += n
+
+  # Consumer side: waits until there is something to read or the timeout (in
+  # seconds, None = forever) expires. Returns True if there is data to read.
+  def wait_for_data(self, timeout: float = None):
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while self.readable() == 0:
+      if deadline is not None and time.monotonic() >= deadline:
+        return False
+      time.sleep(self.POLL_INTERVAL_S)
+    return True
@@ -0,0 +1,42 @@
+"""Benchmark: per-frame cost of the Animator's note animation + colour blend,
+original dict-of-Animation path vs the vectorized AnimationEngine, with 1-88
+simultaneous notes.
+
+Run: python3 bench_animation_engine.py [--frames N]
+"""
+import argparse
+import time
+
+from NoteUtils import midi_name_from_midi_number
+from test_animation_engine import LegacyNoteAnimator, EngineNoteAnimator
+
+NOTE_COUNTS = [1, 2, 4, 8, 16, 32, 64, 88]
+FRAME_DT_S = 1.0 / 120.0
+
+
+def time_frames(animator_cls, num_notes, num_frames):
+    animator = animator_cls()
+    # Spread the held notes over the piano so several share a pitch class
+    for note in range(21, 21 + num_notes):
+        animator.note_on(midi_name_from_midi_number(note))
+    animator.update_colour(FRAME_DT_S)
+    start = time.perf_counter()
+    for _ in range(num_frames):
+        animator.update_colour(FRAME_DT_S)
+    return (time.perf_counter() - start) / num_frames
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--frames", type=int, default=2000, help="Frames to time per note count.")
+    args = parser.parse_args()
+
+    print("%6s  %12s  %12s  %8s" % ("notes", "legacy (us)", "engine (us)", "speedup"))
+    for num_notes in NOTE_COUNTS:
+        legacy_s = time_frames(LegacyNoteAnimator, num_notes, args.frames)
+        engine_s = time_frames(EngineNoteAnimator, num_notes, args.frames)
+        print("%6d  %12.1f  %12.1f  %7.1fx" % (num_notes, legacy_s * 1e6, engine_s * 1e6, legacy_s / engine_s))
+
+
+if __name__ == '__main__':
+    main()
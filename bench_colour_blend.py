@@ -0,0 +1,40 @@
+"""Benchmark: per-frame cost of the AnimationEngine's colour blend in each blend
+mode (raw RGB, Oklab and OkLCh), with 1-88 simultaneous notes.
+
+Run: python3 bench_colour_blend.py [--frames N]
+"""
+import argparse
+import time
+
+from AnimationEngine import AnimationEngine
+from NoteUtils import midi_note_to_rgb
+
+NOTE_COUNTS = [1, 2, 4, 8, 16, 32, 64, 88]
+FRAME_DT_S = 1.0 / 120.0
+
+
+def time_frames(blend, num_notes, num_frames):
+    engine = AnimationEngine(blend=blend)
+    # Fading in, so every held note contributes to the blend
+    for note in range(21, 21 + num_notes):
+        engine.start(note, 0.0, 1.0, 1e9, AnimationEngine.CURVE_SQRTSTEP, colour=midi_note_to_rgb(note))
+    engine.update(FRAME_DT_S)
+    start = time.perf_counter()
+    for _ in range(num_frames):
+        engine.update(FRAME_DT_S)
+    return (time.perf_counter() - start) / num_frames
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--frames", type=int, default=2000, help="Frames to time per blend and note count.")
+    args = parser.parse_args()
+
+    print("%6s" % "notes" + "".join("  %12s" % (blend + " (us)") for blend in AnimationEngine.BLENDS))
+    for num_notes in NOTE_COUNTS:
+        times_s = [time_frames(blend, num_notes, args.frames) for blend in AnimationEngine.BLENDS]
+        print("%6d" % num_notes + "".join("  %12.1f" % (t * 1e6) for t in times_s))
+
+
+if __name__ == '__main__':
+    main()
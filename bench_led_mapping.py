@@ -0,0 +1,60 @@
+"""Benchmark: per-frame cost of rendering a frame buffer for each LED mapping,
+running it through the gamma/brightness output stage (plain and dithered) and
+encoding it for the NeoPixel SPI bus, for strips of 19-600 LEDs with a ten
+note chord held.
+
+Run: python3 bench_led_mapping.py [--frames N]
+"""
+import argparse
+import time
+
+from AnimationEngine import AnimationEngine
+from ColourUtils import GammaOutputStage
+from LedMapping import LED_MAPPINGS, LedFrameRenderer
+from LedOutput import neopixel_spi_encode
+from NoteUtils import midi_note_to_rgb
+
+LED_COUNTS = [19, 60, 150, 300, 600]
+CHORD = [36, 43, 48, 52, 55, 60, 64, 67, 72, 76]
+FRAME_DT_S = 1.0 / 120.0
+
+
+def time_frames(mapping, num_leds, num_frames):
+    engine = AnimationEngine()
+    for note in CHORD:
+        engine.start(note, 0.0, 1.0, 0.05, AnimationEngine.CURVE_SQRTSTEP, colour=midi_note_to_rgb(note))
+    renderer = LedFrameRenderer(mapping, num_leds)
+    output_stage = GammaOutputStage(num_leds, brightness=0.5)
+    dithered_output_stage = GammaOutputStage(num_leds, brightness=0.5, dither=True)
+    total_colour = engine.update(FRAME_DT_S)
+    times_s = [0.0] * 4
+    for _ in range(num_frames):
+        t0 = time.perf_counter()
+        frame = renderer.render(engine, total_colour)
+        t1 = time.perf_counter()
+        led_values = output_stage.process(frame)
+        t2 = time.perf_counter()
+        dithered_output_stage.process(frame)
+        t3 = time.perf_counter()
+        neopixel_spi_encode(led_values, 0b11000000, 0b11110000)
+        t4 = time.perf_counter()
+        for i, dt in enumerate([t1 - t0, t2 - t1, t3 - t2, t4 - t3]):
+            times_s[i] += dt
+    return [t / num_frames for t in times_s]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--frames", type=int, default=2000, help="Frames to time per mapping and LED count.")
+    args = parser.parse_args()
+
+    print("%-12s  %5s  %12s  %12s  %14s  %12s" % (
+        "mapping", "leds", "render (us)", "output (us)", "dithered (us)", "encode (us)"))
+    for mapping in LED_MAPPINGS:
+        for num_leds in LED_COUNTS:
+            times_s = time_frames(mapping, num_leds, args.frames)
+            print("%-12s  %5d  %12.1f  %12.1f  %14.1f  %12.1f" % ((mapping, num_leds) + tuple(t * 1e6 for t in times_s)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""Benchmark: frame cost of driving 1-8 LED zones at once, each a simulated
+NeoPixel strip (LedOutput's sim output: every write takes as long as the SPI
+transfer of the strip would) written by its own AsyncLedWriter thread, with
+the colours changing every frame.
+
+Reports the Animator side of each frame (rendering every zone and handing the
+frames to the writers) and how many frames per second each zone's strip
+actually got. With the writers running in parallel the transfers never add to
+the frame, which only grows by each zone's rendering (tens of microseconds),
+and every strip keeps its frame rate, where writing the zones one after the
+other would add every transfer to the frame and divide the frame rate of every
+strip by the number of zones.
+
+Run: python3 bench_led_zones.py [--seconds S] [--num-leds N] [--fps F]
+"""
+import argparse
+import time
+
+import numpy as np
+
+from AnimationEngine import AnimationEngine
+from LedMapping import LED_MAPPINGS
+from LedOutput import LED_OUTPUT_SIM, NullOutput
+from LedZones import LedZone, LedZoneConfig
+from NoteUtils import midi_note_to_rgb
+
+ZONE_COUNTS = [1, 2, 4, 8]
+CHORD = [36, 43, 48, 52, 55, 60, 64, 67, 72, 76]
+
+
+def run_zones(num_zones, num_leds, fps, seconds):
+    zones = [
+        LedZone(LedZoneConfig("zone%d" % (i + 1), num_leds, LED_MAPPINGS[i % len(LED_MAPPINGS)], 0.5, output=LED_OUTPUT_SIM))
+        for i in range(num_zones)
+    ]
+    for zone in zones:
+        zone.open()
+    engine = AnimationEngine()
+    frame_period_s = 1.0 / fps
+    num_frames = int(seconds * fps)
+    update_time_s = 0.0
+    start = time.perf_counter()
+    for frame in range(num_frames):
+        # A new note every frame, so every zone's LEDs change
+        note = CHORD[frame % len(CHORD)]
+        engine.start(note, 0.0, 0.5 + 0.5 * (frame % 50) / 50.0, 0.05, AnimationEngine.CURVE_SQRTSTEP, colour=midi_note_to_rgb(note))
+        total_colour = engine.update(frame_period_s)
+        t0 = time.perf_counter()
+        for zone in zones:
+            zone.update(engine, total_colour)
+        update_time_s += time.perf_counter() - t0
+        next_frame = start + (frame + 1) * frame_period_s
+        time.sleep(max(next_frame - time.perf_counter(), 0.0))
+    elapsed_s = time.perf_counter() - start
+    frames_written = [zone.writer.frames_written for zone in zones]
+    for zone in zones:
+        zone.close()
+    return update_time_s / num_frames, np.mean(frames_written) / elapsed_s
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--seconds", type=float, default=2.0, help="Seconds to run each zone count for.")
+    parser.add_argument("--num-leds", type=int, default=150, help="LEDs per zone.")
+    parser.add_argument("--fps", type=float, default=120.0, help="Animator frame rate.")
+    args = parser.parse_args()
+
+    print("%d LEDs per zone, %.1fms per simulated strip write, %.0f fps" % (
+        args.num_leds, 1000.0 * NullOutput.neopixel_write_time_s(args.num_leds), args.fps))
+    print("%5s  %12s  %16s" % ("zones", "frame (us)", "strip fps/zone"))
+    for num_zones in ZONE_COUNTS:
+        update_time_s, strip_fps = run_zones(num_zones, args.num_leds, args.fps, args.seconds)
+        print("%5d  %12.1f  %16.1f" % (num_zones, update_time_s * 1e6, strip_fps))
+
+
+if __name__ == '__main__':
+    main()
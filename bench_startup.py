@@ -0,0 +1,162 @@
+"""Benchmark: cold start of chromesthesia.py with each process start method, as
+the time from launch to the Animator's first frame and the resident memory
+(RSS) of every process once it has settled, with the heavy native libraries
+each process has mapped (numba's llvmlite, scipy, scikit-learn, portaudio).
+
+Arguments it doesn't know are passed on to chromesthesia.py (default --no-hw),
+e.g. --mic-file song.wav to have the mic process load its pitch engine.
+Linux only (reads /proc).
+
+Run: python3 bench_startup.py [--runs N] [--settle-s S] [--start-methods spawn fork] [chromesthesia args]
+"""
+import argparse
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+
+APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "chromesthesia.py")
+FIRST_FRAME_METRIC = "chromesthesia_animator_frames_total"
+FIRST_FRAME_TIMEOUT_S = 120.0
+POLL_INTERVAL_S = 0.01
+# chromesthesia.py starts its processes in this order
+CHILD_NAMES = ["Animator", "MidiNoteDetector", "MicNoteDetector"]
+# Paths that show the library is loaded (numpy's bundled OpenBLAS is also named scipy)
+HEAVY_LIBS = {"llvmlite": "/llvmlite/", "scipy": "/scipy/", "sklearn": "/sklearn", "portaudio": "portaudio"}
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def frames_rendered(port):
+    try:
+        with urllib.request.urlopen("http://127.0.0.1:%d/metrics" % port, timeout=1.0) as response:
+            text = response.read().decode()
+    except OSError:
+        return 0.0
+    for line in text.splitlines():
+        if line.startswith(FIRST_FRAME_METRIC + " "):
+            return float(line.split()[1])
+    return 0.0
+
+
+def children(pid):
+    try:
+        with open("/proc/%d/task/%d/children" % (pid, pid)) as f:
+            return [int(child) for child in f.read().split()]
+    except OSError:
+        return []
+
+
+def start_time(pid):
+    with open("/proc/%d/stat" % pid) as f:
+        # The fields after the (possibly spaced) command name, starttime is field 22
+        return int(f.read().rsplit(")", 1)[1].split()[19])
+
+
+def rss_mb(pid):
+    with open("/proc/%d/status" % pid) as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024.0
+    # Exited (a zombie until the app reaps it)
+    return None
+
+
+def heavy_libs(pid):
+    with open("/proc/%d/maps" % pid) as f:
+        maps = f.read()
+    return [lib for lib, path in HEAVY_LIBS.items() if path in maps]
+
+
+def is_resource_tracker(pid):
+    with open("/proc/%d/cmdline" % pid, "rb") as f:
+        return b"resource_tracker" in f.read()
+
+
+# (name, pid) of the app's main process, its processes and their workers
+def app_processes(main_pid):
+    processes = [("main", main_pid)]
+    named = 0
+    for pid in sorted(children(main_pid), key=start_time):
+        if is_resource_tracker(pid):
+            processes.append(("resource tracker", pid))
+            continue
+        name = CHILD_NAMES[named] if named < len(CHILD_NAMES) else "child"
+        named += 1
+        processes.append((name, pid))
+        processes += [(name + " worker", worker) for worker in children(pid)]
+    return processes
+
+
+def run_once(start_method, app_args, settle_s):
+    port = free_port()
+    command = [sys.executable, APP, "--start-method", start_method, "--metrics-port", str(port)] + app_args
+    launch_time = time.perf_counter()
+    app = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+    try:
+        first_frame_s = None
+        while time.perf_counter() - launch_time < FIRST_FRAME_TIMEOUT_S and app.poll() is None:
+            if frames_rendered(port) > 0:
+                first_frame_s = time.perf_counter() - launch_time
+                break
+            time.sleep(POLL_INTERVAL_S)
+        time.sleep(settle_s)
+        usage = []
+        for name, pid in app_processes(app.pid):
+            try:
+                usage.append((name, pid, rss_mb(pid), heavy_libs(pid)))
+            except OSError:
+                pass
+        return first_frame_s, usage
+    finally:
+        try:
+            os.killpg(app.pid, signal.SIGINT)
+            app.wait(timeout=10.0)
+        except subprocess.TimeoutExpired:
+            os.killpg(app.pid, signal.SIGKILL)
+            app.wait()
+        except ProcessLookupError:
+            pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=3, help="Cold starts to time per start method.")
+    parser.add_argument("--settle-s", type=float, default=5.0, help="Seconds after the first frame to wait before measuring memory.")
+    parser.add_argument("--start-methods", nargs="+", default=["spawn", "fork"], help="Process start methods to compare.")
+    args, app_args = parser.parse_known_args()
+    if not app_args:
+        app_args = ["--no-hw"]
+
+    for start_method in args.start_methods:
+        first_frame_times_s = []
+        for _ in range(args.runs):
+            first_frame_s, usage = run_once(start_method, app_args, args.settle_s)
+            if first_frame_s is not None:
+                first_frame_times_s.append(first_frame_s)
+        print("start method: %s" % start_method)
+        if first_frame_times_s:
+            first_frame_times_s.sort()
+            print("  time to first frame: min %.3fs, median %.3fs (%d/%d runs)" % (
+                first_frame_times_s[0], first_frame_times_s[len(first_frame_times_s) // 2],
+                len(first_frame_times_s), args.runs))
+        else:
+            print("  no frame rendered within %.0fs" % FIRST_FRAME_TIMEOUT_S)
+        print("  %-26s  %7s  %9s  %s" % ("process (last run)", "pid", "RSS (MB)", "heavy libraries"))
+        for name, pid, rss, libs in usage:
+            if rss is None:
+                print("  %-26s  %7d  %9s" % (name, pid, "exited"))
+            else:
+                print("  %-26s  %7d  %9.1f  %s" % (name, pid, rss, ", ".join(libs) or "-"))
+        print("  %-26s  %7s  %9.1f" % ("total", "", sum(rss for _, _, rss, _ in usage if rss is not None)))
+
+
+if __name__ == '__main__':
+    main()
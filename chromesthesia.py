@@ -1,23 +1,28 @@
 import time
-import math
 import argparse
+import functools
+import multiprocessing
 from multiprocessing import Process
-from typing import Dict
+from typing import Dict, List
 from dataclasses import dataclass
 
 import numpy as np
 
-from EventMonitor import EventMonitor
+from EventMonitor import EventMonitor, Issuer, make_issuers
+from FrameScheduler import FrameScheduler
 from MicNoteDetector import MicNoteDetector
 from MidiNoteDetector import MidiNoteDetector
-from Animation import Animation, sqrtstep, smoothstep
-from NoteUtils import NoteData, midi_name_from_note_data, note_to_rgb, note_data_from_midi_name, generate_all_possible_midi_names
-from ColourUtils import gamma
-
-@dataclass
-class NoteColourAnimation:
-  note_colour: np.ndarray
-  animation: Animation
+from PitchEngine import NoteQuantiser, PITCH_ENGINES, PITCH_ENGINE_PYIN
+from AnimationEngine import AnimationEngine
+from NoteUtils import A4_FREQUENCY_HZ, NoteData, MIDI_NOTE_NAMES, NUM_PITCH_CLASSES
+from Chord import exact_chords, implied_chord_of_mask, name_from_midi_notes
+from KeySpelling import KeyEstimator
+from LedMapping import LED_MAPPINGS, LED_MAPPING_FILL
+from LedZones import LedZone, LedZoneConfig, led_zone_configs
+from FrameRecording import FrameRecorder
+from LatencyStats import LatencyStats
+from Metrics import Metrics, MetricsServer
+from LedOutput import LED_OUTPUTS, LED_OUTPUT_NEOPIXEL, LED_OUTPUT_DDP, DDP_PORT
 
 @dataclass
 class NoteHistory:
@@ -28,311 +33,407 @@ class Animator(Process):
   OFF_COLOUR = np.array([0.,0.,0.], dtype=np.float32)
   DEFAULT_ANIM_FADE_IN_TIME_S  = 0.05
   DEFAULT_ANIM_FADE_OUT_TIME_S = 0.1
+  # Note events that haven't changed the LEDs after this long are no longer followed (see --latency-stats)
+  LATENCY_TIMEOUT_S = 1.0
 
-  def __init__(self, event_monitor: EventMonitor, args: argparse.Namespace):
+  def __init__(
+    self, event_monitor: EventMonitor, args: argparse.Namespace, metrics: Metrics = None,
+    zone_configs: List[LedZoneConfig] = None
+  ):
     super(Animator, self).__init__()
     self.args = args
-    self.is_midi_connected = False
-    self.is_mic_connected = False
+    self.metrics = metrics if metrics is not None else Metrics(shared=False)
+    # Names of the MIDI ports and mics that are connected
+    self.connected_midi = set()
+    self.connected_mics = set()
+    # Names of every mic issuer, to tell whether a mic is (also) holding a note
+    self.mic_issuers = frozenset(
+      issuer.name for issuer in event_monitor.issuers if issuer.kind == EventMonitor.EVENT_ISSUER_MIC
+    )
 
-    if args.no_hw:
-      self.pixels = None
-    else:
-      import board
-      import neopixel_spi as neopixel
-      self.pixels = neopixel.NeoPixel_SPI(
-        spi=board.SPI(),
-        n=args.num_leds,
-        auto_write=False,
-        bpp=3,
-        brightness=args.brightness,
-        pixel_order=neopixel.RGB,
-      )
-      self.pixels.fill((0,0,0))
-      self.pixels.show()
+    # The strips the frames go to (see --led-zones), each written from a writer
+    # thread of its own started in run(). Their outputs are opened in run() too, so
+    # the hardware (or socket) belongs to the Animator's process and the Animator
+    # can be handed to a spawned process.
+    if zone_configs is None:
+      zone_configs = led_zone_configs(args)
+    self.zones = [LedZone(config) for config in zone_configs]
+    self.num_leds = sum(zone.num_leds for zone in self.zones)
+    # Records every frame sent to the LEDs (see --record), opened in run()
+    self.frame_recorder = None
+    self.run_start_time = 0.0
+    self.frame_start_time = 0.0
+    # Latency from capturing the input behind each note event to the LEDs changing (see --latency-stats)
+    self.latency_stats = LatencyStats(event_monitor.issuer_names) if args.latency_stats else None
+    self.unseen_event_records = np.zeros(0, dtype=EventMonitor.EVENT_RECORD_DTYPE)
 
     # Currently active notes, also tracks the set of inputs the notes came from
-    # so we can smartly process note on/off events.
-    self.active_notes: Dict[str, NoteData] = {}
+    # so we can smartly process note on/off events. Mapped by MIDI note number.
+    self.active_notes: Dict[int, NoteData] = {}
     # Midi note history - keep track of times when notes have been active via MIDI
-    self.midi_note_history: Dict[str, NoteHistory] = {}
+    self.midi_note_history: Dict[int, NoteHistory] = {}
+    # The chord(s) the active notes form (bass-rooted first, see Chord.exact_chords())
+    # or, if they don't form one, the chord they imply (None if none), looked up
+    # every frame from the mask of the active pitch classes and the bass pitch class
+    self.chord_mask = 0
+    self.chord_bass_pc = None
+    self.chords = ()
+    self.implied_chord = None
+    # The key of the recent notes (None while undecided) for colour and spelling
+    # decisions, estimated every frame from the MIDI and mic note-ons
+    self.key_estimator = KeyEstimator()
+    self.key = None
 
     # Currently active colour animations - these are the animations that are
-    # currently contributing to the total colour of the LEDs. They are mapped
-    # to the midi note name that they are animating.
-    self.active_animations: Dict[str, NoteColourAnimation] = {}
-    # Used to track if the colour has changed
-    self.prev_total_colour = np.array(
-      [math.nan, math.nan, math.nan], dtype=np.float32
-    )
+    # currently contributing to the total colour of the LEDs, one slot per
+    # MIDI note number.
+    self.animation_engine = AnimationEngine(blend=args.blend)
+    # The callbacks are registered by run()/run_offline(), since a copy of the
+    # event monitor handed to another process leaves them behind
     self.event_monitor = event_monitor
-    self.register_callbacks()
+
+  # The LEDs are dark and nothing is animating, so nothing can change until an event arrives
+  def is_idle(self):
+    return self.animation_engine.num_active() == 0 and all(zone.is_dark() for zone in self.zones)
+
+  def _open_outputs(self):
+    for zone in self.zones:
+      zone.open(self.args.no_hw, self.latency_stats)
+    if self.args.record:
+      # The zones' LEDs one after the other
+      self.frame_recorder = FrameRecorder(self.args.record, self.num_leds)
+
+  def _close_outputs(self):
+    for zone in self.zones:
+      zone.close()
+    if self.frame_recorder is not None:
+      self.frame_recorder.close()
+    if self.latency_stats is not None:
+      self.latency_stats.report()
 
   def run(self):
+    FRAME_STATS_INTERVAL_S = 5.0
+    self.register_callbacks()
+    self._open_outputs()
     try:
-      last_time = time.time()
+      scheduler = FrameScheduler(self.args.fps)
+      last_time = scheduler.begin_frame()
+      self.run_start_time = last_time
+      last_stats_time = last_time
       while True:
-        # NO BLOCKING HERE: We need animations to continue updating
-        # even if there are no events to process
+        # Sleep until the next frame is due or until an event arrives, whichever
+        # comes first. When idle there's nothing to animate, so just wait for an event.
+        self.event_monitor.wait_for_events(timeout=scheduler.wait_timeout(self.is_idle()))
+
+        current_time = scheduler.begin_frame()
+        self.frame_start_time = current_time
         self.event_monitor.process_events()
+        self._update_harmony()
 
         # Update the colour of the LEDs via the active animations
-        current_time = time.time()
         dt = current_time - last_time
         self.update_colour(dt)
         last_time = current_time
+        scheduler.end_frame()
+        self._update_metrics(scheduler)
+
+        if (self.args.print_frame_stats or self.args.latency_stats) and current_time - last_stats_time >= FRAME_STATS_INTERVAL_S:
+          if self.args.print_frame_stats:
+            scheduler.report()
+            self.event_monitor.report()
+            for zone in self.zones:
+              zone.writer.report()
+          if self.args.latency_stats:
+            self.latency_stats.report()
+          last_stats_time = current_time
     except KeyboardInterrupt:
       # For Ctrl+C to work cleanly
       print("Animator terminated. Exiting...")
+    finally:
+      self._close_outputs()
+
+  # Renders --midi-file in simulated time (see --offline): every frame is exactly one
+  # frame period after the previous one and sees exactly the MIDI messages before it,
+  # however long anything takes, so recordings of the same file match exactly.
+  def run_offline(self, midi_note_detector: MidiNoteDetector):
+    frame_period_s = 1.0 / self.args.fps
+    self.register_callbacks()
+    self._open_outputs()
+    try:
+      def render_frame(time_s):
+        self.frame_start_time = time_s
+        self.event_monitor.process_events()
+        self._update_harmony()
+        self.update_colour(frame_period_s)
+        return self.is_idle()
+      midi_note_detector.render_midi_file(self.args.midi_file, frame_period_s, render_frame)
+    finally:
+      self._close_outputs()
+
+  # Updates the key and the chord of the active notes after the frame's events
+  def _update_harmony(self):
+    source = KeyEstimator.SOURCE_MIDI if self.connected_midi else KeyEstimator.SOURCE_MIC
+    self.key_estimator.decay_to(self.frame_start_time, source)
+    key = self.key_estimator.estimate_key()
+    key_changed = key != self.key
+    if key_changed:
+      self.key = key
+      if self.args.print_chords:
+        print("Key:", key.name() if key is not None else "-")
+    self._update_chord(key_changed)
+
+  def _update_chord(self, respell: bool = False):
+    mask = 0
+    bass_note = None
+    for midi_note in self.active_notes:
+      mask |= 1 << (midi_note % NUM_PITCH_CLASSES)
+      if bass_note is None or midi_note < bass_note:
+        bass_note = midi_note
+    bass_pc = bass_note % NUM_PITCH_CLASSES if bass_note is not None else None
+    if mask == self.chord_mask and bass_pc == self.chord_bass_pc:
+      if respell and self.args.print_chords and mask != 0:
+        self._print_chord()
+      return
+    self.chord_mask = mask
+    self.chord_bass_pc = bass_pc
+    self.chords = exact_chords(mask, bass_pc)
+    self.implied_chord = None
+    if len(self.chords) == 0 and bass_pc is not None:
+      self.implied_chord = implied_chord_of_mask(mask, bass_pc)
+    if self.args.print_chords:
+      self._print_chord()
+
+  def _print_chord(self):
+    implied = " (implies %s)" % self.implied_chord.name(self.key) if self.implied_chord is not None else ""
+    print("Chord: %s%s" % (name_from_midi_notes(self.active_notes, self.key) or "-", implied))
+
+  def _update_metrics(self, scheduler: FrameScheduler):
+    metrics = self.metrics
+    metrics.set("chromesthesia_animator_frames_total", scheduler.total_frames)
+    metrics.set("chromesthesia_animator_frame_overruns_total", scheduler.total_overruns)
+    metrics.inc("chromesthesia_animator_frame_seconds_total", scheduler.last_frame_time_s)
+    metrics.set("chromesthesia_animator_frame_seconds", scheduler.last_frame_time_s)
+    metrics.set("chromesthesia_animator_events_total", self.event_monitor.total_drained_events)
+    metrics.set("chromesthesia_animator_frame_events", self.event_monitor.drained_events)
+    metrics.set("chromesthesia_events_coalesced_total", self.event_monitor.coalesced_events)
+    writers = [zone.writer for zone in self.zones]
+    metrics.set("chromesthesia_led_frames_written_total", sum(writer.frames_written for writer in writers))
+    metrics.set("chromesthesia_led_frames_skipped_total", sum(writer.frames_skipped for writer in writers))
+    metrics.set("chromesthesia_led_write_seconds_total", sum(writer.write_time_s for writer in writers))
 
   def update_colour(self, dt):
     dt = min(dt, 0.1) # Cap the delta time to prevent large jumps in colour
 
-    if self.args.print_colours:
-      animated_notes = set()
-
-    notes_already_seen = {}
-    filtered_anims = {}
-    for midi_note_name, note_colour_anim in self.active_animations.items():
-      note_name, _ = note_data_from_midi_name(midi_note_name)
-      anim = note_colour_anim.animation
-      curr_brightness = anim.update(dt)
-      if note_name in notes_already_seen:
-        if curr_brightness > notes_already_seen[note_name]:
-          notes_already_seen[note_name] = curr_brightness
-          filtered_anims[midi_note_name] = self.active_animations[midi_note_name]
-      else:
-        notes_already_seen[note_name] = curr_brightness
-        filtered_anims[midi_note_name] = self.active_animations[midi_note_name]
-
-    note_colours = []
-    brightnesses = []
-    for midi_note_name, note_colour_anim in list(self.active_animations.items()):
-      note_colour = note_colour_anim.note_colour
-      anim = note_colour_anim.animation
-
-      # Use the original note colour as the basis for blending
-      # and keep track of the maximum current intensity to scale the final colour.
-      curr_brightness = anim.curr_value
-      assert 0.0 <= curr_brightness <= 1.0
-
-      if midi_note_name in filtered_anims:
-        brightnesses.append(curr_brightness)
-        note_colours.append(note_colour)
-
-      # If the animation is done and no longer contributes colour then we remove it
-      if anim.is_done() and curr_brightness == 0.0:
-        del self.active_animations[midi_note_name]
-      elif self.args.print_colours:
-        animated_notes.add(midi_note_name)
-
-    total_brightness = np.sum(brightnesses)
-    total_colour = np.copy(Animator.OFF_COLOUR)
-    if total_brightness > 0.0 and len(note_colours) > 0:
-      #max_idx = np.argmax(brightnesses)
-      #total_colour = note_colours[max_idx] * brightnesses[max_idx]
-      for brightness, note_colour in zip(brightnesses, note_colours):
-        total_colour = note_colour * brightness + (1.0 - brightness/total_brightness) * total_colour
-
-      np.nan_to_num(total_colour, copy=False, nan=0.0)
-      np.clip(total_colour, 0.0, 1.0, out=total_colour)
-
-    if not np.array_equal(self.prev_total_colour, total_colour):
-      if self.pixels is not None:
-        self.pixels.fill((
-          gamma(round(total_colour[0]*255)),
-          gamma(round(total_colour[1]*255)),
-          gamma(round(total_colour[2]*255))
-        ))
-        self.pixels.show()
-      if self.args.print_colours:
-        print(", ".join(animated_notes), total_colour)
+    # Advance every note's animation and blend the colours of the brightest
+    # note of each pitch class
+    total_colour = self.animation_engine.update(dt)
 
-    self.prev_total_colour = total_colour
+    if self.latency_stats is not None:
+      self._gather_event_records()
 
+    # Every zone's writer sends its frame in parallel with the others
+    changed = False
+    for zone in self.zones:
+      if zone.update(self.animation_engine, total_colour, self.unseen_event_records):
+        # The events are followed through the first zone they change
+        self.unseen_event_records = self.unseen_event_records[:0]
+        changed = True
 
-  def note_on_animation(self, midi_note_name: str, note_data: NoteData):
+    if changed:
+      if self.frame_recorder is not None:
+        self._record_frame()
+      if self.args.print_colours:
+        animated_notes = [
+          MIDI_NOTE_NAMES[note]
+          for note in self.animation_engine.active_notes if self.animation_engine.is_active(note)
+        ]
+        print(", ".join(animated_notes), total_colour)
+
+  def _record_frame(self):
+    time_s = self.frame_start_time - self.run_start_time
+    if len(self.zones) == 1:
+      self.frame_recorder.record(time_s, self.zones[0].led_values)
+    else:
+      self.frame_recorder.record(time_s, np.concatenate([zone.led_values for zone in self.zones]))
+
+  # Keeps the records of the note events that haven't changed the LEDs yet, so
+  # they're handed to the LED writer with the first frame they change
+  def _gather_event_records(self):
+    records = self.event_monitor.processed_note_records
+    if records.size > 0:
+      self.unseen_event_records = np.concatenate([self.unseen_event_records, records])
+    if self.unseen_event_records.size > 0:
+      timed_out = self.unseen_event_records['timestamp'] <= time.monotonic() - self.LATENCY_TIMEOUT_S
+      if np.any(timed_out):
+        self.unseen_event_records = self.unseen_event_records[~timed_out]
+
+  def note_on_animation(self, note_data: NoteData):
+    engine = self.animation_engine
+    midi_note = note_data.note
     curr_anim_value = 0.0
-    if midi_note_name in self.active_animations:
-      curr_anim_value = self.active_animations[midi_note_name].animation.curr_value
+    if engine.is_active(midi_note):
+      curr_anim_value = engine.curr_value[midi_note]
     else:
       # Check whether the same note is already active (regardless of octave)
-      note_name, _ = note_data_from_midi_name(midi_note_name)
-      possible_midi_names = generate_all_possible_midi_names(note_name)
-      active_similar_anims = {k:v for k,v in self.active_animations.items() if k in possible_midi_names}
+      similar_notes = engine.active_notes_in_pitch_class(midi_note)
       # If there are similar note(s) already active then we set the current brightness animation
       # to the already animating value of the highest brightness note
-      for v in active_similar_anims.values():
-        if v.animation.curr_value > curr_anim_value:
-          curr_anim_value = v.animation.curr_value
-      for note_colour_anim in active_similar_anims.values():
-        note_colour_anim.animation.curr_value = curr_anim_value
+      if similar_notes.size > 0:
+        curr_anim_value = max(curr_anim_value, float(engine.curr_value[similar_notes].max()))
+        engine.curr_value[similar_notes] = curr_anim_value
 
     # Create the new animation
     # TODO: Consider using the distance between the curr_anim_value and 1.0 to determine the duration
     # of the brightness increase?
-    rgb_note_colour = note_to_rgb(note_data.note_name, note_data.intensity)
-    self.active_animations[midi_note_name] = NoteColourAnimation(
-      note_colour=rgb_note_colour,
-      animation=Animation(
-        curr_anim_value,
-        1.0,
-        Animator.DEFAULT_ANIM_FADE_IN_TIME_S,
-        sqrtstep
-      )
+    # The note keeps its palette colour (see NoteUtils.MIDI_NOTE_COLOURS)
+    engine.start(
+      midi_note,
+      curr_anim_value,
+      1.0,
+      Animator.DEFAULT_ANIM_FADE_IN_TIME_S,
+      AnimationEngine.CURVE_SQRTSTEP
     )
 
-  def note_off_animation(self, midi_note_name: str):
-    if midi_note_name in self.active_animations:
+  def note_off_animation(self, midi_note: int):
+    engine = self.animation_engine
+    if engine.is_active(midi_note):
       # Fade-out the note
       # TODO: Consider using the distance between the curr_anim_value and 0.0 to determine the duration
       # of the brightness decrease?
-      note_anim = self.active_animations[midi_note_name].animation
-      curr_anim_value = note_anim.curr_value
-      note_anim.reset(
-        curr_anim_value,
+      engine.start(
+        midi_note,
+        float(engine.curr_value[midi_note]),
         0.0,
         Animator.DEFAULT_ANIM_FADE_OUT_TIME_S,
-        smoothstep
+        AnimationEngine.CURVE_SMOOTHSTEP
       )
 
-  def on_disconnect_remove_notes(self, issuer: str):
+  def on_disconnect_remove_notes(self, issuer: Issuer):
     notes_to_remove = []
     for k,v in self.active_notes.items():
-      if v.issuers.difference({issuer}) == set():
+      if v.issuers.difference({issuer.name}) == set():
         notes_to_remove.append(k)
       else:
-        v.issuers.discard(issuer)
+        v.issuers.discard(issuer.name)
     for k in notes_to_remove:
       del self.active_notes[k]
       self.note_off_animation(k)
-    if issuer == EventMonitor.EVENT_ISSUER_MIDI:
+    if issuer.kind == EventMonitor.EVENT_ISSUER_MIDI:
       for k in notes_to_remove:
         self.midi_note_history[k].end_time = time.time()
 
-  def remove_active_note(self, midi_note_name: str, issuer: str):
-    note_data = self.active_notes.get(midi_note_name, None)
+  def remove_active_note(self, midi_note: int, issuer: Issuer):
+    note_data = self.active_notes.get(midi_note, None)
     if note_data is not None:
-      note_data.issuers.discard(issuer)
+      note_data.issuers.discard(issuer.name)
       if len(note_data.issuers) == 0:
-        if issuer == EventMonitor.EVENT_ISSUER_MIDI:
-          self.midi_note_history[midi_note_name].end_time = time.time()
-        del self.active_notes[midi_note_name]
-        self.note_off_animation(midi_note_name)
+        if issuer.kind == EventMonitor.EVENT_ISSUER_MIDI:
+          self.midi_note_history[midi_note].end_time = time.time()
+        del self.active_notes[midi_note]
+        self.note_off_animation(midi_note)
 
   # The main thread will run the event monitor and the note detectors
   # in separate threads. The note detectors will interact with each other
   # through the event monitor which calls the following callback
-  # functions in the Animator:
+  # functions in the Animator, with the issuer (MIDI port or mic) the event
+  # came from:
 
   # ****** START OF CALLBACK FUNCTIONS ******
-  def on_midi_connected(self):
-    print("MIDI connected.")
-    self.is_midi_connected = True
+  def on_midi_connected(self, issuer: Issuer):
+    print("%s connected." % issuer.name)
+    self.connected_midi.add(issuer.name)
 
-  def on_midi_disconnected(self):
-    print("MIDI disconnected.")
-    self.is_midi_connected = False
-    # Remove midi-only active notes
-    self.on_disconnect_remove_notes(EventMonitor.EVENT_ISSUER_MIDI)
+  def on_midi_disconnected(self, issuer: Issuer):
+    print("%s disconnected." % issuer.name)
+    self.connected_midi.discard(issuer.name)
+    # Remove the notes only this port was holding
+    self.on_disconnect_remove_notes(issuer)
 
-  def on_midi_note_on(self, note_data: NoteData):
+  def on_midi_note_on(self, issuer: Issuer, note_data: NoteData):
     if self.args.print_events:
-      print("MIDI note on: ", note_data)
-    midi_note_name = midi_name_from_note_data(note_data)
-    self.note_on_animation(midi_note_name, note_data)
-    active_note = self.active_notes.get(midi_note_name, None)
+      print("%s note on: " % issuer.name, note_data)
+    midi_note = note_data.note
+    self.note_on_animation(note_data)
+    self.key_estimator.add_note_on(midi_note, note_data.intensity)
+    active_note = self.active_notes.get(midi_note, None)
     if active_note is None:
-      self.active_notes[midi_note_name] = note_data
+      self.active_notes[midi_note] = note_data
     else:
       active_note.intensity = note_data.intensity
-      active_note.issuers.add(EventMonitor.EVENT_ISSUER_MIDI)
+      active_note.issuers.add(issuer.name)
 
-    note_history = self.midi_note_history.get(midi_note_name, None)
+    note_history = self.midi_note_history.get(midi_note, None)
     if note_history is None:
       note_history = NoteHistory()
-      self.midi_note_history[midi_note_name] = note_history
+      self.midi_note_history[midi_note] = note_history
     note_history.start_time = time.time()
 
-  def on_midi_note_off(self, note_data: NoteData):
+  def on_midi_note_off(self, issuer: Issuer, note_data: NoteData):
     if self.args.print_events:
-      print("MIDI note off: ", note_data)
-    midi_note_name = midi_name_from_note_data(note_data)
-    # If the mic is still detecting the note then we shouldn't fade out
+      print("%s note off: " % issuer.name, note_data)
+    midi_note = note_data.note
+    # If a mic is still detecting the note then we shouldn't fade out
     # until the mic stops detecting the note.
-    if self.is_mic_connected:
-      active_note = self.active_notes.get(midi_note_name, None)
-      if active_note is not None and EventMonitor.EVENT_ISSUER_MIC in active_note.issuers:
+    if self.connected_mics:
+      active_note = self.active_notes.get(midi_note, None)
+      if active_note is not None and not active_note.issuers.isdisjoint(self.mic_issuers):
         return
-    self.remove_active_note(midi_note_name, EventMonitor.EVENT_ISSUER_MIDI)
+    self.remove_active_note(midi_note, issuer)
 
-  def on_mic_connected(self):
-    print("MIC connected.")
-    self.is_mic_connected = True
+  def on_mic_connected(self, issuer: Issuer):
+    print("%s connected." % issuer.name)
+    self.connected_mics.add(issuer.name)
 
-  def on_mic_disconnected(self):
-    print("MIC disconnected.")
-    self.is_mic_connected = False
-    # Remove mic-only active notes
-    self.on_disconnect_remove_notes(EventMonitor.EVENT_ISSUER_MIC)
+  def on_mic_disconnected(self, issuer: Issuer):
+    print("%s disconnected." % issuer.name)
+    self.connected_mics.discard(issuer.name)
+    # Remove the notes only this mic was holding
+    self.on_disconnect_remove_notes(issuer)
 
-  def on_mic_note_on(self, note_data):
+  def on_mic_note_on(self, issuer: Issuer, note_data: NoteData):
     if self.args.print_events:
-      print("MIC note on: ", note_data)
+      print("%s note on: " % issuer.name, note_data)
 
-    midi_note_name = midi_name_from_note_data(note_data)
-    active_note = self.active_notes.get(midi_note_name, None)
-    if not self.args.no_midi_priority and self.is_midi_connected:
+    midi_note = note_data.note
+    active_note = self.active_notes.get(midi_note, None)
+    if not self.args.no_midi_priority and self.connected_midi:
       pass
     else:
-      self.note_on_animation(midi_note_name, note_data)
+      self.note_on_animation(note_data)
+      self.key_estimator.add_note_on(midi_note, note_data.intensity)
       if active_note is None:
-        self.active_notes[midi_note_name] = note_data
+        self.active_notes[midi_note] = note_data
       else:
         #active_note.intensity = note_data.intensity # Intensity isn't properly implemented for mic yet
-        active_note.issuers.add(EventMonitor.EVENT_ISSUER_MIC)
+        active_note.issuers.add(issuer.name)
 
-  def on_mic_note_off(self, note_data):
+  def on_mic_note_off(self, issuer: Issuer, note_data: NoteData):
     if self.args.print_events:
-      print("MIC note off: ", note_data)
-    midi_note_name = midi_name_from_note_data(note_data)
-    self.remove_active_note(midi_note_name, EventMonitor.EVENT_ISSUER_MIC)
+      print("%s note off: " % issuer.name, note_data)
+    midi_note = note_data.note
+    self.remove_active_note(midi_note, issuer)
 
   # ****** END OF CALLBACK FUNCTIONS ******
 
+  # Registers the callbacks of every issuer's kind, bound to the issuer
   def register_callbacks(self):
-    self.event_monitor.set_event_callback(
-      EventMonitor.EVENT_ISSUER_MIDI,
-      EventMonitor.EVENT_TYPE_CONNECTED,
-      self.on_midi_connected)
-    self.event_monitor.set_event_callback(
-      EventMonitor.EVENT_ISSUER_MIDI,
-      EventMonitor.EVENT_TYPE_DISCONNECTED,
-      self.on_midi_disconnected)
-    self.event_monitor.set_event_callback(
-      EventMonitor.EVENT_ISSUER_MIDI,
-      EventMonitor.EVENT_TYPE_NOTE_ON,
-      self.on_midi_note_on)
-    self.event_monitor.set_event_callback(
-      EventMonitor.EVENT_ISSUER_MIDI,
-      EventMonitor.EVENT_TYPE_NOTE_OFF,
-      self.on_midi_note_off)
-    self.event_monitor.set_event_callback(
-      EventMonitor.EVENT_ISSUER_MIC,
-      EventMonitor.EVENT_TYPE_CONNECTED,
-      self.on_mic_connected)
-    self.event_monitor.set_event_callback(
-      EventMonitor.EVENT_ISSUER_MIC,
-      EventMonitor.EVENT_TYPE_DISCONNECTED,
-      self.on_mic_disconnected)
-    self.event_monitor.set_event_callback(
-      EventMonitor.EVENT_ISSUER_MIC,
-      EventMonitor.EVENT_TYPE_NOTE_ON,
-      self.on_mic_note_on)
-    self.event_monitor.set_event_callback(
-      EventMonitor.EVENT_ISSUER_MIC,
-      EventMonitor.EVENT_TYPE_NOTE_OFF,
-      self.on_mic_note_off)
+    callbacks = {
+      EventMonitor.EVENT_ISSUER_MIDI: {
+        EventMonitor.EVENT_TYPE_CONNECTED: self.on_midi_connected,
+        EventMonitor.EVENT_TYPE_DISCONNECTED: self.on_midi_disconnected,
+        EventMonitor.EVENT_TYPE_NOTE_ON: self.on_midi_note_on,
+        EventMonitor.EVENT_TYPE_NOTE_OFF: self.on_midi_note_off,
+      },
+      EventMonitor.EVENT_ISSUER_MIC: {
+        EventMonitor.EVENT_TYPE_CONNECTED: self.on_mic_connected,
+        EventMonitor.EVENT_TYPE_DISCONNECTED: self.on_mic_disconnected,
+        EventMonitor.EVENT_TYPE_NOTE_ON: self.on_mic_note_on,
+        EventMonitor.EVENT_TYPE_NOTE_OFF: self.on_mic_note_off,
+      },
+    }
+    for issuer in self.event_monitor.issuers:
+      for event_type, callback in callbacks[issuer.kind].items():
+        self.event_monitor.set_event_callback(issuer.name, event_type, functools.partial(callback, issuer))
 
 
 if __name__ == '__main__':
@@ -340,35 +441,109 @@ if __name__ == '__main__':
     description="Chromesthesia - LED colouring based on music notes.",
     formatter_class=argparse.ArgumentDefaultsHelpFormatter
   )
-  args.add_argument("--midi-port-name", type=str, default="USB MIDI Interface", help="Name of the MIDI port to connect to.")
+  args.add_argument("--midi-port-name", type=str, action="append", default=None, help="Name (or part of it) of a MIDI port to connect to (default: %s). Repeat to play several ports at once, each as its own input; a name given N times connects to the first N ports it matches." % MidiNoteDetector.DEFAULT_PORT_NAME)
+  args.add_argument("--midi-input", type=str, choices=MidiNoteDetector.MIDI_INPUT_MODES, default=MidiNoteDetector.MIDI_INPUT_CALLBACK, help="How MIDI messages are received: delivered by the MIDI backend's callback as they arrive, or polled for (for backends without callbacks).")
   args.add_argument("--no-midi-priority", action="store_true", default=False, help="Don't give MIDI priority over mic (active only when midi is connected).")
+  args.add_argument("--print-chords", action="store_true", default=False, help="Print the chord the active notes form, and their estimated key, whenever they change.")
   args.add_argument("--print-colours", action="store_true", default=False, help="Print debug messages showing the RGB.")
   args.add_argument("--print-events", action="store_true", default=False, help="Print debug messages showing the events.")
-  args.add_argument("--no-hw", action="store_true", default=False, help="Don't use hardware, just print debug messages.")
+  args.add_argument("--no-hw", action="store_true", default=False, help="Don't use hardware, just print debug messages (same as --output null).")
+  args.add_argument("--output", type=str, choices=LED_OUTPUTS, default=LED_OUTPUT_NEOPIXEL, help="Where the LED frames are sent: a NeoPixel strip on the SPI bus, nowhere, a DDP receiver over UDP or nowhere but as slowly as a NeoPixel strip would take them (a simulated strip).")
+  args.add_argument("--spi-bus", type=int, default=0, help="SPI bus the NeoPixel strip is on, 0 for the board's default bus.")
+  args.add_argument("--led-zones", type=str, default=None, help="JSON file of LED zones to drive at once (see LedZones.load_zone_configs()), each strip with its own output, SPI bus, LED count, mapping and brightness. Fields a zone leaves out take the value of the flag of the same name.")
+  args.add_argument("--ddp-host", type=str, default=None, help="Host (e.g. a WLED controller) to send the frames to with --output ddp.")
+  args.add_argument("--ddp-port", type=int, default=DDP_PORT, help="UDP port of the DDP receiver.")
   args.add_argument("--num-leds", type=int, default=19, help="Number of LEDs in the strip.")
+  args.add_argument("--led-mapping", type=str, choices=LED_MAPPINGS, default=LED_MAPPING_FILL, help="How notes are laid out on the strip: the blended colour on every LED, a segment per pitch class or a piano keyboard.")
   args.add_argument("--brightness", type=float, default=1.0, help="LED brightness, must be a value in [0,1].")
-  args = args.parse_args()
-
-  event_monitor = EventMonitor()
+  args.add_argument("--dither", action="store_true", default=False, help="Temporally dither the LED values so slow, dim fades don't band.")
+  args.add_argument("--blend", type=str, choices=AnimationEngine.BLENDS, default=AnimationEngine.BLEND_RGB, help="Colour space the colours of simultaneous notes are blended in: raw RGB or perceptual Oklab/OkLCh.")
+  args.add_argument("--latency-stats", action="store_true", default=False, help="Periodically (and on exit) print the p50/p95/p99 latency from MIDI/mic input to the LEDs changing, per input.")
+  args.add_argument("--metrics-port", type=int, default=None, help="Serve live metrics of every stage (frame times, event queues, mic analysis, MIDI messages, ...) in the Prometheus text format on this port.")
+  args.add_argument("--metrics-host", type=str, default="127.0.0.1", help="Address to serve the metrics on, e.g. 0.0.0.0 to scrape them from another machine.")
+  args.add_argument("--record", type=str, default=None, help="Record every frame sent to the LEDs, with its time, into this .npy file (compare recordings with compare_recordings.py).")
+  args.add_argument("--fps", type=float, default=120.0, help="Target LED animation frame rate.")
+  args.add_argument("--print-frame-stats", action="store_true", default=False, help="Periodically print the Animator's frame rate, frame times and frame overruns.")
+  args.add_argument("--pitch-engine", type=str, choices=PITCH_ENGINES, default=PITCH_ENGINE_PYIN, help="Mic pitch detection engine: full librosa.pyin per window, the incremental streaming tracker or the polyphonic chroma pipeline of the web view.")
+  args.add_argument("--mic-workers", type=int, default=0, help="Analyse the mic audio with this many pyin worker processes (e.g. one per core), 0 analyses it in the mic process.")
+  args.add_argument("--tuning-hz", type=float, default=A4_FREQUENCY_HZ, help="Frequency (Hz) of A4 the mic's notes are relative to, e.g. 432 or 442 for instruments not tuned to 440.")
+  args.add_argument("--note-hysteresis-cents", type=float, default=NoteQuantiser.DEFAULT_HYSTERESIS_CENTS, help="How far (cents) past the half-way point to the next note a pyin pitch stays on the note it was on, so a pitch wavering between two notes doesn't flicker between them.")
+  args.add_argument("--start-method", type=str, choices=multiprocessing.get_all_start_methods(), default=None, help="How the Animator and detector processes are started (default: the platform's, fork on Linux): spawn starts each in a fresh interpreter that only loads what it uses, fork copies this process (which never loads librosa either, only the mic process does).")
+  args.add_argument("--midi-file", type=str, default=None, help="Play this standard MIDI file (.mid) through the MIDI note detector instead of listening to a MIDI port.")
+  args.add_argument("--offline", action="store_true", default=False, help="Render --midi-file in simulated time at exactly --fps, as fast as possible and without the mic, then exit (for reproducible --record recordings).")
+  args.add_argument("--midi-file-speed", type=float, default=1.0, help="Playback speed multiplier for --midi-file, 0 plays as fast as possible.")
+  args.add_argument("--mic-device", type=str, action="append", default=None, help="Name (or part of it) of an audio input device to detect notes in (default: the built-in microphone). Repeat to listen to several inputs at once, each as its own input.")
+  args.add_argument("--mic-file", type=str, default=None, help="Replay this audio file (e.g., WAV/FLAC) through the mic note detector instead of listening to a microphone.")
+  args.add_argument("--mic-file-speed", type=float, default=1.0, help="Playback speed multiplier for --mic-file, 0 replays as fast as possible.")
+  parser = args
+  args = parser.parse_args()
+  if args.offline and not args.midi_file:
+    parser.error("--offline needs a --midi-file to render")
+  if args.output == LED_OUTPUT_DDP and not args.no_hw and not args.ddp_host:
+    parser.error("--output ddp needs a --ddp-host to send to")
+  if args.mic_workers > 0 and args.pitch_engine != PITCH_ENGINE_PYIN:
+    parser.error("--mic-workers only works with the pyin pitch engine (the other engines carry their state from hop to hop)")
+  if args.tuning_hz <= 0.0:
+    parser.error("--tuning-hz must be a positive frequency")
+  if args.note_hysteresis_cents < 0.0:
+    parser.error("--note-hysteresis-cents can't be negative")
+  try:
+    zone_configs = led_zone_configs(args)
+  except (OSError, ValueError) as e:
+    parser.error("--led-zones: %s" % e if args.led_zones else str(e))
+  if args.start_method is not None:
+    # Before anything (e.g., the EventMonitor's Event) is made for the other processes
+    multiprocessing.set_start_method(args.start_method)
+
+  # One note detector (and event issuer) per MIDI port and mic, a file is played through one
+  midi_port_names = [None] if args.midi_file or not args.midi_port_name else args.midi_port_name
+  mic_device_names = [None] if args.mic_file or not args.mic_device else args.mic_device
+  event_monitor = EventMonitor(make_issuers(len(midi_port_names), len(mic_device_names)))
+  # Every process updates its own metrics, the metrics server (if any) runs in this one
+  metrics = Metrics(issuers=event_monitor.issuer_names)
+  metrics_server = None
+  if args.metrics_port is not None:
+    metrics_server = MetricsServer(metrics, args.metrics_host, args.metrics_port, collect=lambda: event_monitor.update_metrics(metrics))
+    print("Serving metrics at http://%s:%d/metrics" % (args.metrics_host, metrics_server.port))
+
+  if args.offline:
+    animator = Animator(event_monitor, args, metrics, zone_configs)
+    animator.run_offline(MidiNoteDetector(event_monitor, args, metrics))
+    event_monitor.close()
+    metrics.close()
+    raise SystemExit(0)
 
   # The microphone note detector and the midi note detector will each
   # run in their own threads and interact with each other through this
   # main thread via a shared event monitor with registered callbacks.
-  animator = Animator(event_monitor, args)
-  midi_note_detector = MidiNoteDetector(event_monitor, args)
-  midi_note_detector.start()
-  mic_note_detector = MicNoteDetector(event_monitor, args)
-  mic_note_detector.start()
+  # The Animator starts first so the LEDs come up while the detectors are still
+  # loading (events sent before it's running wait in the event rings).
+  animator = Animator(event_monitor, args, metrics, zone_configs)
   animator.start()
+  midi_issuers = [issuer for issuer in event_monitor.issuers if issuer.kind == EventMonitor.EVENT_ISSUER_MIDI]
+  mic_issuers = [issuer for issuer in event_monitor.issuers if issuer.kind == EventMonitor.EVENT_ISSUER_MIC]
+  note_detectors = []
+  for i, (issuer, port_name) in enumerate(zip(midi_issuers, midi_port_names)):
+    # The same name given again is the next port it matches
+    port_index = midi_port_names[:i].count(port_name)
+    note_detectors.append(MidiNoteDetector(event_monitor, args, metrics, issuer.name, port_name, port_index))
+  for issuer, device_name in zip(mic_issuers, mic_device_names):
+    note_detectors.append(MicNoteDetector(event_monitor, args, metrics, issuer.name, device_name))
+  for note_detector in note_detectors:
+    note_detector.start()
 
   try:
     animator.join()
-    midi_note_detector.join()
-    mic_note_detector.join()
+    for note_detector in note_detectors:
+      note_detector.join()
   except KeyboardInterrupt:
     # For Ctrl+C to work cleanly
     pass
 
   animator.terminate()
-  mic_note_detector.terminate()
-  midi_note_detector.terminate()
+  for note_detector in note_detectors:
+    note_detector.terminate()
+  if metrics_server is not None:
+    metrics_server.close()
+  event_monitor.close()
+  metrics.close()
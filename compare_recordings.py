@@ -0,0 +1,37 @@
+"""Compare two LED frame recordings (made with chromesthesia.py --record) and
+exit non-zero if they differ by more than the given tolerances.
+
+Record the same MIDI or audio file before and after a change, e.g.:
+  python3 chromesthesia.py --no-hw --midi-file song.mid --record before.npy
+  python3 chromesthesia.py --no-hw --midi-file song.mid --record after.npy
+  python3 compare_recordings.py before.npy after.npy --align --time-tolerance 0.02
+
+Run: python3 compare_recordings.py A.npy B.npy [--tolerance L] [--time-tolerance S] [--align]
+"""
+import argparse
+import sys
+
+from FrameRecording import compare_recordings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("recording_a", help="First recording (.npy).")
+    parser.add_argument("recording_b", help="Second recording (.npy).")
+    parser.add_argument("--tolerance", type=int, default=0, help="Largest allowed difference of any LED channel, in LED levels (0-255).")
+    parser.add_argument("--time-tolerance", type=float, default=0.0, help="Seconds a frame may be early or late in the other recording.")
+    parser.add_argument("--align", action="store_true", default=False, help="Line the recordings up on their first lit frame (for recordings of real time playback).")
+    args = parser.parse_args()
+
+    comparison = compare_recordings(args.recording_a, args.recording_b, args.tolerance, args.time_tolerance, args.align)
+    if comparison.matches:
+        print("Recordings match: %d frames compared" % comparison.frames_compared)
+        return 0
+    print("Recordings differ: %d of %d frames mismatched (max difference %d levels), first at %.3fs" % (
+        comparison.mismatched_frames, comparison.frames_compared, comparison.max_difference,
+        comparison.first_mismatch_time_s))
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,223 @@
+"""Parity tests for the vectorized AnimationEngine.
+
+The Animator used to keep a dict of per-note Animation objects and blend their
+colours in a Python loop. LegacyNoteAnimator below is that original code path,
+kept verbatim as the oracle: the engine must produce the same colours frame
+for frame, so swapping it in can't change the lights.
+
+Run: python3 -m unittest test_animation_engine
+"""
+import random
+import unittest
+
+import numpy as np
+
+from Animation import Animation, sqrtstep, smoothstep
+from AnimationEngine import AnimationEngine
+from ColourUtils import srgb_to_oklab, oklab_to_srgb
+from NoteUtils import (
+    MIDI_NOTE_COLOURS, note_to_rgb, note_data_from_midi_name, generate_all_possible_midi_names,
+    midi_name_from_midi_number, midi_number_from_midi_name,
+)
+
+FADE_IN_TIME_S = 0.05
+FADE_OUT_TIME_S = 0.1
+
+
+class LegacyNoteAnimator(object):
+    """The Animator's original dict-of-Animation note animation and blend."""
+
+    def __init__(self):
+        self.active_animations = {}
+
+    def note_on(self, midi_note_name):
+        curr_anim_value = 0.0
+        if midi_note_name in self.active_animations:
+            curr_anim_value = self.active_animations[midi_note_name][1].curr_value
+        else:
+            note_name, _ = note_data_from_midi_name(midi_note_name)
+            possible_midi_names = generate_all_possible_midi_names(note_name)
+            active_similar_anims = {k: v for k, v in self.active_animations.items() if k in possible_midi_names}
+            for v in active_similar_anims.values():
+                if v[1].curr_value > curr_anim_value:
+                    curr_anim_value = v[1].curr_value
+            for v in active_similar_anims.values():
+                v[1].curr_value = curr_anim_value
+        note_name, _ = note_data_from_midi_name(midi_note_name)
+        self.active_animations[midi_note_name] = (
+            note_to_rgb(note_name, 1.0),
+            Animation(curr_anim_value, 1.0, FADE_IN_TIME_S, sqrtstep),
+        )
+
+    def note_off(self, midi_note_name):
+        if midi_note_name in self.active_animations:
+            anim = self.active_animations[midi_note_name][1]
+            anim.reset(anim.curr_value, 0.0, FADE_OUT_TIME_S, smoothstep)
+
+    def update_colour(self, dt):
+        notes_already_seen = {}
+        filtered_anims = {}
+        for midi_note_name, (_, anim) in self.active_animations.items():
+            note_name, _ = note_data_from_midi_name(midi_note_name)
+            curr_brightness = anim.update(dt)
+            if note_name in notes_already_seen:
+                if curr_brightness > notes_already_seen[note_name]:
+                    notes_already_seen[note_name] = curr_brightness
+                    filtered_anims[midi_note_name] = self.active_animations[midi_note_name]
+            else:
+                notes_already_seen[note_name] = curr_brightness
+                filtered_anims[midi_note_name] = self.active_animations[midi_note_name]
+
+        note_colours = []
+        brightnesses = []
+        for midi_note_name, (note_colour, anim) in list(self.active_animations.items()):
+            curr_brightness = anim.curr_value
+            if midi_note_name in filtered_anims:
+                brightnesses.append(curr_brightness)
+                note_colours.append(note_colour)
+            if anim.is_done() and curr_brightness == 0.0:
+                del self.active_animations[midi_note_name]
+
+        total_brightness = np.sum(brightnesses)
+        total_colour = np.array([0., 0., 0.], dtype=np.float32)
+        if total_brightness > 0.0 and len(note_colours) > 0:
+            for brightness, note_colour in zip(brightnesses, note_colours):
+                total_colour = note_colour * brightness + (1.0 - brightness / total_brightness) * total_colour
+            np.nan_to_num(total_colour, copy=False, nan=0.0)
+            np.clip(total_colour, 0.0, 1.0, out=total_colour)
+        return total_colour
+
+
+class EngineNoteAnimator(object):
+    """The same note on/off policy driven through the AnimationEngine."""
+
+    def __init__(self, blend=AnimationEngine.BLEND_RGB):
+        self.engine = AnimationEngine(blend=blend)
+
+    def note_on(self, midi_note_name):
+        engine = self.engine
+        midi_note = midi_number_from_midi_name(midi_note_name)
+        curr_anim_value = 0.0
+        if engine.is_active(midi_note):
+            curr_anim_value = engine.curr_value[midi_note]
+        else:
+            similar_notes = engine.active_notes_in_pitch_class(midi_note)
+            if similar_notes.size > 0:
+                curr_anim_value = max(curr_anim_value, float(engine.curr_value[similar_notes].max()))
+                engine.curr_value[similar_notes] = curr_anim_value
+        note_name, _ = note_data_from_midi_name(midi_note_name)
+        engine.start(midi_note, curr_anim_value, 1.0, FADE_IN_TIME_S,
+                     AnimationEngine.CURVE_SQRTSTEP, colour=note_to_rgb(note_name, 1.0))
+
+    def note_off(self, midi_note_name):
+        midi_note = midi_number_from_midi_name(midi_note_name)
+        if self.engine.is_active(midi_note):
+            self.engine.start(midi_note, float(self.engine.curr_value[midi_note]), 0.0,
+                              FADE_OUT_TIME_S, AnimationEngine.CURVE_SMOOTHSTEP)
+
+    def update_colour(self, dt):
+        return self.engine.update(dt)
+
+
+def random_session(seed, num_frames=400, max_notes=88):
+    rng = random.Random(seed)
+    piano_notes = [midi_name_from_midi_number(n) for n in range(21, 21 + max_notes)]
+    steps = []
+    for _ in range(num_frames):
+        for _ in range(rng.randint(0, 4)):
+            steps.append((rng.choice(['on', 'off']), rng.choice(piano_notes)))
+        steps.append(('update', rng.choice([0.0, 0.004, 0.008, 0.0167, 0.03, 0.1])))
+    return steps
+
+
+class AnimationEngineParityTest(unittest.TestCase):
+    def run_both(self, steps):
+        legacy, engine = LegacyNoteAnimator(), EngineNoteAnimator()
+        for frame, (action, arg) in enumerate(steps):
+            if action == 'update':
+                expected = legacy.update_colour(arg)
+                actual = engine.update_colour(arg)
+                np.testing.assert_allclose(actual, expected, atol=1e-6, err_msg="frame %d" % frame)
+                self.assertEqual(
+                    sorted(midi_number_from_midi_name(name) for name in legacy.active_animations),
+                    np.flatnonzero(engine.engine.active).tolist(),
+                )
+            else:
+                getattr(legacy, 'note_' + action)(arg)
+                getattr(engine, 'note_' + action)(arg)
+
+    def test_random_sessions_match_legacy_colours(self):
+        for seed in range(20):
+            self.run_both(random_session(seed))
+
+    def test_dense_chords_match_legacy_colours(self):
+        steps = []
+        for name in [midi_name_from_midi_number(n) for n in range(21, 109)]:
+            steps += [('on', name), ('update', 0.008)]
+        for name in [midi_name_from_midi_number(n) for n in range(108, 20, -3)]:
+            steps += [('off', name), ('update', 0.02)]
+        steps += [('update', 0.1)] * 3
+        self.run_both(steps)
+
+    def test_engine_goes_dark_and_idle(self):
+        engine = EngineNoteAnimator()
+        engine.note_on('C4')
+        np.testing.assert_allclose(engine.update_colour(0.01), note_to_rgb('C', 1.0), atol=1e-6)
+        engine.note_off('C4')
+        for _ in range(20):
+            colour = engine.update_colour(0.01)
+        np.testing.assert_array_equal(colour, [0., 0., 0.])
+        self.assertEqual(engine.engine.num_active(), 0)
+
+
+class PerceptualBlendTest(unittest.TestCase):
+    def test_a_single_note_looks_the_same_in_every_blend(self):
+        steps = [('on', 'E4'), ('update', 0.01), ('update', 0.03), ('off', 'E4'), ('update', 0.02),
+                 ('on', 'E4'), ('update', 0.01), ('off', 'E4'), ('update', 0.05), ('update', 0.1)]
+        for blend in [AnimationEngine.BLEND_OKLAB, AnimationEngine.BLEND_OKLCH]:
+            rgb, perceptual = EngineNoteAnimator(), EngineNoteAnimator(blend)
+            for action, arg in steps:
+                if action == 'update':
+                    np.testing.assert_allclose(perceptual.update_colour(arg), rgb.update_colour(arg), atol=1e-6)
+                else:
+                    getattr(rgb, 'note_' + action)(arg)
+                    getattr(perceptual, 'note_' + action)(arg)
+
+    def test_two_notes_mix_in_oklab(self):
+        animator = EngineNoteAnimator(AnimationEngine.BLEND_OKLAB)
+        animator.note_on('C4')
+        animator.note_on('G4')
+        colour = animator.update_colour(0.01)
+        # Both notes are at full brightness: the sequential blend weighs C by 1/2 and G by 1
+        weights = np.array([0.5, 1.0])
+        lab = weights @ srgb_to_oklab([note_to_rgb('C', 1.0), note_to_rgb('G', 1.0)]) / weights.sum()
+        np.testing.assert_allclose(colour, oklab_to_srgb(lab), atol=1e-6)
+
+    def test_oklch_keeps_the_saturation_of_opposite_hues(self):
+        chroma = {}
+        for blend in [AnimationEngine.BLEND_OKLAB, AnimationEngine.BLEND_OKLCH]:
+            engine = AnimationEngine(blend=blend)
+            engine.start(60, 1.0, 1.0, 0.05, AnimationEngine.CURVE_SQRTSTEP, colour=[1.0, 0.0, 0.0])
+            engine.start(61, 1.0, 1.0, 0.05, AnimationEngine.CURVE_SQRTSTEP, colour=[0.0, 1.0, 1.0])
+            lab = srgb_to_oklab(engine.update(0.01))
+            chroma[blend] = np.hypot(lab[1], lab[2])
+        self.assertLess(chroma[AnimationEngine.BLEND_OKLAB], 0.05)
+        self.assertGreater(chroma[AnimationEngine.BLEND_OKLCH], 0.1)
+
+    def test_palette_colours_need_no_conversion_on_note_on(self):
+        engine = AnimationEngine(blend=AnimationEngine.BLEND_OKLCH)
+        np.testing.assert_allclose(engine.oklab_colour, srgb_to_oklab(MIDI_NOTE_COLOURS), atol=1e-12)
+        # Without a colour the note blends with its palette colour
+        engine.start(67, 1.0, 1.0, 0.05, AnimationEngine.CURVE_SQRTSTEP)
+        np.testing.assert_allclose(engine.update(0.01), note_to_rgb('G', 1.0), atol=1e-6)
+        # A colour of its own is converted when it's given
+        engine.start(60, 1.0, 1.0, 0.05, AnimationEngine.CURVE_SQRTSTEP, colour=[1.0, 0.0, 0.0])
+        np.testing.assert_allclose(engine.oklab_colour[60], srgb_to_oklab([1.0, 0.0, 0.0]), atol=1e-12)
+
+    def test_unknown_blend_is_rejected(self):
+        with self.assertRaises(ValueError):
+            AnimationEngine(blend='hsv')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,197 @@
+"""Parity tests for the chord tables against web/js/chord.js.
+
+The vectors are the ones in chord.test.js, chord.alias.test.js,
+chord.implied.test.js and chord-qualities.test.js, so the LED app and the web
+view name the same notes the same way. The tables are also checked against a
+straight transcription of the JS matching for every pitch class set.
+
+Run: python3 -m unittest test_chord
+"""
+import unittest
+
+from Chord import (
+    CHORD_QUALITIES, NO_BASS, NUM_MASKS, chord_names_detailed, display_from_midi_notes,
+    display_from_pitch_classes, exact_chords, implied_chord, implied_chord_of_mask,
+    mask_pitch_classes, name_from_midi_notes, name_from_pitch_classes,
+)
+from KeySpelling import Key, MODE_MAJOR, MODE_MINOR
+
+F_MAJOR = Key(5, MODE_MAJOR)
+
+
+class ChordQualitiesTest(unittest.TestCase):
+    def test_has_all_13_qualities(self):
+        self.assertEqual(len(CHORD_QUALITIES), 13)
+        for name in ['ø7', 'dim7', '6', 'm6']:
+            self.assertIn(name, [q.name for q in CHORD_QUALITIES])
+
+    def test_no_two_qualities_share_intervals(self):
+        self.assertEqual(len({q.intervals for q in CHORD_QUALITIES}), len(CHORD_QUALITIES))
+
+    def test_required_tones_are_chord_tones(self):
+        for q in CHORD_QUALITIES:
+            self.assertEqual(q.intervals[0], 0)
+            self.assertIn(0, q.required)
+            self.assertTrue(set(q.required) <= set(q.intervals), q.name)
+            self.assertTrue(set(q.one_of) <= set(q.intervals), q.name)
+
+
+class ExactChordTest(unittest.TestCase):
+    def test_non_chords_show_note_names(self):
+        self.assertEqual(name_from_midi_notes([60, 65]), 'C F')
+        self.assertEqual(name_from_midi_notes([65, 60]), 'C F')
+        self.assertEqual(name_from_midi_notes([60]), 'C')
+        self.assertEqual(name_from_midi_notes([]), '')
+        self.assertEqual(name_from_midi_notes([60, 66]), 'C Gb')
+        self.assertEqual(name_from_midi_notes([60, 61, 62]), 'C Db D')
+        self.assertEqual(name_from_midi_notes([48, 72]), 'C')
+        self.assertEqual(name_from_midi_notes([58, 60]), 'Bb C')
+
+    def test_chords_are_named(self):
+        self.assertEqual(name_from_midi_notes([60, 64, 67]), 'C')
+        self.assertEqual(name_from_midi_notes([60, 63, 67]), 'Cm')
+        self.assertEqual(name_from_midi_notes([60, 65, 67]), 'Csus4 / Fsus2')
+        self.assertEqual(name_from_midi_notes([60, 64, 67, 70]), 'C7')
+        self.assertEqual(name_from_midi_notes([48, 64, 79]), 'C')
+        self.assertEqual(name_from_midi_notes([48, 60, 64, 67]), 'C')
+
+    def test_key_aware_spelling(self):
+        name = name_from_midi_notes([58, 62, 65], F_MAJOR)
+        self.assertTrue(name.startswith('Bb'), name)
+        self.assertNotIn('A#', name)
+
+    def test_pitch_class_entry_point(self):
+        self.assertEqual(name_from_pitch_classes({0, 4, 7}, 0), 'C')
+        self.assertEqual(name_from_pitch_classes({0, 4, 7, 9}, 0), 'C6 / Am7')
+        self.assertEqual(name_from_pitch_classes({0, 4, 7, 9}, 9), 'Am7 / C6')
+        self.assertTrue(name_from_pitch_classes({11, 2, 5, 9}, 11).startswith('Bø7'))
+        self.assertEqual(name_from_pitch_classes({0, 6}, 0), 'C Gb')
+        self.assertEqual(name_from_pitch_classes({0, 6}, 6, None, [6, 0]), 'Gb C')
+        self.assertEqual(name_from_pitch_classes({0, 6}, 6, None, [0, 6]), 'C Gb')
+
+    def test_dim7_roots_on_the_key_leading_tone(self):
+        self.assertTrue(name_from_pitch_classes({8, 11, 2, 5}, 2, Key(9, MODE_MINOR)).startswith('G#dim7'))
+        self.assertTrue(name_from_pitch_classes({8, 11, 2, 5}, 2, Key(0, MODE_MAJOR)).startswith('Bdim7'))
+        self.assertTrue(name_from_pitch_classes({1, 4, 7, 10}, 4, Key(2, MODE_MINOR)).startswith('C#dim7'))
+        self.assertTrue(name_from_pitch_classes({6, 9, 0, 3}, 0, Key(7, MODE_MINOR)).startswith('F#dim7'))
+
+    def test_dim7_falls_back_to_the_bass(self):
+        self.assertTrue(name_from_pitch_classes({8, 11, 2, 5}, 5).startswith('Fdim7'))
+        self.assertTrue(name_from_pitch_classes({1, 4, 7, 10}, 4, Key(0, MODE_MAJOR)).startswith('Edim7'))
+
+    def test_aug_is_not_reordered_by_the_key(self):
+        self.assertTrue(name_from_pitch_classes({0, 4, 8}, 4, Key(1, MODE_MAJOR)).startswith('Eaug'))
+
+
+class AliasTest(unittest.TestCase):
+    def test_aliases_lead_with_the_bass(self):
+        self.assertEqual(name_from_midi_notes([60, 64, 67, 69]), 'C6 / Am7')
+        self.assertEqual(name_from_midi_notes([57, 60, 64, 67]), 'Am7 / C6')
+        self.assertEqual(name_from_midi_notes([57, 60, 63, 67]), 'Aø7 / Cm6')
+        self.assertEqual(name_from_midi_notes([60, 63, 67, 69]), 'Cm6 / Aø7')
+
+    def test_symmetric_chords_show_every_root(self):
+        name = name_from_midi_notes([60, 64, 68])
+        self.assertTrue(name.startswith('Caug'), name)
+        self.assertIn('Eaug', name)
+        self.assertIn('Abaug', name)
+        name = name_from_midi_notes([60, 63, 66, 69])
+        self.assertTrue(name.startswith('Cdim7'), name)
+        self.assertEqual(len(name.split(' / ')), 4)
+
+    def test_split_display(self):
+        self.assertEqual(display_from_midi_notes([60, 63, 66, 69]), ('Cdim7', ['Ebdim7', 'Gbdim7', 'Adim7']))
+        self.assertEqual(
+            display_from_midi_notes([62, 65, 68, 71], Key(9, MODE_MINOR)),
+            ('G#dim7', ['Ddim7', 'Fdim7', 'Bdim7'])
+        )
+        self.assertEqual(display_from_midi_notes([60, 64, 68]), ('Caug', ['Eaug', 'Abaug']))
+        self.assertEqual(display_from_midi_notes([60, 64, 67, 69]), ('C6 / Am7', []))
+        self.assertEqual(display_from_midi_notes([60, 64, 67]), ('C', []))
+        self.assertEqual(display_from_pitch_classes({0, 3, 6, 9}), ('Cdim7 / Ebdim7 / Gbdim7 / Adim7', []))
+
+
+class ImpliedChordTest(unittest.TestCase):
+    def test_implied(self):
+        self.assertEqual(implied_chord([64, 71, 74]), 'E7')
+        self.assertEqual(implied_chord([60, 64]), 'C')
+        self.assertEqual(implied_chord([60, 63]), 'Cm')
+        self.assertEqual(implied_chord([60, 64, 70]), 'C7')
+        self.assertEqual(implied_chord([60, 63, 70]), 'Cm7')
+        self.assertEqual(implied_chord([60, 64, 71]), 'Cmaj7')
+        self.assertEqual(implied_chord([60, 68]), 'Ab')
+
+    def test_nothing_implied(self):
+        self.assertIsNone(implied_chord([60, 67]))
+        self.assertIsNone(implied_chord([60, 70]))
+        self.assertIsNone(implied_chord([60, 66]))
+        self.assertIsNone(implied_chord([60, 63, 66]))
+        self.assertIsNone(implied_chord([60, 64, 67]))
+        self.assertIsNone(implied_chord([60, 64, 67, 70]))
+        self.assertIsNone(implied_chord([60]))
+        self.assertIsNone(implied_chord([]))
+
+
+# Straight transcription of chord.js's matching, to check the tables against
+def js_exact(pcs, bass):
+    matches = []
+    for root in range(12):
+        for q in CHORD_QUALITIES:
+            if len(pcs) == len(q.intervals) and all((root + iv) % 12 in pcs for iv in q.intervals):
+                matches.append((root, q.name))
+    matches.sort(key=lambda m: (0 if m[0] == bass else 1, m[0]))
+    return matches
+
+
+def js_implied_candidates(pcs):
+    if len(pcs) < 2 or js_exact(pcs, None):
+        return []
+    candidates = []
+    for root in range(12):
+        for qi, q in enumerate(CHORD_QUALITIES):
+            if not all((root + iv) % 12 in pcs for iv in q.required):
+                continue
+            present = sum((root + iv) % 12 in pcs for iv in q.intervals)
+            if q.one_of and not any((root + iv) % 12 in pcs for iv in q.one_of):
+                continue
+            if not all(any((root + iv) % 12 == pc for iv in q.intervals) for pc in pcs):
+                continue
+            candidates.append((root, qi, present))
+    return candidates
+
+
+def js_implied(candidates, lowest):
+    ranked = sorted((len(CHORD_QUALITIES[qi].intervals), qi, 0 if root == lowest else 1, -present, root)
+                    for root, qi, present in candidates)
+    if not ranked or (len(ranked) > 1 and ranked[0][:4] == ranked[1][:4]):
+        return None
+    return ranked[0][4], CHORD_QUALITIES[ranked[0][1]].name
+
+
+class TableParityTest(unittest.TestCase):
+    def test_exact_tables_match_the_js_matching(self):
+        for mask in range(NUM_MASKS):
+            pcs = set(mask_pitch_classes(mask))
+            for bass in [None] + sorted(pcs):
+                chords = exact_chords(mask, bass)
+                self.assertEqual([(c.root, c.quality.name) for c in chords], js_exact(pcs, bass), (pcs, bass))
+
+    def test_implied_tables_match_the_js_matching(self):
+        for mask in range(NUM_MASKS):
+            pcs = set(mask_pitch_classes(mask))
+            candidates = js_implied_candidates(pcs)
+            for lowest in sorted(pcs):
+                chord = implied_chord_of_mask(mask, lowest)
+                got = (chord.root, chord.quality.name) if chord is not None else None
+                self.assertEqual(got, js_implied(candidates, lowest), (pcs, lowest))
+
+    def test_no_bass_keeps_root_order(self):
+        self.assertEqual(
+            chord_names_detailed({0, 4, 7, 9}),
+            (('C6', 'Am7'), False, False)
+        )
+        self.assertEqual(exact_chords(0b1001, NO_BASS), ())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+"""Tests for the chroma pitch engine (the numpy port of web/js/mic-input.js).
+
+The engine vectorizes the web view's per-bin loops, so the closed-form
+envelope smoother is checked against the JS recurrence, and synthetic tones
+and chords check the fold, the note picks and the silence gate end to end.
+
+Run: python3 -m unittest test_chroma_pitch_engine
+"""
+import unittest
+
+import numpy as np
+
+from ChromaPitchEngine import ChromaPitchEngine, _ConstantQSmoother
+
+SAMPLE_RATE = 44100
+INT16_SCALE = 1.0 / 32768.0
+
+
+# The web view's smoothEnvCQ(), one bin at a time
+def smooth_env_cq(mag, i0, i1, frac, w_min):
+    env = np.zeros(mag.size)
+    acc = mag[i0]
+    for i in range(i0, i1 + 1):
+        acc += (mag[i] - acc) / max(frac * i, w_min)
+        env[i] = acc
+    acc = env[i1]
+    for i in range(i1, i0 - 1, -1):
+        acc += (env[i] - acc) / max(frac * i, w_min)
+        env[i] = acc
+    return env[i0:i1+1]
+
+
+# int16 audio of the given MIDI notes, each with a few decaying harmonics
+def tones(midi_notes, duration_s, amplitude=0.05):
+    t = np.arange(int(SAMPLE_RATE * duration_s)) / SAMPLE_RATE
+    audio = np.zeros(t.size)
+    for note in midi_notes:
+        f = 440.0 * 2.0 ** ((note - 69) / 12.0)
+        for harmonic in range(1, 5):
+            audio += amplitude / harmonic * np.sin(2.0 * np.pi * f * harmonic * t)
+    return (audio * 32767).astype(np.int16)
+
+
+def run_engine(engine, audio, chunk=512):
+    results = []
+    for i in range(0, audio.size, chunk):
+        results += engine.analyse_hops([audio[i:i+chunk]])
+    return results
+
+
+class ConstantQSmootherTest(unittest.TestCase):
+    def test_matches_the_recurrence(self):
+        rng = np.random.default_rng(0)
+        for i0, i1, frac, w_min in [(8, 372, 0.5, 8.0), (93, 1860, 0.06, 4.0), (93, 1860, 0.5, 8.0)]:
+            mag = rng.random(i1 + 1) ** 4
+            out = np.zeros(i1 - i0 + 1)
+            _ConstantQSmoother(i0, i1, frac, w_min).smooth(mag[i0:], out)
+            np.testing.assert_allclose(out, smooth_env_cq(mag, i0, i1, frac, w_min), rtol=1e-12)
+
+
+class ChromaPitchEngineTest(unittest.TestCase):
+    def make_engine(self, **kwargs):
+        return ChromaPitchEngine(SAMPLE_RATE, 36, 96, scale=INT16_SCALE, **kwargs)
+
+    def test_one_result_per_hop(self):
+        engine = self.make_engine()
+        results = run_engine(engine, np.zeros(engine.hop_length * 10, dtype=np.int16))
+        self.assertEqual(len(results), 10)
+
+    def test_silence_has_no_notes(self):
+        engine = self.make_engine()
+        results = run_engine(engine, np.zeros(SAMPLE_RATE // 2, dtype=np.int16))
+        self.assertTrue(all(notes.size == 0 for notes in results))
+        self.assertEqual(engine.bass_pitch_class, -1)
+
+    def test_single_note(self):
+        engine = self.make_engine()
+        results = run_engine(engine, tones([60], 0.8))
+        self.assertEqual(results[-1].tolist(), [60])
+        self.assertEqual(int(np.argmax(engine.pc_energy)), 0)
+        self.assertEqual(engine.bass_pitch_class, 0)
+        self.assertGreater(engine.level, 0.5)
+
+    def test_chord(self):
+        engine = self.make_engine()
+        results = run_engine(engine, tones([57, 60, 64], 0.8))
+        self.assertEqual(results[-1].tolist(), [57, 60, 64])
+        self.assertEqual(engine.bass_pitch_class, 9)
+
+    def test_notes_stop_after_the_audio_does(self):
+        engine = self.make_engine()
+        audio = np.concatenate([tones([60, 64, 67], 0.8), np.zeros(SAMPLE_RATE, dtype=np.int16)])
+        results = run_engine(engine, audio)
+        self.assertEqual(results[-1].size, 0)
+
+    def test_raw_preset_detects_the_chord_too(self):
+        engine = self.make_engine(dsp_preset='raw')
+        results = run_engine(engine, tones([60, 64, 67], 0.8))
+        self.assertEqual(results[-1].tolist(), [60, 64, 67])
+
+    def test_unknown_dsp_preset(self):
+        with self.assertRaises(ValueError):
+            self.make_engine(dsp_preset='loud')
+
+
+if __name__ == '__main__':
+    unittest.main()
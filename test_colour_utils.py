@@ -0,0 +1,63 @@
+"""Tests for the gamma/brightness/dithering output stage that turns frames into
+the 8-bit values sent to the LEDs, and for the sRGB <-> Oklab conversions.
+
+Run: python3 -m unittest test_colour_utils
+"""
+import unittest
+
+import numpy as np
+
+from ColourUtils import GAMMA, GammaOutputStage, gamma, srgb_to_oklab, oklab_to_srgb
+from NoteUtils import MIDI_NOTE_COLOURS
+
+
+class GammaOutputStageTest(unittest.TestCase):
+    def test_gamma_table_follows_the_gamma_curve(self):
+        for value in range(256):
+            self.assertEqual(gamma(value), int(pow(value / 255.0, GAMMA) * 255.0 + 0.5))
+
+    def test_without_dithering_matches_the_per_channel_path(self):
+        frame = np.random.default_rng(0).random((50, 3), dtype=np.float32)
+        frame[0] = [0.0, 1.0, 0.5]
+        for brightness in [1.0, 0.6, 0.05]:
+            output = GammaOutputStage(50, brightness).process(frame)
+            # What the Animator sent before: gamma(round(v*255)), scaled by the driver
+            expected = [[int(gamma(round(float(v) * 255)) * brightness) for v in row] for row in frame]
+            self.assertEqual(output.tolist(), expected)
+
+    def test_dithering_averages_out_to_the_in_between_level(self):
+        stage = GammaOutputStage(4, brightness=0.25, dither=True)
+        frame = np.array([[0.0, 0.1, 0.2], [0.3, 0.31, 0.32], [0.5, 0.75, 1.0], [0.05, 0.06, 0.07]], dtype=np.float32)
+        num_frames = 256
+        total = np.zeros((4, 3))
+        for _ in range(num_frames):
+            total += stage.process(frame)
+        levels = np.rint(frame * (GammaOutputStage.DITHER_LUT_SIZE - 1)) / (GammaOutputStage.DITHER_LUT_SIZE - 1)
+        ideal = np.power(levels, GAMMA) * 255.0 * 0.25
+        np.testing.assert_allclose(total / num_frames, ideal, atol=1.0 / num_frames + 1.0 / 256)
+
+    def test_dithering_leaves_black_and_full_white_steady(self):
+        stage = GammaOutputStage(2, dither=True)
+        frame = np.array([[0.0, 0.0, 0.0], [1.0, 1.0, 1.0]], dtype=np.float32)
+        for _ in range(10):
+            self.assertEqual(stage.process(frame).tolist(), [[0, 0, 0], [255, 255, 255]])
+
+
+class OklabTest(unittest.TestCase):
+    def test_reference_values(self):
+        # Reference values from https://bottosson.github.io/posts/oklab/
+        np.testing.assert_allclose(srgb_to_oklab([1.0, 1.0, 1.0]), [1.0, 0.0, 0.0], atol=1e-4)
+        np.testing.assert_allclose(srgb_to_oklab([0.0, 0.0, 0.0]), [0.0, 0.0, 0.0], atol=1e-9)
+        np.testing.assert_allclose(srgb_to_oklab([1.0, 0.0, 0.0]), [0.62796, 0.22486, 0.12585], atol=1e-4)
+        np.testing.assert_allclose(srgb_to_oklab([0.0, 0.0, 1.0]), [0.45201, -0.03246, -0.31153], atol=1e-4)
+
+    def test_the_palette_round_trips(self):
+        np.testing.assert_allclose(oklab_to_srgb(srgb_to_oklab(MIDI_NOTE_COLOURS)), MIDI_NOTE_COLOURS, atol=1e-6)
+
+    def test_out_of_gamut_colours_are_clamped(self):
+        rgb = oklab_to_srgb([0.7, 0.4, 0.4])
+        self.assertTrue(np.all((rgb >= 0.0) & (rgb <= 1.0)))
+
+
+if __name__ == '__main__':
+    unittest.main()
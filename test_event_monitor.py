@@ -0,0 +1,168 @@
+"""Tests for the binary event transport between the note detectors and the
+Animator.
+
+Run: python3 -m unittest test_event_monitor
+"""
+import threading
+import time
+import unittest
+import multiprocessing
+
+from EventMonitor import EventMonitor, Issuer, make_issuers
+from NoteUtils import NoteData
+
+MIDI = EventMonitor.EVENT_ISSUER_MIDI
+MIC = EventMonitor.EVENT_ISSUER_MIC
+NOTE_ON = EventMonitor.EVENT_TYPE_NOTE_ON
+NOTE_OFF = EventMonitor.EVENT_TYPE_NOTE_OFF
+
+
+class SmallEventMonitor(EventMonitor):
+    EVENT_RING_SIZE = 4
+    BACKPRESSURE_TIMEOUT_S = 0.05
+
+
+def send_notes(event_monitor, num_notes):
+    for i in range(num_notes):
+        note_data = NoteData(issuers={MIDI}, note=21 + i % 88)
+        event_monitor.on_event(MIDI, NOTE_ON, note_data)
+        event_monitor.on_event(MIDI, NOTE_OFF, note_data)
+
+
+class EventMonitorTest(unittest.TestCase):
+    def make_monitor(self, monitor_cls=EventMonitor, issuers=None):
+        event_monitor = monitor_cls(issuers)
+        self.addCleanup(event_monitor.close)
+        self.received = []
+        for issuer in event_monitor.issuer_names:
+            for event_type in EventMonitor.EVENT_TYPES:
+                if event_type in EventMonitor.NOTE_EVENT_TYPES:
+                    callback = lambda note_data, i=issuer, t=event_type: self.received.append(
+                        (i, t, note_data.note, note_data.intensity, note_data.issuers))
+                else:
+                    callback = lambda i=issuer, t=event_type: self.received.append((i, t))
+                event_monitor.set_event_callback(issuer, event_type, callback)
+        return event_monitor
+
+    def test_events_arrive_in_order_with_midi_first(self):
+        event_monitor = self.make_monitor()
+        event_monitor.on_event(MIC, EventMonitor.EVENT_TYPE_CONNECTED)
+        event_monitor.on_event(MIC, NOTE_ON, NoteData(issuers={MIC}, note=64))
+        event_monitor.on_event(MIDI, NOTE_ON, NoteData(issuers={MIDI}, note=60, intensity=0.5))
+        event_monitor.on_event(MIDI, NOTE_OFF, NoteData(issuers={MIDI}, note=60))
+        self.assertTrue(event_monitor.wait_for_events(timeout=0))
+        event_monitor.process_events()
+        self.assertEqual(self.received, [
+            (MIDI, NOTE_ON, 60, 64 / 127, {MIDI}),
+            (MIDI, NOTE_OFF, 60, 1.0, {MIDI}),
+            (MIC, EventMonitor.EVENT_TYPE_CONNECTED),
+            (MIC, NOTE_ON, 64, 1.0, {MIC}),
+        ])
+        self.assertFalse(event_monitor.wait_for_events(timeout=0.01))
+
+    def test_every_input_is_an_issuer_in_priority_order(self):
+        event_monitor = self.make_monitor(issuers=make_issuers(3, 2))
+        self.assertEqual(event_monitor.issuer_names, [MIDI, 'MIDI2', 'MIDI3', MIC, 'MIC2'])
+        event_monitor.on_event('MIC2', NOTE_ON, NoteData(issuers={'MIC2'}, note=64))
+        event_monitor.on_event(MIC, NOTE_ON, NoteData(issuers={MIC}, note=65))
+        event_monitor.on_event('MIDI3', NOTE_ON, NoteData(issuers={'MIDI3'}, note=60))
+        event_monitor.on_event(MIDI, NOTE_OFF, NoteData(issuers={MIDI}, note=62))
+        event_monitor.process_events()
+        self.assertEqual([(e[0], e[2], e[4]) for e in self.received], [
+            (MIDI, 62, {MIDI}), ('MIDI3', 60, {'MIDI3'}), (MIC, 65, {MIC}), ('MIC2', 64, {'MIC2'}),
+        ])
+        self.assertEqual(event_monitor.dropped_events(), {name: 0 for name in event_monitor.issuer_names})
+
+    def test_issuers_are_ordered_by_their_own_priority(self):
+        event_monitor = self.make_monitor(issuers=[Issuer('PADS', MIDI, 2), Issuer('KEYS', MIDI, 1)])
+        self.assertEqual(event_monitor.issuer_names, ['KEYS', 'PADS'])
+        event_monitor.on_event('PADS', NOTE_ON, NoteData(issuers={'PADS'}, note=36))
+        event_monitor.on_event('KEYS', NOTE_ON, NoteData(issuers={'KEYS'}, note=60))
+        event_monitor.process_events()
+        self.assertEqual([e[0] for e in self.received], ['KEYS', 'PADS'])
+        self.assertEqual(event_monitor.processed_note_records['issuer'].tolist(), [0, 1])
+
+    def test_issuer_names_are_unique(self):
+        with self.assertRaises(ValueError):
+            EventMonitor([Issuer(MIDI, MIDI, 0), Issuer(MIDI, MIDI, 1)])
+
+    def test_repeated_note_events_are_coalesced(self):
+        event_monitor = self.make_monitor()
+        for intensity in [0.25, 1.0]:
+            event_monitor.on_event(MIDI, NOTE_ON, NoteData(issuers={MIDI}, note=60, intensity=intensity))
+        event_monitor.on_event(MIDI, NOTE_ON, NoteData(issuers={MIDI}, note=62))
+        event_monitor.on_event(MIDI, NOTE_OFF, NoteData(issuers={MIDI}, note=60))
+        event_monitor.process_events()
+        self.assertEqual([(e[1], e[2], e[3]) for e in self.received],
+                         [(NOTE_ON, 60, 1.0), (NOTE_ON, 62, 1.0), (NOTE_OFF, 60, 1.0)])
+        self.assertEqual(event_monitor.coalesced_events, 1)
+
+    def test_batch_arrives_in_order_with_one_write(self):
+        event_monitor = self.make_monitor()
+        events = [(NOTE_ON, NoteData(issuers={MIDI}, note=note), None) for note in [60, 64, 67]]
+        events.append((NOTE_OFF, NoteData(issuers={MIDI}, note=64), 1.5))
+        self.assertEqual(event_monitor.on_events(MIDI, events), 4)
+        self.assertEqual(event_monitor.on_events(MIDI, []), 0)
+        records = event_monitor.event_rings[event_monitor.issuer_code(MIDI)].peek()
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]['timestamp'][-1], 1.5)
+        event_monitor.process_events()
+        self.assertEqual([e[1:3] for e in self.received],
+                         [(NOTE_ON, 60), (NOTE_ON, 64), (NOTE_ON, 67), (NOTE_OFF, 64)])
+        self.assertEqual(event_monitor.dropped_events(), {MIDI: 0, MIC: 0})
+
+    def test_batch_too_big_for_the_ring_gets_per_event_backpressure(self):
+        event_monitor = self.make_monitor(SmallEventMonitor)
+        events = [(NOTE_ON, NoteData(issuers={MIDI}, note=note), None) for note in range(60, 66)]
+        events.append((NOTE_OFF, NoteData(issuers={MIDI}, note=60), None))
+        consumer = threading.Timer(0.01, event_monitor.process_events)
+        consumer.start()
+        self.assertEqual(event_monitor.on_events(MIDI, events), 5)
+        consumer.join()
+        event_monitor.process_events()
+        self.assertEqual([e[1:3] for e in self.received],
+                         [(NOTE_ON, 60), (NOTE_ON, 61), (NOTE_ON, 62), (NOTE_ON, 63), (NOTE_OFF, 60)])
+        self.assertEqual(event_monitor.dropped_events(), {MIDI: 2, MIC: 0})
+
+    def test_full_ring_drops_note_ons_but_not_note_offs(self):
+        event_monitor = self.make_monitor(SmallEventMonitor)
+        for note in range(60, 64):
+            self.assertTrue(event_monitor.on_event(MIDI, NOTE_ON, NoteData(issuers={MIDI}, note=note)))
+        self.assertFalse(event_monitor.on_event(MIDI, NOTE_ON, NoteData(issuers={MIDI}, note=64)))
+
+        # The note off waits for the consumer to make room
+        consumer = threading.Timer(0.01, event_monitor.process_events)
+        consumer.start()
+        self.assertTrue(event_monitor.on_event(MIDI, NOTE_OFF, NoteData(issuers={MIDI}, note=60)))
+        consumer.join()
+        event_monitor.process_events()
+        self.assertEqual([e[1:3] for e in self.received],
+                         [(NOTE_ON, 60), (NOTE_ON, 61), (NOTE_ON, 62), (NOTE_ON, 63), (NOTE_OFF, 60)])
+        self.assertEqual(event_monitor.dropped_events(), {MIDI: 1, MIC: 0})
+
+    def test_stalled_consumer_only_delays_the_first_note_off(self):
+        event_monitor = self.make_monitor(SmallEventMonitor)
+        send_notes(event_monitor, 2)
+        start_time = time.monotonic()
+        for note in range(60, 70):
+            event_monitor.on_event(MIDI, NOTE_OFF, NoteData(issuers={MIDI}, note=note))
+        self.assertLess(time.monotonic() - start_time, 5 * SmallEventMonitor.BACKPRESSURE_TIMEOUT_S)
+        self.assertEqual(event_monitor.dropped_events()[MIDI], 10)
+
+    def test_burst_from_another_process_is_lossless(self):
+        event_monitor = self.make_monitor()
+        # Fewer events than fit in the ring, so none can be dropped however slow the consumer is
+        num_notes = EventMonitor.EVENT_RING_SIZE // 2 - 1
+        producer = multiprocessing.Process(target=send_notes, args=(event_monitor, num_notes))
+        producer.start()
+        while producer.is_alive() or event_monitor.pending_events(MIDI) > 0:
+            if event_monitor.wait_for_events(timeout=0.01):
+                event_monitor.process_events()
+        producer.join()
+        self.assertEqual(len(self.received), 2 * num_notes)
+        self.assertEqual([e[1] for e in self.received[-2:]], [NOTE_ON, NOTE_OFF])
+        self.assertEqual(event_monitor.dropped_events(), {MIDI: 0, MIC: 0})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+"""Tests for recording the frames sent to the LEDs and comparing recordings.
+
+Run: python3 -m unittest test_frame_recording
+"""
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from FrameRecording import FrameRecorder, compare_recordings, load_recording
+
+
+def frame(value, num_leds=4):
+    return np.full((num_leds, 3), value, dtype=np.uint8)
+
+
+class FrameRecordingTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+
+    def path(self, name):
+        return os.path.join(self.dir.name, name)
+
+    def record(self, name, timed_values, num_leds=4):
+        recorder = FrameRecorder(self.path(name), num_leds)
+        for time_s, value in timed_values:
+            recorder.record(time_s, frame(value, num_leds))
+        recorder.close()
+        return self.path(name)
+
+    def test_round_trip(self):
+        recorder = FrameRecorder(self.path('a.npy'), 5)
+        rng = np.random.default_rng(0)
+        frames = rng.integers(0, 256, (3000, 5, 3)).astype(np.uint8) # Grows past the initial capacity
+        for i, f in enumerate(frames):
+            recorder.record(i / 120.0, f)
+        recorder.close()
+        times, recorded = load_recording(self.path('a.npy'))
+        np.testing.assert_array_equal(recorded, frames)
+        np.testing.assert_allclose(times, np.arange(3000) / 120.0)
+        self.assertEqual(os.path.getsize(self.path('a.npy')), FrameRecorder.HEADER_LEN + 3000 * (8 + 15))
+
+    def test_readable_before_it_is_closed(self):
+        recorder = FrameRecorder(self.path('a.npy'), 4)
+        recorder.record(0.0, frame(1))
+        recorder.record(0.5, frame(2))
+        # The header isn't rewritten after every frame
+        self.assertEqual(len(load_recording(self.path('a.npy'))[0]), 0)
+        recorder.flush()
+        times, frames = load_recording(self.path('a.npy'))
+        self.assertEqual(times.tolist(), [0.0, 0.5])
+        self.assertEqual(frames[:, 0, 0].tolist(), [1, 2])
+        recorder.close()
+
+    def test_header_is_flushed_periodically(self):
+        recorder = FrameRecorder(self.path('a.npy'), 4)
+        for i in range(FrameRecorder.HEADER_FLUSH_FRAMES * 2 + 10):
+            recorder.record(i / 60.0, frame(i % 256))
+            if i == FrameRecorder.HEADER_FLUSH_FRAMES - 2:
+                self.assertEqual(len(load_recording(self.path('a.npy'))[0]), 0)
+        # Readable up to the last flush, as if the process had been killed
+        times, frames = load_recording(self.path('a.npy'))
+        self.assertEqual(len(times), FrameRecorder.HEADER_FLUSH_FRAMES * 2)
+        self.assertEqual(frames[-1, 0, 0], (FrameRecorder.HEADER_FLUSH_FRAMES * 2 - 1) % 256)
+        recorder.close()
+        self.assertEqual(len(load_recording(self.path('a.npy'))[0]), FrameRecorder.HEADER_FLUSH_FRAMES * 2 + 10)
+
+    def test_identical_recordings_match(self):
+        timed_values = [(0.0, 0), (0.1, 50), (0.2, 100), (0.3, 0)]
+        comparison = compare_recordings(self.record('a.npy', timed_values), self.record('b.npy', timed_values))
+        self.assertTrue(comparison.matches)
+        self.assertEqual(comparison.frames_compared, 8)
+
+    def test_colour_tolerance(self):
+        a = self.record('a.npy', [(0.0, 0), (0.1, 50), (0.2, 0)])
+        b = self.record('b.npy', [(0.0, 0), (0.1, 52), (0.2, 0)])
+        self.assertTrue(compare_recordings(a, b, tolerance=2).matches)
+        comparison = compare_recordings(a, b, tolerance=1)
+        self.assertFalse(comparison.matches)
+        self.assertEqual(comparison.mismatched_frames, 2)
+        self.assertEqual(comparison.max_difference, 2)
+        self.assertAlmostEqual(comparison.first_mismatch_time_s, 0.1)
+
+    def test_time_tolerance(self):
+        a = self.record('a.npy', [(0.0, 0), (0.100, 50), (0.200, 0)])
+        b = self.record('b.npy', [(0.0, 0), (0.105, 50), (0.198, 0)])
+        self.assertFalse(compare_recordings(a, b).matches)
+        self.assertTrue(compare_recordings(a, b, time_tolerance_s=0.01).matches)
+
+    def test_missing_frames_are_mismatches(self):
+        a = self.record('a.npy', [(0.0, 0), (0.1, 50), (0.2, 0)])
+        b = self.record('b.npy', [(0.0, 0)])
+        comparison = compare_recordings(a, b, time_tolerance_s=0.01)
+        self.assertEqual(comparison.mismatched_frames, 1)
+        self.assertEqual(comparison.max_difference, 50)
+
+    def test_different_strips_cant_be_compared(self):
+        a = self.record('a.npy', [(0.0, 0)], num_leds=4)
+        b = self.record('b.npy', [(0.0, 0)], num_leds=5)
+        with self.assertRaises(ValueError):
+            compare_recordings(a, b)
+
+
+if __name__ == '__main__':
+    unittest.main()
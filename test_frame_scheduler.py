@@ -0,0 +1,84 @@
+"""Tests for the Animator's frame pacing: frame deadlines at the target frame
+rate, overrun counting and waiting for events when idle.
+
+The scheduler's clock is faked, so frames take exactly as long as the tests say.
+
+Run: python3 -m unittest test_frame_scheduler
+"""
+import contextlib
+import io
+import unittest
+from unittest import mock
+
+from FrameScheduler import FrameScheduler
+
+
+class FakeClock(object):
+    def __init__(self, now=100.0):
+        self.now = now
+
+    def monotonic(self):
+        return self.now
+
+
+class FrameSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch("FrameScheduler.time", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.scheduler = FrameScheduler(100.0)
+
+    # Runs a frame that takes frame_time_s, starting wait_s after the previous one ended
+    def run_frame(self, frame_time_s, wait_s=0.0):
+        self.clock.now += wait_s
+        self.scheduler.begin_frame()
+        self.clock.now += frame_time_s
+        self.scheduler.end_frame()
+
+    def test_frames_are_due_one_frame_period_after_the_previous_start(self):
+        self.assertEqual(self.scheduler.frame_period_s, 0.01)
+        self.assertEqual(self.scheduler.time_until_next_frame(), 0.0)
+        self.run_frame(0.002)
+        self.assertAlmostEqual(self.scheduler.time_until_next_frame(), 0.008)
+        self.clock.now += 0.005
+        self.assertAlmostEqual(self.scheduler.time_until_next_frame(), 0.003)
+        self.clock.now += 0.01
+        self.assertEqual(self.scheduler.time_until_next_frame(), 0.0)
+        self.assertEqual((self.scheduler.total_frames, self.scheduler.total_overruns), (1, 0))
+
+    def test_frames_longer_than_the_period_are_overruns(self):
+        self.run_frame(0.004)
+        self.run_frame(0.015, wait_s=0.006)
+        self.run_frame(0.009)
+        self.assertEqual(self.scheduler.total_overruns, 1)
+        self.assertAlmostEqual(self.scheduler.last_frame_time_s, 0.009)
+        self.assertAlmostEqual(self.scheduler.interval_max_frame_time_s, 0.015)
+        # A late frame doesn't try to catch up: the next one is due right away
+        self.run_frame(0.02)
+        self.assertEqual(self.scheduler.time_until_next_frame(), 0.0)
+        self.assertEqual((self.scheduler.total_frames, self.scheduler.total_overruns), (4, 2))
+
+    def test_report_starts_a_new_interval(self):
+        self.run_frame(0.015)
+        self.run_frame(0.002)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            self.scheduler.report()
+        self.assertIn("frames: 2", output.getvalue())
+        self.assertIn("overruns: 1 (total 1)", output.getvalue())
+        self.assertEqual((self.scheduler.interval_frames, self.scheduler.interval_overruns), (0, 0))
+        self.run_frame(0.02)
+        self.assertEqual((self.scheduler.interval_overruns, self.scheduler.total_overruns), (1, 2))
+
+    def test_idle_waits_for_the_next_event(self):
+        self.run_frame(0.002)
+        self.assertIsNone(self.scheduler.wait_timeout(idle=True))
+        self.assertAlmostEqual(self.scheduler.wait_timeout(idle=False), 0.008)
+        self.clock.now += 1.0
+        self.assertIsNone(self.scheduler.wait_timeout(idle=True))
+        self.assertEqual(self.scheduler.wait_timeout(idle=False), 0.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
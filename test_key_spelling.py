@@ -0,0 +1,202 @@
+"""Parity tests for the key aware note spelling and the key estimator against
+web/js/key-spelling.js.
+
+The vectors are the ones in key-spelling.test.js, so notes and chords are
+spelled (and keys estimated) the same way on the LEDs' side as in the web view.
+
+Run: python3 -m unittest test_key_spelling
+"""
+import unittest
+
+import numpy as np
+
+from KeySpelling import KEYS, KS_MAJOR, KS_MINOR, Key, KeyEstimator, MODE_MAJOR, MODE_MINOR, LETTERS, spell
+
+C, F, BB, B = 0, 5, 10, 11
+
+
+class SpellTest(unittest.TestCase):
+    def test_undecided_key_uses_the_default_table(self):
+        by_pc = ['C', 'Db', 'D', 'Eb', 'E', 'F', 'Gb', 'G', 'Ab', 'A', 'Bb', 'B']
+        self.assertEqual([spell(pc, None) for pc in range(12)], by_pc)
+
+    def test_bb_in_f_major_a_sharp_in_b_major(self):
+        self.assertEqual(spell(BB, Key(F, MODE_MAJOR)), 'Bb')
+        self.assertEqual(spell(BB, Key(B, MODE_MAJOR)), 'A#')
+
+    def test_c_major_naturals(self):
+        c_major = Key(C, MODE_MAJOR)
+        self.assertEqual([spell(pc, c_major) for pc in [0, 2, 4, 11]], ['C', 'D', 'E', 'B'])
+
+    def test_every_major_key_uses_each_letter_once(self):
+        for tonic in range(12):
+            key = Key(tonic, MODE_MAJOR)
+            letters = [spell((tonic + step) % 12, key)[0] for step in [0, 2, 4, 5, 7, 9, 11]]
+            self.assertEqual(len(set(letters)), 7, (tonic, letters))
+
+    def test_minor_keys_spell_via_their_relative_major(self):
+        self.assertEqual(spell(10, Key(2, MODE_MINOR)), 'Bb')
+        self.assertEqual(spell(9, Key(9, MODE_MINOR)), 'A')
+
+    def test_minor_keys_spell_the_leading_tone_raised(self):
+        natural_pcs = {'C': 0, 'D': 2, 'E': 4, 'F': 5, 'G': 7, 'A': 9, 'B': 11}
+        tonic_letters = ['C', 'C', 'D', 'E', 'E', 'F', 'F', 'G', 'G', 'A', 'B', 'B']
+        for tonic in range(12):
+            leading_tone = (tonic + 11) % 12
+            letter = LETTERS[(LETTERS.index(tonic_letters[tonic]) + 6) % 7]
+            delta = (leading_tone - natural_pcs[letter]) % 12
+            if delta > 6:
+                delta -= 12
+            want = letter + ('#' * delta if delta > 0 else 'b' * -delta)
+            if '##' in want or 'bb' in want:
+                continue
+            self.assertEqual(spell(leading_tone, Key(tonic, MODE_MINOR)), want, tonic)
+
+    def test_rest_of_a_minor_key_is_undisturbed(self):
+        d_minor = Key(2, MODE_MINOR)
+        self.assertEqual(spell(10, d_minor), 'Bb')
+        self.assertEqual(spell(0, d_minor), 'C')
+        self.assertEqual(spell(1, d_minor), 'C#')
+
+    def test_chromatic_notes_follow_the_key_direction(self):
+        self.assertEqual(spell(6, Key(0, MODE_MAJOR)), 'F#')
+        self.assertEqual(spell(6, Key(5, MODE_MAJOR)), 'Gb')
+
+    def test_gb_major_spells_cb(self):
+        self.assertEqual(spell(11, Key(6, MODE_MAJOR)), 'Cb')
+
+
+def play(estimator, notes, step_s, t=0.0):
+    for note in notes:
+        estimator.add_note_on(note, 0.9)
+        t += step_s
+        estimator.decay_to(t, KeyEstimator.SOURCE_MIDI)
+    return t
+
+
+# The JS estimateKey(): every key correlated one at a time
+def js_estimate_key(weights, margin):
+    total = sum(weights)
+    if total < KeyEstimator.MIN_TOTAL:
+        return None
+    if sum(w >= total * KeyEstimator.PC_PRESENT_FRACTION for w in weights) < KeyEstimator.MIN_DISTINCT_PCS:
+        return None
+    best, best_score, second = None, -2, -2
+    for key in KEYS:
+        profile = KS_MAJOR if key.mode == MODE_MAJOR else KS_MINOR
+        score = np.corrcoef(weights, [profile[(pc - key.tonic) % 12] for pc in range(12)])[0, 1]
+        if score > best_score:
+            best, best_score, second = key, score, best_score
+        elif score > second:
+            second = score
+    return best if best_score - second >= margin else None
+
+
+class KeyEstimatorTest(unittest.TestCase):
+    def test_weight_halves_over_one_midi_half_life(self):
+        estimator = KeyEstimator(half_life_midi_s=2.0)
+        estimator.decay_to(0.0, KeyEstimator.SOURCE_MIDI)
+        estimator.add_note_on(60, 1.0)
+        w0 = estimator.weight(0)
+        estimator.decay_to(2.0, KeyEstimator.SOURCE_MIDI)
+        self.assertAlmostEqual(estimator.weight(0) / w0, 0.5)
+
+    def test_mic_uses_its_own_half_life(self):
+        estimator = KeyEstimator(half_life_mic_s=4.0)
+        estimator.decay_to(0.0, KeyEstimator.SOURCE_MIC)
+        estimator.add_note_on(60, 1.0)
+        w0 = estimator.weight(0)
+        estimator.decay_to(4.0, KeyEstimator.SOURCE_MIC)
+        self.assertAlmostEqual(estimator.weight(0) / w0, 0.5)
+
+    def test_c_major_stream(self):
+        estimator = KeyEstimator()
+        t = 0.0
+        for _ in range(4):
+            t = play(estimator, [60, 62, 64, 65, 67, 69, 71, 72], 0.1, t)
+        self.assertEqual(estimator.estimate_key(), Key(0, MODE_MAJOR))
+
+    def test_a_minor_stream(self):
+        estimator = KeyEstimator()
+        t = 0.0
+        for _ in range(4):
+            t = play(estimator, [57, 59, 60, 62, 64, 65, 67, 69], 0.1, t)
+        self.assertEqual(estimator.estimate_key(), Key(9, MODE_MINOR))
+
+    def test_one_chord_does_not_establish_a_key(self):
+        estimator = KeyEstimator()
+        t = play(estimator, [71, 75, 78, 82], 0.03)
+        self.assertIsNone(estimator.estimate_key())
+        for _ in range(20):
+            t += 0.1
+            estimator.decay_to(t, KeyEstimator.SOURCE_MIDI)
+        self.assertIsNone(estimator.estimate_key())
+
+    def test_five_pitch_classes_decide(self):
+        estimator = KeyEstimator()
+        play(estimator, [60, 64, 67, 65, 69, 72], 0.05)
+        self.assertIsNotNone(estimator.estimate_key())
+
+    def test_decayed_residue_does_not_count_as_sounding(self):
+        estimator = KeyEstimator()
+        t = 0.0
+        for root in [62, 64, 65, 67, 69]:
+            t = play(estimator, [root, root + 4, root + 7, root + 11], 0.04, t)
+        for _ in range(8):
+            for note in [71, 75, 78, 82]:
+                estimator.add_note_on(note, 0.9)
+            t += 0.1
+            estimator.decay_to(t, KeyEstimator.SOURCE_MIDI)
+        self.assertIsNone(estimator.estimate_key())
+
+    def test_bass_and_velocity_weighting(self):
+        estimator = KeyEstimator()
+        estimator.add_note_on(36, 0.8)
+        low = estimator.weight(0)
+        estimator.reset()
+        estimator.add_note_on(72, 0.8)
+        self.assertGreater(low, estimator.weight(0))
+        estimator.reset()
+        estimator.add_note_on(60, 1.0)
+        loud = estimator.weight(0)
+        estimator.reset()
+        estimator.add_note_on(60, 0.2)
+        self.assertGreater(loud, estimator.weight(0))
+
+    def test_reset(self):
+        estimator = KeyEstimator()
+        estimator.add_note_on(60, 1.0)
+        estimator.reset()
+        self.assertEqual(estimator.weight(0), 0.0)
+        self.assertIsNone(estimator.estimate_key())
+
+    def test_matches_the_js_scoring(self):
+        rng = np.random.default_rng(0)
+        estimator = KeyEstimator()
+        t = 0.0
+        for i in range(2000):
+            if rng.random() < 0.2:
+                # Now and then a note out of nowhere
+                estimator.add_note_on(int(rng.integers(21, 109)), rng.random())
+            else:
+                # Mostly the scale of a key that moves round the circle of fifths
+                tonic = (i // 200) * 7 % 12
+                degree = int(rng.choice([0, 2, 4, 5, 7, 9, 11, 1]))
+                estimator.add_note_on(48 + tonic + degree + 12 * int(rng.integers(0, 3)), rng.random())
+            t += rng.random() * 0.2
+            estimator.decay_to(t, KeyEstimator.SOURCE_MIDI if i % 2 else KeyEstimator.SOURCE_MIC)
+            weights = [estimator.weight(pc) for pc in range(12)]
+            self.assertEqual(estimator.estimate_key(), js_estimate_key(weights, estimator.confidence_margin), weights)
+
+    def test_decay_does_not_underflow(self):
+        estimator = KeyEstimator()
+        t = play(estimator, [60, 62, 64, 65, 67, 69, 71], 0.1)
+        for _ in range(200):
+            t += 100.0
+            estimator.decay_to(t, KeyEstimator.SOURCE_MIDI)
+        t = play(estimator, [60, 62, 64, 65, 67, 69, 71, 72] * 4, 0.1, t)
+        self.assertEqual(estimator.estimate_key(), Key(0, MODE_MAJOR))
+
+
+if __name__ == '__main__':
+    unittest.main()
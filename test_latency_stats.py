@@ -0,0 +1,107 @@
+"""Tests for the input to LED latency histograms and for following event
+capture times through the LED writer to the frame that's written.
+
+Run: python3 -m unittest test_latency_stats
+"""
+import pickle
+import threading
+import time
+import unittest
+
+import numpy as np
+
+from EventMonitor import EventMonitor
+from LatencyStats import LatencyStats
+from LedOutput import AsyncLedWriter, NullOutput
+
+MIDI = EventMonitor.ISSUERS.index(EventMonitor.EVENT_ISSUER_MIDI)
+MIC = EventMonitor.ISSUERS.index(EventMonitor.EVENT_ISSUER_MIC)
+
+
+def event_records(issuer_code, timestamps):
+    records = np.zeros(len(timestamps), dtype=EventMonitor.EVENT_RECORD_DTYPE)
+    records['issuer'] = issuer_code
+    records['type'] = EventMonitor.EVENT_TYPES.index(EventMonitor.EVENT_TYPE_NOTE_ON)
+    records['timestamp'] = timestamps
+    return records
+
+
+class LatencyStatsTest(unittest.TestCase):
+    def test_percentiles_are_within_a_bin(self):
+        stats = LatencyStats(EventMonitor.ISSUERS)
+        latencies_s = np.linspace(0.001, 0.1, 1000)
+        stats.add(np.full(latencies_s.size, MIDI), latencies_s)
+        bin_ratio = 10.0 ** (1.0 / LatencyStats.BINS_PER_DECADE)
+        for percentile in [50, 95, 99]:
+            expected = np.percentile(latencies_s, percentile)
+            actual = stats.percentile(EventMonitor.EVENT_ISSUER_MIDI, percentile)
+            self.assertGreaterEqual(actual * bin_ratio, expected)
+            self.assertLessEqual(actual, expected * bin_ratio)
+        self.assertEqual(stats.percentile(EventMonitor.EVENT_ISSUER_MIDI, 100), 0.1)
+
+    def test_issuers_are_kept_apart(self):
+        stats = LatencyStats(EventMonitor.ISSUERS)
+        stats.add(np.array([MIDI, MIC, MIC]), np.array([0.002, 0.05, 0.05]))
+        self.assertEqual(stats.num_events(EventMonitor.EVENT_ISSUER_MIDI), 1)
+        self.assertEqual(stats.num_events(EventMonitor.EVENT_ISSUER_MIC), 2)
+        self.assertLess(stats.percentile(EventMonitor.EVENT_ISSUER_MIDI, 99), 0.003)
+        self.assertGreater(stats.percentile(EventMonitor.EVENT_ISSUER_MIC, 50), 0.045)
+
+    def test_writer_threads_add_concurrently(self):
+        stats = LatencyStats(EventMonitor.ISSUERS)
+        num_threads, num_adds = 8, 500
+        issuer_codes = np.array([MIDI, MIC, MIDI, MIDI])
+
+        def add(thread_index):
+            for i in range(num_adds):
+                stats.add(issuer_codes, np.array([0.001, 0.002, 0.003, 0.001 * (thread_index * num_adds + i + 1)]))
+
+        threads = [threading.Thread(target=add, args=(t,)) for t in range(num_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(stats.num_events(EventMonitor.EVENT_ISSUER_MIDI), 3 * num_threads * num_adds)
+        self.assertEqual(stats.num_events(EventMonitor.EVENT_ISSUER_MIC), num_threads * num_adds)
+        self.assertAlmostEqual(float(stats.max_latency_s[MIDI]), 0.001 * num_threads * num_adds)
+
+    def test_survives_pickling(self):
+        stats = LatencyStats(EventMonitor.ISSUERS)
+        stats.add(np.array([MIC]), np.array([0.01]))
+        copy = pickle.loads(pickle.dumps(stats))
+        copy.add(np.array([MIC]), np.array([0.02]))
+        self.assertEqual(copy.num_events(EventMonitor.EVENT_ISSUER_MIC), 2)
+
+    def test_no_events(self):
+        self.assertIsNone(LatencyStats(EventMonitor.ISSUERS).percentile(EventMonitor.EVENT_ISSUER_MIC, 50))
+
+
+class WriterLatencyTest(unittest.TestCase):
+    def test_latency_runs_until_the_frame_is_written(self):
+        stats = LatencyStats(EventMonitor.ISSUERS)
+        writer = AsyncLedWriter(NullOutput(2, write_time_s=0.02), 2, stats)
+        capture_time = time.monotonic()
+        writer.submit(np.ones((2, 3), dtype=np.uint8), event_records(MIDI, [capture_time]))
+        writer.close()
+        self.assertEqual(stats.num_events(EventMonitor.EVENT_ISSUER_MIDI), 1)
+        self.assertGreaterEqual(float(stats.max_latency_s[MIDI]), 0.02)
+
+    def test_events_behind_an_unchanged_frame_wait_for_the_next_one(self):
+        stats = LatencyStats(EventMonitor.ISSUERS)
+        output = NullOutput(2)
+        writer = AsyncLedWriter(output, 2, stats)
+        frame = np.ones((2, 3), dtype=np.uint8)
+        writer.submit(frame)
+        while output.frames_written == 0:
+            time.sleep(0.001)
+        writer.submit(frame, event_records(MIC, [time.monotonic()]))
+        while writer.frames_unchanged == 0:
+            time.sleep(0.001)
+        self.assertEqual(stats.num_events(EventMonitor.EVENT_ISSUER_MIC), 0)
+        writer.submit(frame * 2)
+        writer.close()
+        self.assertEqual(stats.num_events(EventMonitor.EVENT_ISSUER_MIC), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,260 @@
+"""Tests for laying the animated notes out along the LED strip and for the LED
+outputs (bulk NeoPixel SPI encoding and its public API fallback, DDP over UDP
+and the async writer thread).
+
+Run: python3 -m unittest test_led_mapping
+"""
+import contextlib
+import io
+import socket
+import threading
+import unittest
+
+import numpy as np
+
+from AnimationEngine import AnimationEngine
+from LedMapping import (
+    LedFrameRenderer, LED_MAPPING_FILL, LED_MAPPING_PITCH_CLASS, LED_MAPPING_KEYBOARD,
+)
+from LedOutput import AsyncLedWriter, DdpOutput, NeoPixelSpiOutput, NullOutput, neopixel_spi_encode
+from NoteUtils import PITCH_CLASS_COLOURS, midi_note_to_rgb
+
+
+def hold_notes(notes):
+    engine = AnimationEngine()
+    for note in notes:
+        engine.start(note, 1.0, 1.0, 0.05, AnimationEngine.CURVE_SQRTSTEP, colour=midi_note_to_rgb(note))
+    total_colour = engine.update(0.01)
+    return engine, total_colour
+
+
+def transmogrify(buffer, bit0, bit1):
+    """neopixel_spi.NeoPixel_SPI._transmogrify, the driver's per-bit Python loop."""
+    spibuf = bytearray(8 * len(buffer))
+    k = 0
+    for byte in buffer:
+        for i in range(7, -1, -1):
+            spibuf[k] = bit1 if byte >> i & 0x01 else bit0
+            k += 1
+    return bytes(spibuf)
+
+
+class LedFrameRendererTest(unittest.TestCase):
+    def test_fill_shows_the_blended_colour_everywhere(self):
+        engine, total_colour = hold_notes([60, 64, 67])
+        frame = LedFrameRenderer(LED_MAPPING_FILL, 7).render(engine, total_colour)
+        self.assertEqual(frame.shape, (7, 3))
+        np.testing.assert_allclose(frame, np.tile(total_colour, (7, 1)), atol=1e-6)
+
+    def test_pitch_class_segments_light_only_their_notes(self):
+        engine, total_colour = hold_notes([60, 76]) # C4 and E5
+        frame = LedFrameRenderer(LED_MAPPING_PITCH_CLASS, 24).render(engine, total_colour)
+        lit = np.flatnonzero(frame.any(axis=1))
+        self.assertEqual(lit.tolist(), [0, 1, 8, 9])
+        np.testing.assert_allclose(frame[0], PITCH_CLASS_COLOURS[0])
+        np.testing.assert_allclose(frame[9], PITCH_CLASS_COLOURS[4])
+
+    def test_pitch_class_segments_show_the_colours_of_their_notes(self):
+        engine = AnimationEngine()
+        green, blue = np.array([0.0, 1.0, 0.0]), np.array([0.0, 0.0, 1.0])
+        self.assertFalse(np.allclose(PITCH_CLASS_COLOURS[0], green))
+        # Two Cs with colours of their own at different brightnesses, and an E in its palette colour
+        engine.start(60, 1.0, 1.0, 0.05, AnimationEngine.CURVE_SQRTSTEP, colour=green)
+        engine.start(72, 0.5, 0.5, 0.05, AnimationEngine.CURVE_SQRTSTEP, colour=blue)
+        engine.start(64, 0.5, 0.5, 0.05, AnimationEngine.CURVE_SQRTSTEP)
+        frame = LedFrameRenderer(LED_MAPPING_PITCH_CLASS, 12).render(engine, engine.update(0.01))
+        # Weighted 2:1 by brightness, at the brightness of the brighter C
+        np.testing.assert_allclose(frame[0], (2.0 * green + blue) / 3.0, atol=1e-6)
+        np.testing.assert_allclose(frame[4], 0.5 * PITCH_CLASS_COLOURS[4], atol=1e-6)
+
+    def test_keyboard_lights_the_keys_position(self):
+        engine, total_colour = hold_notes([21, 108]) # Lowest and highest piano keys
+        frame = LedFrameRenderer(LED_MAPPING_KEYBOARD, 19).render(engine, total_colour)
+        lit = np.flatnonzero(frame.any(axis=1))
+        self.assertEqual(lit.tolist(), [0, 18])
+        np.testing.assert_allclose(frame[0], midi_note_to_rgb(21))
+        np.testing.assert_allclose(frame[18], midi_note_to_rgb(108))
+
+    def test_keyboard_gives_each_key_a_run_of_leds_on_dense_strips(self):
+        engine, total_colour = hold_notes([60])
+        renderer = LedFrameRenderer(LED_MAPPING_KEYBOARD, 88 * 4)
+        frame = renderer.render(engine, total_colour)
+        lit = np.flatnonzero(frame.any(axis=1))
+        self.assertEqual(lit.tolist(), list(range((60 - 21) * 4, (61 - 21) * 4)))
+        np.testing.assert_allclose(frame[lit], np.tile(midi_note_to_rgb(60), (4, 1)))
+
+    def test_dark_when_nothing_is_playing(self):
+        engine, total_colour = hold_notes([])
+        for mapping in [LED_MAPPING_FILL, LED_MAPPING_PITCH_CLASS, LED_MAPPING_KEYBOARD]:
+            frame = LedFrameRenderer(mapping, 30).render(engine, total_colour)
+            self.assertFalse(frame.any(), mapping)
+
+
+class NeoPixelSpiEncodeTest(unittest.TestCase):
+    def test_matches_the_drivers_bit_loop(self):
+        led_bytes = np.random.default_rng(0).integers(0, 256, (40, 3)).astype(np.uint8)
+        encoded = neopixel_spi_encode(led_bytes, 0b11000000, 0b11110000)
+        self.assertEqual(encoded.tobytes(), transmogrify(led_bytes.tobytes(), 0b11000000, 0b11110000))
+
+
+class FakeSpi(object):
+    """The driver's SPI device: a context manager that keeps what's written."""
+
+    def __init__(self):
+        self.written = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def write(self, data):
+        self.written.append(bytes(data))
+
+
+class FakeNeoPixelSpi(object):
+    """The NeoPixel_SPI internals NeoPixelSpiOutput's fast path writes to, for a GRB strip."""
+
+    def __init__(self, num_leds):
+        self._byteorder = (1, 0, 2)
+        self._post_brightness_buffer = bytearray(num_leds * 3)
+        self._bit0 = 0b11000000
+        self._bit1 = 0b11110000
+        self._reset = bytes(4)
+        self._spi = FakeSpi()
+
+
+class PublicNeoPixels(object):
+    """A driver with only the public pixel API: pixels set by index or slice, then show()."""
+
+    def __init__(self, num_leds):
+        self.values = [(0, 0, 0)] * num_leds
+        self.shown = []
+
+    def __setitem__(self, index, value):
+        self.values[index] = value
+
+    def show(self):
+        self.shown.append(list(self.values))
+
+
+class ChangedNeoPixelSpi(PublicNeoPixels):
+    """A driver version that has some of the internals, but not as the fast path expects them."""
+
+    def __init__(self, num_leds):
+        super().__init__(num_leds)
+        self._byteorder = (1, 0, 2)
+        self._post_brightness_buffer = memoryview(bytearray(num_leds * 4))
+        self._bit0 = 0b11000000
+        self._bit1 = 0b11110000
+        self._reset = bytes(4)
+        self._spi = FakeSpi()
+
+
+class NeoPixelSpiOutputTest(unittest.TestCase):
+    def frame(self):
+        return np.random.default_rng(1).integers(0, 256, (5, 3)).astype(np.uint8)
+
+    def test_fast_path_sends_the_drivers_bytes(self):
+        pixels = FakeNeoPixelSpi(5)
+        output = NeoPixelSpiOutput(5, pixels=pixels)
+        self.assertTrue(output.fast_path)
+        frame = self.frame()
+        output.write(frame)
+        grb = frame[:, [1, 0, 2]].tobytes()
+        self.assertEqual(bytes(pixels._post_brightness_buffer), grb)
+        self.assertEqual(pixels._spi.written[-1], bytes(4) + transmogrify(grb, pixels._bit0, pixels._bit1) + bytes(4))
+
+    def test_falls_back_to_the_public_api_without_the_internals(self):
+        for pixels in [PublicNeoPixels(5), ChangedNeoPixelSpi(5)]:
+            with contextlib.redirect_stdout(io.StringIO()):
+                output = NeoPixelSpiOutput(5, pixels=pixels)
+            self.assertFalse(output.fast_path)
+            frame = self.frame()
+            output.write(frame)
+            self.assertEqual(pixels.shown[-1], [tuple(rgb) for rgb in frame.tolist()])
+
+
+class DdpOutputTest(unittest.TestCase):
+    def setUp(self):
+        # A local receiver stands in for the DDP controller
+        self.receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.receiver.bind(('127.0.0.1', 0))
+        self.receiver.settimeout(2.0)
+        self.addCleanup(self.receiver.close)
+
+    def receive_frame(self, num_leds):
+        data = bytearray(num_leds * 3)
+        while True:
+            packet = self.receiver.recv(2048)
+            self.assertEqual(packet[0] & 0xC0, DdpOutput.DDP_FLAGS_VERSION_1)
+            self.assertEqual(packet[2], DdpOutput.DDP_DATA_TYPE_RGB8)
+            offset = int.from_bytes(packet[4:8], 'big')
+            length = int.from_bytes(packet[8:10], 'big')
+            self.assertEqual(len(packet), DdpOutput.DDP_HEADER_LEN + length)
+            data[offset:offset + length] = packet[DdpOutput.DDP_HEADER_LEN:]
+            if packet[0] & DdpOutput.DDP_FLAGS_PUSH:
+                return packet[1], np.frombuffer(bytes(data), dtype=np.uint8).reshape(num_leds, 3)
+
+    def test_frames_arrive_whole_across_packets(self):
+        num_leds = 1000 # Three packets
+        output = DdpOutput(num_leds, '127.0.0.1', self.receiver.getsockname()[1])
+        rng = np.random.default_rng(0)
+        sequences = []
+        for _ in range(3):
+            frame = rng.integers(0, 256, (num_leds, 3)).astype(np.uint8)
+            output.write(frame)
+            sequence, received = self.receive_frame(num_leds)
+            np.testing.assert_array_equal(received, frame)
+            sequences.append(sequence)
+        self.assertEqual(sequences, [1, 2, 3])
+        output.close()
+        _, received = self.receive_frame(num_leds)
+        self.assertFalse(received.any())
+
+
+class SlowOutput(NullOutput):
+    """Blocks every write until it's released, to stand in for a stalled bus."""
+
+    def __init__(self, num_leds):
+        super().__init__(num_leds)
+        self.release = threading.Event()
+        self.writing = threading.Event()
+        self.frames = []
+
+    def write(self, frame):
+        self.writing.set()
+        self.release.wait()
+        super().write(frame)
+        self.frames.append(frame.copy())
+
+
+class AsyncLedWriterTest(unittest.TestCase):
+    def test_only_the_latest_frame_is_sent_while_the_output_is_busy(self):
+        output = SlowOutput(2)
+        writer = AsyncLedWriter(output, 2)
+        writer.submit(np.full((2, 3), 1, dtype=np.uint8))
+        self.assertTrue(output.writing.wait(2.0))
+        # The output is stuck on the first frame, submitting never blocks
+        for value in range(2, 10):
+            writer.submit(np.full((2, 3), value, dtype=np.uint8))
+        output.release.set()
+        writer.close()
+        self.assertEqual([int(frame[0, 0]) for frame in output.frames], [1, 9])
+        self.assertEqual(writer.frames_skipped, 7)
+
+    def test_unchanged_frames_are_not_sent_again(self):
+        output = NullOutput(3)
+        writer = AsyncLedWriter(output, 3)
+        frame = np.arange(9, dtype=np.uint8).reshape(3, 3)
+        for _ in range(5):
+            writer.submit(frame)
+        writer.close()
+        self.assertEqual(output.frames_written, 1)
+        np.testing.assert_array_equal(output.last_frame, frame)
+        self.assertEqual(writer.frames_written + writer.frames_unchanged + writer.frames_skipped, 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
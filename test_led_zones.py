@@ -0,0 +1,168 @@
+"""Tests for the LED zones: loading and checking zone configurations, each
+zone rendering with its own mapping and brightness, and the zones' writers
+sending their frames in parallel.
+
+The writers are checked with outputs that only return once every zone is
+writing at the same time, so zones written one after the other time out.
+
+Run: python3 -m unittest test_led_zones
+"""
+import argparse
+import json
+import os
+import tempfile
+import threading
+import unittest
+
+import numpy as np
+
+from AnimationEngine import AnimationEngine
+from LedMapping import LED_MAPPING_FILL, LED_MAPPING_KEYBOARD, LED_MAPPING_PITCH_CLASS
+from LedOutput import LED_OUTPUT_DDP, LED_OUTPUT_NEOPIXEL, LED_OUTPUT_SIM, NullOutput, AsyncLedWriter
+from LedZones import LedZone, LedZoneConfig, check_zone_configs, led_zone_configs, load_zone_configs
+from NoteUtils import midi_note_to_rgb
+
+
+def make_args(**overrides):
+    args = dict(
+        num_leds=19, led_mapping=LED_MAPPING_FILL, brightness=1.0, dither=False,
+        output=LED_OUTPUT_NEOPIXEL, spi_bus=0, ddp_host=None, ddp_port=4048, led_zones=None, no_hw=False,
+    )
+    args.update(overrides)
+    return argparse.Namespace(**args)
+
+
+def hold_notes(notes):
+    engine = AnimationEngine()
+    for note in notes:
+        engine.start(note, 1.0, 1.0, 0.0, AnimationEngine.CURVE_SQRTSTEP, colour=midi_note_to_rgb(note))
+    return engine, engine.update(0.0)
+
+
+class ZoneConfigTest(unittest.TestCase):
+    def load(self, zones, **overrides):
+        with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+            json.dump(zones, f)
+        self.addCleanup(os.remove, f.name)
+        return load_zone_configs(f.name, make_args(**overrides))
+
+    def test_without_zones_the_flags_are_the_only_zone(self):
+        configs = led_zone_configs(make_args(num_leds=60, brightness=0.5, spi_bus=1))
+        self.assertEqual(len(configs), 1)
+        self.assertEqual((configs[0].num_leds, configs[0].brightness, configs[0].spi_bus), (60, 0.5, 1))
+
+    def test_left_out_fields_come_from_the_flags(self):
+        configs = self.load([
+            {"name": "keys", "num_leds": 88, "led_mapping": LED_MAPPING_KEYBOARD},
+            {"spi_bus": 1, "brightness": 0.25},
+        ], dither=True)
+        self.assertEqual([config.name for config in configs], ["keys", "zone2"])
+        self.assertEqual(configs[0].led_mapping, LED_MAPPING_KEYBOARD)
+        self.assertEqual((configs[1].num_leds, configs[1].led_mapping, configs[1].brightness), (19, LED_MAPPING_FILL, 0.25))
+        self.assertTrue(all(config.dither for config in configs))
+
+    def test_unknown_fields_are_an_error(self):
+        with self.assertRaises(ValueError):
+            self.load([{"num_led": 10}])
+
+    def test_neopixel_zones_need_a_bus_each(self):
+        with self.assertRaises(ValueError):
+            self.load([{"name": "a"}, {"name": "b"}])
+        # Zones that aren't on the SPI bus can share it
+        self.assertEqual(len(self.load([{"name": "a"}, {"name": "b", "output": LED_OUTPUT_SIM}])), 2)
+
+    def test_invalid_zones(self):
+        zone = LedZoneConfig("a", 10, LED_MAPPING_FILL, 1.0)
+        for invalid in [
+            [],
+            [zone, zone._replace(spi_bus=1)],
+            [zone._replace(num_leds=0)],
+            [zone._replace(led_mapping="spiral")],
+            [zone._replace(brightness=1.5)],
+            [zone._replace(output="dmx")],
+            [zone._replace(output=LED_OUTPUT_DDP)],
+            [zone._replace(spi_bus=-1)],
+            [zone._replace(ddp_port=0)],
+        ]:
+            with self.assertRaises(ValueError, msg=invalid):
+                check_zone_configs(invalid)
+
+    def test_fields_of_the_wrong_type_are_an_error(self):
+        for field, value in [
+            ("brightness", "high"), ("spi_bus", "0"), ("num_leds", 10.5), ("num_leds", True),
+            ("dither", 1), ("led_mapping", ["fill"]), ("ddp_host", 1), ("ddp_port", None), ("name", 3),
+        ]:
+            with self.assertRaises(ValueError, msg=(field, value)):
+                self.load([{field: value}])
+
+    def test_no_hw_skips_the_output_checks(self):
+        zones = [{"name": "a"}, {"name": "b"}, {"name": "c", "output": LED_OUTPUT_DDP}]
+        with self.assertRaises(ValueError):
+            self.load(zones)
+        self.assertEqual(len(self.load(zones, no_hw=True)), 3)
+
+
+class LedZoneTest(unittest.TestCase):
+    def open_zone(self, config):
+        zone = LedZone(config)
+        zone.open(no_hw=True)
+        self.addCleanup(zone.close)
+        return zone
+
+    def test_each_zone_has_its_own_mapping_and_brightness(self):
+        engine, total_colour = hold_notes([60])
+        fill = self.open_zone(LedZoneConfig("fill", 4, LED_MAPPING_FILL, 1.0))
+        segments = self.open_zone(LedZoneConfig("segments", 12, LED_MAPPING_PITCH_CLASS, 0.5))
+        self.assertTrue(fill.update(engine, total_colour))
+        self.assertTrue(segments.update(engine, total_colour))
+        self.assertTrue(np.all(fill.led_values == fill.led_values[0]))
+        self.assertTrue(fill.led_values.any())
+        # Only the C segment is lit, dimmer than the fill zone
+        self.assertEqual(np.flatnonzero(segments.led_values.any(axis=1)).tolist(), [0])
+        self.assertLess(segments.led_values[0].max(), fill.led_values[0].max())
+
+    def test_unchanged_frames_are_not_submitted(self):
+        engine, total_colour = hold_notes([60])
+        zone = self.open_zone(LedZoneConfig("fill", 4, LED_MAPPING_FILL, 1.0))
+        self.assertTrue(zone.update(engine, total_colour))
+        self.assertFalse(zone.update(engine, total_colour))
+        self.assertEqual(zone.writer.frames_submitted, 1)
+        self.assertFalse(zone.is_dark())
+
+    def test_no_hw_keeps_simulated_strips(self):
+        zone = self.open_zone(LedZoneConfig("sim", 100, LED_MAPPING_FILL, 1.0, output=LED_OUTPUT_SIM))
+        self.assertAlmostEqual(zone.writer.output.write_time_s, NullOutput.neopixel_write_time_s(100))
+
+
+class RendezvousOutput(NullOutput):
+    """Returns from a write only once every zone's output is writing too."""
+
+    def __init__(self, num_leds, barrier):
+        super().__init__(num_leds)
+        self.barrier = barrier
+        self.broken = False
+
+    def write(self, frame):
+        try:
+            self.barrier.wait(timeout=2.0)
+        except threading.BrokenBarrierError:
+            self.broken = True
+        super().write(frame)
+
+
+class ParallelWritersTest(unittest.TestCase):
+    def test_zones_are_written_at_the_same_time(self):
+        num_zones = 4
+        barrier = threading.Barrier(num_zones)
+        outputs = [RendezvousOutput(8, barrier) for _ in range(num_zones)]
+        writers = [AsyncLedWriter(output, 8, name="zone%d" % i) for i, output in enumerate(outputs)]
+        for i, writer in enumerate(writers):
+            writer.submit(np.full((8, 3), i + 1, dtype=np.uint8))
+        for writer in writers:
+            writer.close()
+        self.assertFalse(any(output.broken for output in outputs))
+        self.assertEqual([int(output.last_frame[0, 0]) for output in outputs], [1, 2, 3, 4])
+
+
+if __name__ == '__main__':
+    unittest.main()
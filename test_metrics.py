@@ -0,0 +1,80 @@
+"""Tests for the shared memory metrics and their Prometheus endpoint.
+
+Run: python3 -m unittest test_metrics
+"""
+import multiprocessing
+import pickle
+import unittest
+import urllib.error
+import urllib.request
+
+from EventMonitor import EventMonitor
+from Metrics import METRICS, Metrics, MetricsServer
+
+
+def count_midi_messages(metrics, num_messages):
+    for _ in range(num_messages):
+        metrics.inc("chromesthesia_midi_messages_total", issuer=EventMonitor.EVENT_ISSUER_MIDI)
+
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Metrics()
+        self.addCleanup(self.metrics.close)
+
+    def test_updates_from_another_process_are_seen(self):
+        process = multiprocessing.Process(target=count_midi_messages, args=(self.metrics, 250))
+        process.start()
+        process.join(10.0)
+        self.assertEqual(process.exitcode, 0)
+        self.assertEqual(self.metrics.get("chromesthesia_midi_messages_total", EventMonitor.EVENT_ISSUER_MIDI), 250.0)
+
+    def test_prometheus_text(self):
+        self.metrics.set("chromesthesia_animator_frame_seconds", 0.002)
+        self.metrics.set("chromesthesia_event_queue_depth", 3, EventMonitor.EVENT_ISSUER_MIC)
+        text = self.metrics.prometheus_text()
+        lines = text.splitlines()
+        self.assertIn("# TYPE chromesthesia_animator_frame_seconds gauge", lines)
+        self.assertIn("chromesthesia_animator_frame_seconds 0.002", lines)
+        self.assertIn('chromesthesia_event_queue_depth{issuer="MIC"} 3.0', lines)
+        self.assertIn('chromesthesia_event_queue_depth{issuer="MIDI"} 0.0', lines)
+        # A HELP and a TYPE line per metric, then a value per issuer of labelled metrics
+        num_values = sum(len(EventMonitor.ISSUERS) if label else 1 for _, _, _, label in METRICS)
+        self.assertEqual(len(lines), 2 * len(METRICS) + num_values)
+        self.assertTrue(text.endswith("\n"))
+
+    def test_labelled_metrics_have_a_value_per_issuer(self):
+        metrics = Metrics(shared=False, issuers=["MIDI", "MIDI2", "MIC"])
+        metrics.inc("chromesthesia_midi_messages_total", 2, "MIDI2")
+        lines = metrics.prometheus_text().splitlines()
+        self.assertIn('chromesthesia_midi_messages_total{issuer="MIDI2"} 2.0', lines)
+        self.assertIn('chromesthesia_midi_messages_total{issuer="MIDI"} 0.0', lines)
+        self.assertIn('chromesthesia_event_queue_depth{issuer="MIC"} 0.0', lines)
+
+    def test_unshared_metrics_are_picklable(self):
+        metrics = Metrics(shared=False)
+        metrics.inc("chromesthesia_mic_hops_total", 5, EventMonitor.EVENT_ISSUER_MIC)
+        self.assertEqual(pickle.loads(pickle.dumps(metrics)).get("chromesthesia_mic_hops_total", EventMonitor.EVENT_ISSUER_MIC), 5.0)
+
+
+class MetricsServerTest(unittest.TestCase):
+    def test_serves_the_collected_metrics(self):
+        metrics = Metrics()
+        event_monitor = EventMonitor()
+        self.addCleanup(metrics.close)
+        self.addCleanup(event_monitor.close)
+        server = MetricsServer(metrics, "127.0.0.1", 0, collect=lambda: event_monitor.update_metrics(metrics))
+        self.addCleanup(server.close)
+        event_monitor.on_event(EventMonitor.EVENT_ISSUER_MIDI, EventMonitor.EVENT_TYPE_CONNECTED)
+        event_monitor.on_event(EventMonitor.EVENT_ISSUER_MIDI, EventMonitor.EVENT_TYPE_DISCONNECTED)
+        url = "http://127.0.0.1:%d/metrics" % server.port
+        with urllib.request.urlopen(url, timeout=5.0) as response:
+            self.assertTrue(response.headers['Content-Type'].startswith('text/plain; version=0.0.4'))
+            body = response.read().decode('utf-8')
+        self.assertIn('chromesthesia_event_queue_depth{issuer="MIDI"} 2.0', body.splitlines())
+        with self.assertRaises(urllib.error.HTTPError):
+            urllib.request.urlopen("http://127.0.0.1:%d/other" % server.port, timeout=5.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
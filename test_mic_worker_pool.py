@@ -0,0 +1,144 @@
+"""Tests for the pyin worker pool's hand-out of results: in window order when
+the workers finish out of order, giving up on overdue windows (whose slots
+stay taken until their workers are done) and skipping windows that come due
+while every slot is busy.
+
+The workers run a fake analysis instead of pyin (no librosa needed): each
+window's last sample says which note it holds and how long analysing it takes.
+
+Run: python3 -m unittest test_mic_worker_pool
+"""
+import queue
+import time
+import unittest
+
+import numpy as np
+
+from MicWorkerPool import PyinWorkerPool
+from NoteUtils import midi_to_hz
+from SharedRingBuffer import _attach_shared_memory
+
+SAMPLE_RATE = 1000
+# Seconds of (fake) analysis per 128 added to a window's code
+DELAY_STEP_S = 0.01
+
+
+def window_code(midi_note, delay_s=0.0):
+    return midi_note + 128 * int(round(delay_s / DELAY_STEP_S))
+
+
+# Same protocol as MicWorkerPool._pyin_worker, but "detects" the note of the
+# window's code after sleeping for its delay
+def _fake_worker(shm_name, num_slots, window_length, sample_rate, tuning_hz, tasks, results):
+    shm = _attach_shared_memory(shm_name)
+    windows = np.ndarray((num_slots, window_length), dtype=np.float32, buffer=shm.buf)
+    try:
+        results.put(None)
+        while True:
+            try:
+                task = tasks.get(timeout=1.0)
+            except queue.Empty:
+                continue
+            if task is None:
+                break
+            seq, slot = task
+            code = int(windows[slot][-1])
+            time.sleep((code // 128) * DELAY_STEP_S)
+            results.put((seq, slot, np.array([midi_to_hz(code % 128, tuning_hz)])))
+    finally:
+        windows = None
+        shm.close()
+
+
+class FakeWorkerPool(PyinWorkerPool):
+    RESULT_TIMEOUT_S = 0.3
+    worker_main = staticmethod(_fake_worker)
+
+
+class PyinWorkerPoolTest(unittest.TestCase):
+    def make_pool(self, num_workers):
+        pool = FakeWorkerPool(SAMPLE_RATE, num_workers)
+        self.addCleanup(pool.close)
+        return pool
+
+    # Audio for the next hop, whose window ends in the hop's code
+    def hop(self, pool, code):
+        return np.full(pool.hop_length, code, dtype=np.float32)
+
+    # Hands the pool one window per code, each with its own capture time
+    def submit(self, pool, codes, first_capture_time=1.0):
+        results, capture_times = [], []
+        for i, code in enumerate(codes):
+            chunks = [self.hop(pool, code)]
+            if pool.audio_ring.num_written == 0:
+                # The first window needs a whole window of audio
+                chunks.insert(0, np.zeros(pool.window_length - pool.hop_length, dtype=np.float32))
+            detected_notes, times = pool.process(chunks, first_capture_time + i)
+            results += [notes.tolist() for notes in detected_notes]
+            capture_times += times
+        return results, capture_times
+
+    def wait(self, pool):
+        detected_notes, capture_times = pool.wait_for_results()
+        return [notes.tolist() for notes in detected_notes], capture_times
+
+    # The results of the windows, whether process() or wait_for_results() hands them out
+    def submit_and_wait(self, pool, codes, first_capture_time=1.0):
+        results, capture_times = self.submit(pool, codes, first_capture_time)
+        more_results, more_capture_times = self.wait(pool)
+        return results + more_results, capture_times + more_capture_times
+
+    def test_results_are_handed_out_in_window_order(self):
+        pool = self.make_pool(2)
+        # The second window's result comes back long before the first one's
+        results, _ = self.submit(pool, [window_code(60, 0.15), window_code(64)])
+        self.assertEqual(results, [])
+        deadline = time.monotonic() + 0.1
+        while time.monotonic() < deadline:
+            results += pool.process([])[0]
+        self.assertEqual(results, [])
+        self.assertEqual(self.wait(pool), ([[60], [64]], [1.0, 2.0]))
+        self.assertEqual((pool.skipped_windows, pool.timed_out_windows), (0, 0))
+
+    def test_overdue_windows_are_given_up_on(self):
+        pool = self.make_pool(2)
+        self.assertEqual(self.submit_and_wait(pool, [window_code(60, 0.6), window_code(64)]), ([[64]], [2.0]))
+        self.assertEqual(pool.timed_out_windows, 1)
+        # The late result is dropped and the next windows carry on
+        time.sleep(0.4)
+        self.assertEqual(self.submit_and_wait(pool, [window_code(67)], 3.0), ([[67]], [3.0]))
+
+    def test_overdue_windows_keep_their_slot_until_their_result_arrives(self):
+        pool = self.make_pool(1)
+        self.submit(pool, [window_code(60, 0.45)])
+        late_slot = pool._in_flight[0][0]
+        self.assertEqual(self.wait(pool), ([], []))
+        self.assertEqual(pool.timed_out_windows, 1)
+        # The worker is still analysing the overdue window, so only one of the
+        # next two windows gets a slot, and it isn't the overdue window's
+        results = self.submit(pool, [window_code(62), window_code(64)], 2.0)
+        self.assertEqual(pool.skipped_windows, 1)
+        self.assertEqual(pool._windows[late_slot][-1], window_code(60, 0.45))
+        more_results = self.wait(pool)
+        self.assertEqual((results[0] + more_results[0], results[1] + more_results[1]), ([[62]], [2.0]))
+        self.assertEqual(sorted(pool._free_slots), list(range(pool.num_slots)))
+
+    def test_windows_are_skipped_while_every_slot_is_busy(self):
+        pool = self.make_pool(1)
+        self.assertEqual(pool.num_slots, PyinWorkerPool.SLOTS_PER_WORKER)
+        results = self.submit_and_wait(pool, [window_code(60, 0.1), window_code(62), window_code(64)])
+        self.assertEqual(results, ([[60], [62]], [1.0, 2.0]))
+        self.assertEqual(pool.skipped_windows, 1)
+        # The slots are free again
+        self.assertEqual(self.submit_and_wait(pool, [window_code(65)], 4.0), ([[65]], [4.0]))
+
+    def test_close_stops_the_workers(self):
+        pool = self.make_pool(2)
+        workers = list(pool._workers)
+        pool.close()
+        self.assertFalse(any(worker.is_alive() for worker in workers))
+        pool.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
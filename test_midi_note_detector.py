@@ -0,0 +1,274 @@
+"""Tests for the MIDI note detector's live input: the messages the backend
+delivers (on its own thread, or polled for) reaching the event ring as one
+batch, and the port being noticed disappearing and coming back. Also its
+--midi-file playback (sent as fast as possible) and offline rendering.
+
+For the live input mido's port list and input ports are faked, so no MIDI
+backend or device is needed. The MIDI file tests write a small file with mido
+and are skipped without it.
+
+Run: python3 -m unittest test_midi_note_detector
+"""
+import argparse
+import contextlib
+import importlib.util
+import io
+import os
+import sys
+import tempfile
+import threading
+import time
+import types
+import unittest
+from unittest import mock
+
+from EventMonitor import EventMonitor
+
+# The MIDI file tests need the real mido (to write and read the files), the live
+# input tests fake its ports (see FakeMido) and run without it
+MIDO_INSTALLED = importlib.util.find_spec("mido") is not None
+if not MIDO_INSTALLED:
+    sys.modules["mido"] = types.ModuleType("mido")
+
+from MidiNoteDetector import MidiNoteDetector
+
+MIDI = EventMonitor.EVENT_ISSUER_MIDI
+CONNECTED = EventMonitor.EVENT_TYPE_CONNECTED
+DISCONNECTED = EventMonitor.EVENT_TYPE_DISCONNECTED
+NOTE_ON = EventMonitor.EVENT_TYPE_NOTE_ON
+NOTE_OFF = EventMonitor.EVENT_TYPE_NOTE_OFF
+PORT_NAME = MidiNoteDetector.DEFAULT_PORT_NAME + ":0"
+
+
+def note_on(note, velocity=100):
+    return types.SimpleNamespace(type='note_on', note=note, velocity=velocity)
+
+
+def note_off(note):
+    return types.SimpleNamespace(type='note_off', note=note, velocity=0)
+
+
+class FakePort(object):
+    def __init__(self, name, callback):
+        self.name = name
+        self.callback = callback
+        self.pending = []
+        self.closed = False
+
+    # Delivers the messages like the backend: to the callback on a thread of its
+    # own if there is one, otherwise to the next iter_pending()
+    def send(self, *messages):
+        if self.callback is None:
+            self.pending.extend(messages)
+            return
+        thread = threading.Thread(target=lambda: [self.callback(msg) for msg in messages])
+        thread.start()
+        thread.join()
+
+    def iter_pending(self):
+        pending, self.pending = self.pending, []
+        return iter(pending)
+
+    def close(self):
+        self.closed = True
+
+
+# The parts of mido the detector uses for live input. Listing the ports raises
+# KeyboardInterrupt once stopped, which ends MidiNoteDetector.run() like Ctrl+C.
+class FakeMido(object):
+    def __init__(self, input_names):
+        self.input_names = list(input_names)
+        self.ports = []
+        self.stopped = False
+
+    def get_input_names(self):
+        if self.stopped:
+            raise KeyboardInterrupt()
+        return list(self.input_names)
+
+    def open_input(self, name, callback=None):
+        port = FakePort(name, callback)
+        self.ports.append(port)
+        return port
+
+
+# Counts the batches sent through it
+class BatchCountingEventMonitor(EventMonitor):
+    def __init__(self):
+        super().__init__()
+        self.batch_sizes = []
+
+    def on_events(self, issuer, events):
+        self.batch_sizes.append(len(events))
+        return super().on_events(issuer, events)
+
+
+class FastMidiNoteDetector(MidiNoteDetector):
+    MIDI_PORT_CHECK_TIME_S = 0.01
+
+
+class MidiNoteDetectorTest(unittest.TestCase):
+    def setUp(self):
+        self.mido = FakeMido([PORT_NAME])
+        patcher = mock.patch("MidiNoteDetector.mido", self.mido)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.event_monitor = BatchCountingEventMonitor()
+        self.addCleanup(self.event_monitor.close)
+        self.received = []
+        for event_type in EventMonitor.EVENT_TYPES:
+            if event_type in EventMonitor.NOTE_EVENT_TYPES:
+                callback = lambda note_data, t=event_type: self.received.append((t, note_data.note))
+            else:
+                callback = lambda t=event_type: self.received.append((t,))
+            self.event_monitor.set_event_callback(MIDI, event_type, callback)
+
+    def make_detector(self, midi_input=MidiNoteDetector.MIDI_INPUT_CALLBACK):
+        args = argparse.Namespace(midi_file=None, midi_input=midi_input)
+        return FastMidiNoteDetector(self.event_monitor, args)
+
+    # Processes the events until the expected ones have arrived (or a second has passed)
+    def wait_for_events(self, expected):
+        deadline = time.monotonic() + 1.0
+        while self.received != expected and time.monotonic() < deadline:
+            if self.event_monitor.wait_for_events(timeout=0.01):
+                self.event_monitor.process_events()
+        self.assertEqual(self.received, expected)
+
+    def forward(self, detector, messages):
+        detector._open_midi_port(detector._find_midi_port())
+        detector.midi_port.send(*messages)
+        detector._wait_for_messages(1.0)
+        detector._forward_received_messages()
+
+    def test_callback_messages_reach_the_ring_as_one_batch(self):
+        detector = self.make_detector()
+        start_time = time.monotonic()
+        self.forward(detector, [note_on(60), note_on(64), note_off(60)])
+        self.assertEqual(self.event_monitor.batch_sizes, [3])
+        records = self.event_monitor.event_rings[self.event_monitor.issuer_code(MIDI)].peek()[0]
+        # Stamped with when they were received
+        self.assertTrue(all(start_time <= timestamp <= time.monotonic() for timestamp in records['timestamp']))
+        self.event_monitor.process_events()
+        self.assertEqual(self.received, [(NOTE_ON, 60), (NOTE_ON, 64), (NOTE_OFF, 60)])
+        self.assertEqual(list(detector.active_notes), [64])
+
+    def test_polled_messages_reach_the_ring_as_one_batch(self):
+        detector = self.make_detector(MidiNoteDetector.MIDI_INPUT_POLL)
+        self.forward(detector, [note_on(60), note_on(67)])
+        self.assertIsNone(self.mido.ports[0].callback)
+        self.assertEqual(self.event_monitor.batch_sizes, [2])
+        self.event_monitor.process_events()
+        self.assertEqual(self.received, [(NOTE_ON, 60), (NOTE_ON, 67)])
+
+    def test_quiet_port_only_waits_until_the_port_check(self):
+        detector = self.make_detector()
+        detector._open_midi_port(PORT_NAME)
+        start_time = time.monotonic()
+        detector._wait_for_messages(0.05)
+        self.assertLess(time.monotonic() - start_time, 0.5)
+        detector._forward_received_messages()
+        self.assertEqual(self.event_monitor.batch_sizes, [])
+
+    def test_port_disconnects_and_reconnects(self):
+        detector = self.make_detector()
+        thread = threading.Thread(target=detector.run)
+        with contextlib.redirect_stdout(io.StringIO()):
+            thread.start()
+            self.wait_for_events([(CONNECTED,)])
+            self.mido.ports[0].send(note_on(60))
+            self.wait_for_events([(CONNECTED,), (NOTE_ON, 60)])
+
+            self.mido.input_names = []
+            self.wait_for_events([(CONNECTED,), (NOTE_ON, 60), (DISCONNECTED,)])
+            self.assertTrue(self.mido.ports[0].closed)
+
+            self.mido.input_names = ["Other port", PORT_NAME]
+            expected = [(CONNECTED,), (NOTE_ON, 60), (DISCONNECTED,), (CONNECTED,)]
+            self.wait_for_events(expected)
+            self.assertEqual(len(self.mido.ports), 2)
+            self.mido.ports[1].send(note_on(64))
+            self.wait_for_events(expected + [(NOTE_ON, 64)])
+            self.assertEqual(list(detector.active_notes), [64])
+
+            self.mido.stopped = True
+            thread.join(timeout=1.0)
+        self.assertFalse(thread.is_alive())
+
+
+@unittest.skipUnless(MIDO_INSTALLED, "needs mido to write the MIDI file")
+class MidiFileTest(unittest.TestCase):
+    # Beat = 0.5s at the default tempo, so 240 ticks = 0.25s
+    TICKS_PER_BEAT = 480
+
+    def setUp(self):
+        import mido
+        midi_file = mido.MidiFile(ticks_per_beat=self.TICKS_PER_BEAT)
+        track = mido.MidiTrack()
+        midi_file.tracks.append(track)
+        track.append(mido.Message('note_on', note=60, velocity=100, time=0))
+        track.append(mido.Message('control_change', control=64, value=127, time=0))
+        track.append(mido.Message('note_on', note=64, velocity=100, time=240))
+        # Too soft to count as a note on
+        track.append(mido.Message('note_on', note=67, velocity=2, time=0))
+        track.append(mido.Message('note_off', note=60, velocity=0, time=240))
+        # A note on with velocity 0 is a note off
+        track.append(mido.Message('note_on', note=64, velocity=0, time=240))
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.path = os.path.join(temp_dir.name, "notes.mid")
+        midi_file.save(self.path)
+
+        self.event_monitor = EventMonitor()
+        self.addCleanup(self.event_monitor.close)
+        self.received = []
+        self.active_notes = set()
+        for event_type in EventMonitor.EVENT_TYPES:
+            if event_type in EventMonitor.NOTE_EVENT_TYPES:
+                callback = lambda note_data, t=event_type: self.on_note_event(t, note_data.note)
+            else:
+                callback = lambda t=event_type: self.received.append((t,))
+            self.event_monitor.set_event_callback(MIDI, event_type, callback)
+        args = argparse.Namespace(midi_file=self.path, midi_file_speed=0.0, midi_input=MidiNoteDetector.MIDI_INPUT_CALLBACK)
+        self.detector = MidiNoteDetector(self.event_monitor, args)
+
+    def on_note_event(self, event_type, note):
+        self.received.append((event_type, note))
+        if event_type == NOTE_ON:
+            self.active_notes.add(note)
+        else:
+            self.active_notes.discard(note)
+
+    def test_playback_sends_the_file_s_note_events(self):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            self.detector.run()
+        self.assertEqual(self.event_monitor.pending_events(MIDI), 6)
+        self.event_monitor.process_events()
+        self.assertEqual(self.received, [
+            (CONNECTED,), (NOTE_ON, 60), (NOTE_ON, 64), (NOTE_OFF, 60), (NOTE_OFF, 64), (DISCONNECTED,),
+        ])
+        report = output.getvalue()
+        self.assertIn("Duration: 0.75s", report)
+        self.assertIn("Messages: 6 (5 note on/off)", report)
+        self.assertIn("(speed: unthrottled)", report)
+        self.assertIn("Events dropped (event ring full): 0", report)
+        self.assertIn("Peak event ring depth: 5 / %d" % EventMonitor.EVENT_RING_SIZE, report)
+
+    def test_render_sends_the_events_before_each_frame(self):
+        frames = []
+
+        def render_frame(time_s):
+            self.event_monitor.process_events()
+            frames.append((round(time_s, 3), sorted(self.active_notes)))
+            return len(self.received) > 0 and self.received[-1] == (DISCONNECTED,)
+
+        self.detector.render_midi_file(self.path, 0.1, render_frame)
+        self.assertEqual(frames, [
+            (0.0, [60]), (0.1, [60]), (0.2, [60]), (0.3, [60, 64]), (0.4, [60, 64]),
+            (0.5, [64]), (0.6, [64]), (0.7, [64]), (0.8, []),
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()
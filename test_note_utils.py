@@ -5,8 +5,12 @@ values now live in note_colours.json (shared with the web view). These tests
 pin the exact pre-refactor values so the LED output can never silently change
 when the JSON is edited by mistake.
 
+Also checks the MIDI note number tables that the note pipeline uses instead of
+note name strings, and the note/frequency conversions used instead of librosa's.
+
 Run: python3 -m unittest test_note_utils
 """
+import pickle
 import unittest
 
 import numpy as np
@@ -58,5 +62,48 @@ class NoteColourParityTest(unittest.TestCase):
         )
 
 
+class MidiNoteTableTest(unittest.TestCase):
+    def test_names_round_trip_through_note_numbers(self):
+        self.assertEqual(NoteUtils.MIDI_NOTE_NAMES[60], 'C4')
+        self.assertEqual(NoteUtils.MIDI_NOTE_NAMES[21], 'A0')
+        self.assertEqual(NoteUtils.MIDI_NOTE_NAMES[61], 'Db4')
+        self.assertEqual(NoteUtils.midi_number_from_midi_name('C#4'), 61)
+        for midi_note, name in enumerate(NoteUtils.MIDI_NOTE_NAMES):
+            self.assertEqual(NoteUtils.midi_number_from_midi_name(name), midi_note)
+
+    def test_note_colours_match_note_to_rgb(self):
+        for midi_note in range(NoteUtils.NUM_MIDI_NOTES):
+            note_name = NoteUtils.CHROMATIC_NOTE_NAMES[midi_note % 12]
+            np.testing.assert_array_equal(
+                NoteUtils.midi_note_to_rgb(midi_note), NoteUtils.note_to_rgb(note_name, 1.0)
+            )
+
+    def test_note_data_survives_the_event_queue(self):
+        note_data = NoteUtils.NoteData(issuers={'MIDI'}, note=70, intensity=0.5)
+        self.assertEqual(note_data.pitch_class, 10)
+        copy = pickle.loads(pickle.dumps(note_data))
+        self.assertEqual(copy, note_data)
+        self.assertEqual(copy.pitch_class, 10)
+        self.assertIn('Bb4', repr(copy))
+
+
+class NoteFrequencyTest(unittest.TestCase):
+    def test_reference_frequencies(self):
+        self.assertEqual(NoteUtils.MIDI_NOTE_FREQUENCIES[69], 440.0)
+        self.assertAlmostEqual(NoteUtils.MIDI_NOTE_FREQUENCIES[60], 261.6255653005986)
+        self.assertAlmostEqual(NoteUtils.MIDI_NOTE_FREQUENCIES[21], 27.5)
+        self.assertAlmostEqual(NoteUtils.MIDI_NOTE_FREQUENCIES[NoteUtils.midi_number_from_midi_name('A5')], 880.0)
+        self.assertAlmostEqual(float(NoteUtils.midi_to_hz(60.5)), 269.2917795270241)
+
+    def test_hz_to_midi_inverts_midi_to_hz(self):
+        midi_notes = np.linspace(0.0, 127.0, 1001)
+        np.testing.assert_allclose(NoteUtils.hz_to_midi(NoteUtils.midi_to_hz(midi_notes)), midi_notes, atol=1e-9)
+        self.assertAlmostEqual(float(NoteUtils.hz_to_midi(440.0)), 69.0)
+
+    def test_table_is_read_only(self):
+        with self.assertRaises(ValueError):
+            NoteUtils.MIDI_NOTE_FREQUENCIES[0] = 0.0
+
+
 if __name__ == '__main__':
     unittest.main()
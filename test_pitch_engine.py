@@ -0,0 +1,258 @@
+"""Tests for the mic pitch engines' note quantisation, the streaming pitch
+engine and the mic note detector's note on/off diff and audio file replay.
+
+The quantiser's hysteresis is checked with pitches wavering on the boundary
+between two notes, the streaming engine with synthetic tones (steady, changing
+note, retuned) and its running difference function against a full recompute,
+the detector's note events with a recording event monitor, and its --mic-file
+replay with a synthetic WAV (written with soundfile, skipped without it).
+
+Run: python3 -m unittest test_pitch_engine
+"""
+import argparse
+import contextlib
+import importlib.util
+import io
+import os
+import tempfile
+import time
+import unittest
+
+import numpy as np
+
+from EventMonitor import EventMonitor
+from MicNoteDetector import MicNoteDetector
+from NoteUtils import midi_to_hz
+from PitchEngine import INT16_SCALE, MAX_MIDI_NOTE, MIN_MIDI_NOTE, NoteQuantiser, StreamingPitchEngine
+
+SAMPLE_RATE = 22050
+
+
+# Pitch (Hz) cents away from the MIDI note (A4 = tuning_hz)
+def detuned(midi_note, cents, tuning_hz=440.0):
+    return np.array([midi_to_hz(midi_note + cents / 100.0, tuning_hz)])
+
+
+class NoteQuantiserTest(unittest.TestCase):
+    def test_nearest_note(self):
+        quantiser = NoteQuantiser()
+        np.testing.assert_array_equal(quantiser.quantise(np.array([440.0, 261.63, 440.5])), [60, 69])
+
+    def test_boundary_flicker_holds_the_note(self):
+        quantiser = NoteQuantiser(hysteresis_cents=25.0)
+        self.assertEqual(quantiser.quantise(detuned(60, 0.0)).tolist(), [60])
+        for cents in [45.0, 55.0, 48.0, 62.0, 51.0, 70.0]:
+            self.assertEqual(quantiser.quantise(detuned(60, cents)).tolist(), [60], cents)
+
+    def test_real_note_change(self):
+        quantiser = NoteQuantiser(hysteresis_cents=25.0)
+        quantiser.quantise(detuned(60, 0.0))
+        self.assertEqual(quantiser.quantise(detuned(60, 80.0)).tolist(), [61])
+        self.assertEqual(quantiser.quantise(detuned(64, 0.0)).tolist(), [64])
+
+    def test_no_hysteresis_takes_the_nearest_note(self):
+        quantiser = NoteQuantiser(hysteresis_cents=0.0)
+        quantiser.quantise(detuned(60, 0.0))
+        self.assertEqual(quantiser.quantise(detuned(60, 55.0)).tolist(), [61])
+        self.assertEqual(quantiser.quantise(detuned(60, 45.0)).tolist(), [60])
+
+    def test_silence_releases_the_held_notes(self):
+        quantiser = NoteQuantiser(hysteresis_cents=25.0)
+        quantiser.quantise(detuned(60, 0.0))
+        self.assertEqual(quantiser.quantise(np.zeros(0)).tolist(), [])
+        self.assertEqual(quantiser.quantise(detuned(60, 60.0)).tolist(), [61])
+
+    def test_tuning_reference(self):
+        self.assertEqual(NoteQuantiser(432.0).quantise(np.array([432.0])).tolist(), [69])
+        # A4 of baroque pitch is G#4 at 440
+        self.assertEqual(NoteQuantiser(415.3).quantise(np.array([415.3])).tolist(), [69])
+        self.assertEqual(NoteQuantiser(440.0).quantise(np.array([415.3])).tolist(), [68])
+
+
+class StreamingTuningTest(unittest.TestCase):
+    # The notes the streaming engine settles on for a steady tone
+    def settled_notes(self, frequency_hz, tuning_hz):
+        engine = StreamingPitchEngine(SAMPLE_RATE, tuning_hz)
+        t = np.arange(SAMPLE_RATE) / SAMPLE_RATE
+        audio = (8000.0 * np.sin(2.0 * np.pi * frequency_hz * t)).astype(np.int16)
+        results = engine.analyse_hops([audio])
+        return {note for notes in results[len(results) // 2:] for note in notes.tolist()}
+
+    def test_tuned_a4(self):
+        self.assertEqual(self.settled_notes(415.3, 415.3), {69})
+        self.assertEqual(self.settled_notes(415.3, 440.0), {68})
+
+
+# int16 samples of a sine wave
+def tone(frequency_hz, seconds, amplitude=8000.0):
+    t = np.arange(int(SAMPLE_RATE * seconds)) / SAMPLE_RATE
+    return (amplitude * np.sin(2.0 * np.pi * frequency_hz * t)).astype(np.int16)
+
+
+class StreamingPitchEngineTest(unittest.TestCase):
+    # Where the engine's latest hop analysed its frame, as positions in the audio
+    def frame_start(self, engine, hop):
+        return hop * engine.hop_length + engine.hop_length
+
+    # The engine's difference function of its latest frame, computed from scratch
+    def full_difference(self, engine):
+        view = engine.audio_ring.window(engine.hop_cursor.next_end - engine.hop_length, engine.view_length)
+        diff = engine._difference_rows(view, engine.hop_length, engine.frame_length, engine._frame_fft_size)
+        return np.maximum(diff, 0.0)
+
+    # Checks the engine's running difference function against a full recompute:
+    # the same values on hops that rebuilt it, otherwise within the rounding of
+    # the engine's float32 FFTs
+    def check_difference(self, engine, rebuilt):
+        expected = self.full_difference(engine)
+        if rebuilt:
+            np.testing.assert_array_equal(engine._diff, expected)
+        else:
+            np.testing.assert_allclose(engine._diff, expected, rtol=0.0, atol=1e-5 * expected.max())
+
+    def test_steady_tones_land_on_their_notes(self):
+        for midi_note in [MIN_MIDI_NOTE + 5, 57, 60, 64, 76, MAX_MIDI_NOTE - 5]:
+            results = StreamingPitchEngine(SAMPLE_RATE).analyse_hops([tone(midi_to_hz(midi_note), 0.5)])
+            self.assertEqual({tuple(notes.tolist()) for notes in results[5:]}, {(midi_note,)}, midi_note)
+
+    def test_silence_has_no_notes(self):
+        results = StreamingPitchEngine(SAMPLE_RATE).analyse_hops([np.zeros(SAMPLE_RATE // 2, dtype=np.int16)])
+        self.assertTrue(len(results) > 0 and all(notes.size == 0 for notes in results))
+
+    def test_note_changes_between_hops(self):
+        engine = StreamingPitchEngine(SAMPLE_RATE)
+        change = SAMPLE_RATE // 2
+        results = engine.analyse_hops([np.concatenate([tone(midi_to_hz(60), 0.5), tone(midi_to_hz(64), 0.5)])])
+        for hop, notes in enumerate(results):
+            frame_start = self.frame_start(engine, hop)
+            if frame_start + engine.frame_length <= change:
+                self.assertEqual(notes.tolist(), [60], hop)
+            elif frame_start >= change + 2 * engine.hop_length:
+                self.assertEqual(notes.tolist(), [64], hop)
+            else:
+                # Frames holding both tones may be unvoiced, but never another note
+                self.assertIn(notes.tolist(), [[], [60], [64]], hop)
+
+    def test_sliding_difference_matches_a_full_recompute(self):
+        engine = StreamingPitchEngine(SAMPLE_RATE)
+        engine.RESYNC_HOPS = 7
+        rng = np.random.default_rng(1)
+        audio = (tone(midi_to_hz(57), 0.5) + rng.normal(0.0, 500.0, SAMPLE_RATE // 2)).astype(np.int16)
+        # The first hop primes the running sum, then it slides and is rebuilt every RESYNC_HOPS
+        written = engine.view_length
+        engine.analyse_hops([audio[:written]])
+        self.check_difference(engine, rebuilt=True)
+        rebuilds = 0
+        for _ in range(20):
+            self.assertEqual(len(engine.analyse_hops([audio[written:written + engine.hop_length]])), 1)
+            written += engine.hop_length
+            rebuilt = engine._hops_since_resync == 0
+            rebuilds += rebuilt
+            self.check_difference(engine, rebuilt)
+        self.assertEqual(rebuilds, 20 // (engine.RESYNC_HOPS + 1))
+
+        # Skipped hops break the running sum, so it's rebuilt from the new frame
+        engine.hop_cursor.max_pending_hops = 2
+        self.assertEqual(len(engine.analyse_hops([audio[written:written + 6 * engine.hop_length]])), 2)
+        written += 6 * engine.hop_length
+        self.assertEqual(engine.hop_cursor.skipped_hops, 4)
+        self.assertEqual(engine._hops_since_resync, 1)
+        for _ in range(3):
+            engine.analyse_hops([audio[written:written + engine.hop_length]])
+            written += engine.hop_length
+            self.check_difference(engine, rebuilt=False)
+
+
+# Records the events sent through it
+class RecordingEventMonitor(object):
+    def __init__(self):
+        self.events = []
+
+    def on_event(self, issuer, event_type, note_data, capture_time=None):
+        self.events.append((event_type, note_data.note))
+
+
+class ActiveNotesTest(unittest.TestCase):
+    def setUp(self):
+        self.event_monitor = RecordingEventMonitor()
+        self.detector = MicNoteDetector(self.event_monitor, argparse.Namespace())
+
+    def update(self, notes):
+        self.event_monitor.events = []
+        self.detector._update_active_notes(np.array(notes, dtype=np.int64))
+        return self.event_monitor.events
+
+    def test_note_on_and_off(self):
+        on, off = EventMonitor.EVENT_TYPE_NOTE_ON, EventMonitor.EVENT_TYPE_NOTE_OFF
+        self.assertEqual(self.update([60, 64]), [(on, 60), (on, 64)])
+        self.assertEqual(self.update([60, 64]), [])
+        self.assertEqual(self.update([60, 67]), [(off, 64), (on, 67)])
+        self.assertEqual(self.update([]), [(off, 60), (off, 67)])
+        self.assertEqual(self.detector.active_notes, {})
+
+    def test_active_notes_hold_the_note_on_data(self):
+        self.update([69])
+        note_data = self.detector.active_notes[69]
+        self.assertEqual(note_data.note, 69)
+        self.assertEqual(note_data.issuers, {EventMonitor.EVENT_ISSUER_MIC})
+        self.assertEqual(self.update([]), [(EventMonitor.EVENT_TYPE_NOTE_OFF, 69)])
+
+
+
+@unittest.skipUnless(importlib.util.find_spec("soundfile"), "needs soundfile to write the WAV")
+class MicFileReplayTest(unittest.TestCase):
+    def setUp(self):
+        import soundfile
+        silence = lambda seconds: np.zeros(int(SAMPLE_RATE * seconds), dtype=np.int16)
+        # C4 from 0.1s to 0.4s and E4 from 0.6s to 0.9s
+        self.audio = np.concatenate([
+            silence(0.1), tone(midi_to_hz(60), 0.3), silence(0.2), tone(midi_to_hz(64), 0.3), silence(0.1),
+        ])
+        with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as f:
+            soundfile.write(f, self.audio, SAMPLE_RATE, format="WAV")
+        self.addCleanup(os.remove, f.name)
+        self.path = f.name
+        self.event_monitor = EventMonitor()
+        self.addCleanup(self.event_monitor.close)
+
+    def replay(self, speed):
+        args = argparse.Namespace(pitch_engine="stream", mic_workers=0, tuning_hz=440.0, note_hysteresis_cents=None)
+        detector = MicNoteDetector(self.event_monitor, args)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            timeline = detector._replay_audio_file(self.path, speed)
+        return timeline, output.getvalue()
+
+    def test_replay_detects_the_note_timeline(self):
+        timeline, report = self.replay(0.0)
+        self.assertEqual([(event, note) for _, event, note in timeline], [("on", 60), ("off", 60), ("on", 64), ("off", 64)])
+        # Each note event comes within a few hops of the tone starting or stopping
+        for (stream_time_s, _, _), change_s in zip(timeline, [0.1, 0.4, 0.6, 0.9]):
+            self.assertTrue(change_s <= stream_time_s <= change_s + 0.08, (stream_time_s, change_s))
+        self.assertIn("real-time factor", report)
+        self.assertIn("Per-hop analysis (hop = 10.0ms", report)
+        self.assertIn("Skipped hops: 0", report)
+
+        received = []
+        for event_type in EventMonitor.EVENT_TYPES:
+            if event_type in EventMonitor.NOTE_EVENT_TYPES:
+                callback = lambda note_data, t=event_type: received.append((t, note_data.note))
+            else:
+                callback = lambda t=event_type: received.append((t,))
+            self.event_monitor.set_event_callback(EventMonitor.EVENT_ISSUER_MIC, event_type, callback)
+        self.event_monitor.process_events()
+        on, off = EventMonitor.EVENT_TYPE_NOTE_ON, EventMonitor.EVENT_TYPE_NOTE_OFF
+        self.assertEqual(received, [
+            (EventMonitor.EVENT_TYPE_CONNECTED,), (on, 60), (off, 60), (on, 64), (off, 64),
+            (EventMonitor.EVENT_TYPE_DISCONNECTED,),
+        ])
+
+    def test_replay_is_paced_by_its_speed(self):
+        start_time = time.perf_counter()
+        timeline, _ = self.replay(5.0)
+        self.assertGreaterEqual(time.perf_counter() - start_time, self.audio.size / SAMPLE_RATE / 5.0)
+        self.assertEqual(len(timeline), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+"""Tests for the mic accumulation ring buffer.
+
+The pitch engines analyse zero-copy views handed out by AudioRingBuffer and
+rely on HopCursor for exact window/hop sizes, so a wrap-around or off-by-one
+here would silently feed the analyser the wrong audio.
+
+Run: python3 -m unittest test_ring_buffer
+"""
+import unittest
+
+import numpy as np
+
+from RingBuffer import AudioRingBuffer, HopCursor
+
+
+class AudioRingBufferTest(unittest.TestCase):
+    def test_windows_are_contiguous_across_the_wrap(self):
+        ring = AudioRingBuffer(8)
+        stream = np.arange(30, dtype=np.int16)
+        for i in range(0, stream.size, 3):
+            ring.write(stream[i:i+3])
+            end = ring.num_written
+            length = min(end, ring.capacity)
+            view = ring.window(end, length)
+            np.testing.assert_array_equal(view, stream[end-length:end])
+
+    def test_window_is_a_view_not_a_copy(self):
+        ring = AudioRingBuffer(8)
+        ring.write(np.arange(6, dtype=np.int16))
+        self.assertIsNotNone(ring.latest(4).base)
+
+    def test_scale_is_applied_on_write(self):
+        ring = AudioRingBuffer(4, scale=0.5)
+        ring.write(np.array([2, 4], dtype=np.int16))
+        np.testing.assert_array_equal(ring.latest(2), np.array([1.0, 2.0], dtype=np.float32))
+
+    def test_oversized_write_keeps_newest_samples(self):
+        ring = AudioRingBuffer(4)
+        ring.write(np.arange(10, dtype=np.int16))
+        self.assertEqual(ring.num_written, 10)
+        np.testing.assert_array_equal(ring.latest(4), [6, 7, 8, 9])
+
+    def test_overwritten_window_raises(self):
+        ring = AudioRingBuffer(4)
+        ring.write(np.arange(10, dtype=np.int16))
+        with self.assertRaises(IndexError):
+            ring.window(5, 2)
+        with self.assertRaises(IndexError):
+            ring.window(11, 2)
+
+
+class HopCursorTest(unittest.TestCase):
+    def test_exact_window_and_hop(self):
+        ring = AudioRingBuffer(64)
+        cursor = HopCursor(ring, window_length=8, hop_length=4)
+        stream = np.arange(40, dtype=np.int16)
+        starts = []
+        for i in range(0, stream.size, 5):
+            ring.write(stream[i:i+5])
+            for view in cursor.windows():
+                self.assertEqual(view.size, 8)
+                starts.append(int(view[0]))
+        self.assertEqual(starts, list(range(0, 40 - 8 + 1, 4)))
+        self.assertEqual(cursor.skipped_hops, 0)
+
+    def test_backlog_is_limited_to_max_pending_hops(self):
+        ring = AudioRingBuffer(64)
+        cursor = HopCursor(ring, window_length=8, hop_length=4, max_pending_hops=1)
+        ring.write(np.arange(40, dtype=np.int16))
+        views = [view.copy() for view in cursor.windows()]
+        self.assertEqual(len(views), 1)
+        np.testing.assert_array_equal(views[0], np.arange(32, 40))
+        self.assertEqual(cursor.skipped_hops, 8)
+
+    def test_overwritten_hops_are_skipped(self):
+        ring = AudioRingBuffer(16)
+        cursor = HopCursor(ring, window_length=8, hop_length=4)
+        ring.write(np.arange(40, dtype=np.int16))
+        starts = [int(view[0]) for view in cursor.windows()]
+        self.assertEqual(starts, [24, 28, 32])
+        self.assertEqual(cursor.skipped_hops, 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+"""Tests for the lock-free audio handoff between the PortAudio thread and the
+mic analysis loop.
+
+Run: python3 -m unittest test_shared_ring_buffer
+"""
+import pickle
+import unittest
+
+import numpy as np
+
+from SharedRingBuffer import SharedRingBuffer
+
+
+class SharedRingBufferTest(unittest.TestCase):
+    def setUp(self):
+        self.ring = SharedRingBuffer(8, dtype=np.int16)
+
+    def tearDown(self):
+        self.ring.close()
+
+    def drain(self, ring):
+        segments = ring.peek()
+        items = np.concatenate(segments) if segments else np.array([], dtype=np.int16)
+        ring.release(items.size)
+        return items.tolist()
+
+    def test_items_come_out_in_order_across_the_wrap(self):
+        received = []
+        for start in range(0, 30, 3):
+            self.assertTrue(self.ring.write(np.arange(start, start + 3, dtype=np.int16)))
+            if start % 2 == 0:
+                received += self.drain(self.ring)
+        received += self.drain(self.ring)
+        self.assertEqual(received, list(range(30)))
+        self.assertEqual(self.ring.overruns(), (0, 0))
+
+    def test_full_ring_drops_and_counts_whole_writes(self):
+        self.assertTrue(self.ring.write(np.arange(6, dtype=np.int16)))
+        self.assertFalse(self.ring.write(np.arange(3, dtype=np.int16)))
+        self.assertEqual(self.ring.overruns(), (1, 3))
+        self.assertEqual(self.drain(self.ring), list(range(6)))
+
+    def test_wait_for_data_times_out_when_empty(self):
+        self.assertFalse(self.ring.wait_for_data(timeout=0.01))
+        self.ring.write(np.array([1], dtype=np.int16))
+        self.assertTrue(self.ring.wait_for_data(timeout=0.01))
+
+    def test_pickled_copy_shares_the_buffer(self):
+        consumer = pickle.loads(pickle.dumps(self.ring))
+        try:
+            self.ring.write(np.array([4, 5, 6], dtype=np.int16))
+            self.assertEqual(self.drain(consumer), [4, 5, 6])
+            self.assertEqual(self.ring.readable(), 0)
+        finally:
+            consumer.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+"""Guards the start-up footprint of the processes: the mic side's modules and
+the streaming and chroma pitch engines must not load librosa (or the numba,
+scipy and scikit-learn stack under it) or pyaudio, which only the mic process
+loads once it needs them (pyin, an actual microphone).
+
+Run: python3 -m unittest test_startup_imports
+"""
+import os
+import subprocess
+import sys
+import unittest
+
+HEAVY_MODULES = ['librosa', 'numba', 'scipy', 'sklearn', 'pyaudio']
+
+
+# Modules of HEAVY_MODULES a fresh interpreter has loaded after running code
+def heavy_modules_after(code):
+    script = code + "\nimport sys\nprint(' '.join(m for m in %r if m in sys.modules))" % HEAVY_MODULES
+    output = subprocess.run(
+        [sys.executable, '-c', script], cwd=os.path.dirname(os.path.abspath(__file__)),
+        check=True, capture_output=True, text=True
+    ).stdout
+    return output.split()
+
+
+class StartupImportsTest(unittest.TestCase):
+    def test_mic_modules_import_lightly(self):
+        self.assertEqual(heavy_modules_after("import MicNoteDetector, MicWorkerPool, PitchEngine"), [])
+
+    def test_streaming_and_chroma_engines_need_no_librosa(self):
+        self.assertEqual(heavy_modules_after(
+            "import PitchEngine\n"
+            "PitchEngine.create_pitch_engine(PitchEngine.PITCH_ENGINE_STREAM, 44100)\n"
+            "PitchEngine.create_pitch_engine(PitchEngine.PITCH_ENGINE_CHROMA, 44100)"
+        ), [])
+
+
+if __name__ == '__main__':
+    unittest.main()